@@ -22,6 +22,8 @@ import mailpile.util
 import mailpile.ui
 import mailpile.postinglist
 import mailpile.security as security
+import mailpile.mailutils
+import mailpile.mailboxes.fdpool
 from mailpile.crypto.gpgi import GnuPG
 from mailpile.eventlog import Event
 from mailpile.i18n import gettext as _
@@ -1716,14 +1718,28 @@ class ProgramStatus(Command):
             else:
                 locks = _('Nothing Found')
 
+            pc = self.result['parse_cache']
+            parse_cache = ('  %d messages, %d/%d KB, %d hits, %d misses'
+                           ', %d evicted'
+                           ) % (pc['entries'], pc['bytes'] // 1024,
+                                pc['max_bytes'] // 1024, pc['hits'],
+                                pc['misses'], pc['evictions'])
+            fp = self.result['fd_pool']
+            fd_pool = ('  %d/%d open, %d hits, %d misses, %d evicted'
+                       ) % (fp['entries'], fp['max_fds'], fp['hits'],
+                            fp['misses'], fp['evictions'])
+
             return ('Recent events:\n%s\n\n'
                     'Events in progress:\n%s\n\n'
                     'Live sessions:\n%s\n\n'
                     'Postinglist timers:\n%s\n\n'
+                    'Parse cache:\n%s\n\n'
+                    'File descriptor pool:\n%s\n\n'
                     'Threads: (bg delay %.3fs, live=%s, httpd=%s)\n%s\n\n'
                     'Locks:\n%s'
                     ) % (cevents, ievents, sessions,
                          self.result['pl_timers'],
+                         parse_cache, fd_pool,
                          self.result['delay'],
                          self.result['live'],
                          self.result['httpd'],
@@ -1786,6 +1802,8 @@ class ProgramStatus(Command):
                           'userinfo': v.auth} for k, v in
                          mailpile.auth.SESSION_CACHE.iteritems()],
             'pl_timers': mailpile.postinglist.TIMERS,
+            'parse_cache': mailpile.mailutils.GLOBAL_PARSE_CACHE.stats(),
+            'fd_pool': mailpile.mailboxes.fdpool.GLOBAL_FD_POOL.stats(),
             'delay': play_nice_with_threads(sleep=False),
             'live': mailpile.util.LIVE_USER_ACTIVITIES,
             'httpd': mailpile.httpd.LIVE_HTTP_REQUESTS,
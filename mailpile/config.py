@@ -25,6 +25,10 @@ from mailpile.httpd import HttpWorker
 from mailpile.i18n import gettext as _
 from mailpile.i18n import ngettext as _n
 from mailpile.mailboxes import OpenMailbox, NoSuchMailboxError, wervd
+from mailpile.mailboxes import DumpMailboxState, LoadMailboxState
+from mailpile.mailboxes.cache import MailboxCache
+from mailpile.mailboxes.fdpool import GLOBAL_FD_POOL
+from mailpile.mailboxes.store import ContentStore
 from mailpile.mailutils import FormatMbxId, MBX_ID_LEN
 from mailpile.search import MailIndex
 from mailpile.search_history import SearchHistory
@@ -1295,7 +1299,8 @@ class ConfigManager(ConfigDict):
         self.index_check = GLOBAL_INDEX_CHECK
         self.vcards = {}
         self.search_history = SearchHistory()
-        self._mbox_cache = []
+        self._mbox_cache = MailboxCache(max_size=MAX_CACHED_MBOXES)
+        self._content_store = None
         self._running = {}
         self._lock = ConfigRLock()
         self.loaded_config = False
@@ -1530,6 +1535,9 @@ class ConfigManager(ConfigDict):
             self.parse_config(session, '\n'.join(pub_lines), source=self.conf_pub)
             self.parse_config(session, '\n'.join(prv_lines), source=self.conffile)
 
+            # Apply limits which live outside the config object
+            GLOBAL_FD_POOL.set_max_fds(self.sys.fd_cache_size)
+
         ## The following events only happen when we've successfully loaded
         ## both config files!
 
@@ -1770,7 +1778,7 @@ class ConfigManager(ConfigDict):
         except ValueError:
             return False
 
-    def load_pickle(self, pfn):
+    def load_pickle(self, pfn, loads=cPickle.loads):
         with open(os.path.join(self.workdir, pfn), 'rb') as fd:
             if self.master_key:
                 from mailpile.crypto.streamer import DecryptingStreamer
@@ -1778,13 +1786,15 @@ class ConfigManager(ConfigDict):
                                         mep_key=self.master_key,
                                         name='load_pickle'
                                         ) as streamer:
-                    rv = cPickle.loads(streamer.read())
+                    rv = loads(streamer.read())
                     streamer.verify(_raise=IOError)
                     return rv
             else:
-                return cPickle.loads(fd.read())
+                return loads(fd.read())
 
-    def save_pickle(self, obj, pfn, encrypt=True):
+    def save_pickle(self, obj, pfn, encrypt=True, dump=None):
+        if dump is None:
+            dump = lambda o, fd: cPickle.dump(o, fd, protocol=0)
         ppath = os.path.join(self.workdir, pfn)
         if encrypt and self.master_key and self.prefs.encrypt_misc:
             from mailpile.crypto.streamer import EncryptingStreamer
@@ -1792,11 +1802,25 @@ class ConfigManager(ConfigDict):
                                     dir=self.tempfile_dir(),
                                     header_data={'subject': pfn},
                                     name='save_pickle') as fd:
-                cPickle.dump(obj, fd, protocol=0)
+                dump(obj, fd)
                 fd.save(ppath)
         else:
             with open(ppath, 'wb') as fd:
-                cPickle.dump(obj, fd, protocol=0)
+                dump(obj, fd)
+
+    def load_mailbox_state(self, pfn):
+        # This also loads (and so migrates) plain pickles
+        return self.load_pickle(pfn, loads=LoadMailboxState)
+
+    def save_mailbox_state(self, mbox, pfn):
+        # Only write (and encrypt) the state if it has actually changed
+        sio = io.BytesIO()
+        DumpMailboxState(mbox, sio)
+        data = sio.getvalue()
+        digest = md5_hex(data)
+        if self._mbox_cache.digests.get(pfn) != digest:
+            self.save_pickle(data, pfn, dump=lambda d, fd: fd.write(d))
+            self._mbox_cache.digests[pfn] = digest
 
     def _mailbox_info(self, mailbox_id, prefer_local=True):
         try:
@@ -1814,61 +1838,62 @@ class ConfigManager(ConfigDict):
             raise NoSuchMailboxError(_('No such mailbox: %s') % mbx_id)
         return mbx_id, src, FilePath(mfn), pfn
 
-    def save_mailbox(self, session, pfn, mbox):
-        mbox.save(session,
-                  to=pfn, pickler=lambda o, f: self.save_pickle(o, f))
-
-    def uncache_mailbox(self, session, pfn, drop=True, force_save=False):
+    def get_content_store(self):
+        """The store local mailboxes share (deduplicated) messages in."""
         with self._lock:
-            mboxes = [c[2] for c in self._mbox_cache if c[0] == pfn]
-            if len(mboxes) > 0:
-                # At this point, if the mailbox is not in use, there should be
-                # exactly 2 references to it: in mboxes and self._mbox_cache.
-                # However, sys.getrefcount always returns one extra for itself.
-                if sys.getrefcount(mboxes[0]) > 3:
-                    if force_save:
-                        self.save_mailbox(session, pfn, mboxes[0])
-                    return
-
-                # This may be slow, but it has to happen inside the lock
-                # otherwise we run the risk of races.
-                self.save_mailbox(session, pfn, mboxes[0])
-            else:
-                # Not found, nothing to do here
-                return
+            if self._content_store is None and ContentStore.Available():
+                self._content_store = ContentStore(
+                    os.path.join(self.workdir, 'mail', '.store'))
+            return self._content_store
+
+    def _prepare_mailbox(self, mbox):
+        mbox._decryption_key_func = lambda: self.master_key
+        mbox._encryption_key_func = lambda: (self.prefs.encrypt_mail and
+                                             self.master_key)
+        if isinstance(mbox, wervd.MailpileMailbox):
+            mbox.content_store = self.get_content_store()
+            mbox._compression_func = lambda: self.prefs.compress_mail
 
-            if drop:
-                self._mbox_cache = [c for c in self._mbox_cache if c[0] != pfn]
+    def save_mailbox(self, session, pfn, mbox):
+        mbox.save(session, to=pfn, pickler=self.save_mailbox_state)
+
+    def _save_mailboxes(self, session, mailboxes, wait=False):
+        # Saving happens in the save worker, without holding the config
+        # lock; each mailbox holds its own lock while it is being saved.
+        # Cached mailboxes are only marked clean once their save starts,
+        # so changes made while saving (or a failed save) are not lost.
+        def saver(pfn, mbox):
+            def save():
+                self._mbox_cache.mark_clean(pfn, mbox)
+                try:
+                    self.save_mailbox(session, pfn, mbox)
+                except:
+                    self._mbox_cache.mark_dirty(pfn)
+                    raise
+            return save
+        for pfn, mbx_id, mbox in mailboxes:
+            task = saver(pfn, mbox)
+            name = 'Save mailbox {0!s} ({1!s})'.format(mbx_id, pfn)
+            if wait:
+                self.save_worker.do(session, name, task)
             else:
-                keep2 = self._mbox_cache[-MAX_CACHED_MBOXES:]
-                keep1 = [c for c in self._mbox_cache[:-MAX_CACHED_MBOXES]
-                         if c[0] != pfn]
-                self._mbox_cache = keep1 + keep2
+                self.save_worker.add_unique_task(session, name, task)
 
-    def cache_mailbox(self, session, pfn, mbx_id, mbox):
-        with self._lock:
-            self._mbox_cache = [c for c in self._mbox_cache if c[0] != pfn]
-            self._mbox_cache.append((pfn, mbx_id, mbox))
-            flush = [(p[0], p[1])
-                     for p in self._mbox_cache[:-MAX_CACHED_MBOXES]]
-        for pfn, mbx_id in flush:
-            self.save_worker.add_unique_task(
-                session, 'Save mailbox {0!s} (drop={1!s})'.format(mbx_id, False),
-                lambda: self.uncache_mailbox(session, pfn, drop=False))
+    def cache_mailbox(self, session, pfn, mbx_id, mbox, pin=False):
+        self._save_mailboxes(session,
+                             self._mbox_cache.put(pfn, mbx_id, mbox, pin=pin))
+
+    def unpin_mailbox(self, session, mailbox_id, prefer_local=True):
+        """Let a mailbox opened with pin=True be evicted from the cache."""
+        mbx_id, src, mfn, pfn = self._mailbox_info(mailbox_id,
+                                                   prefer_local=prefer_local)
+        self._save_mailboxes(session, self._mbox_cache.unpin(pfn))
 
     def flush_mbox_cache(self, session, clear=True, wait=False):
-        if wait:
-            saver = self.save_worker.do
-        else:
-            saver = self.save_worker.add_task
-        with self._lock:
-            flush = [(p[0], p[1]) for p in self._mbox_cache]
-        for pfn, mbx_id in flush:
-            saver(session,
-                  'Save mailbox {0!s} (drop={1!s})'.format(mbx_id, clear),
-                  lambda: self.uncache_mailbox(session, pfn,
-                                               drop=clear, force_save=True),
-                  unique=True)
+        dirty = self._mbox_cache.get_dirty()
+        if clear:
+            self._mbox_cache.clear()
+        self._save_mailboxes(session, dirty, wait=wait)
 
     def find_mboxids_and_sources_by_path(self, *paths):
         def _au(p):
@@ -1925,19 +1950,21 @@ class ConfigManager(ConfigDict):
         raise ValueError('Not found')
 
     def open_mailbox(self, session, mailbox_id,
-                     prefer_local=True, from_cache=False):
+                     prefer_local=True, from_cache=False, pin=False):
+        """
+        Open a mailbox, from the cache if possible. Mailboxes opened with
+        pin=True stay cached until released with unpin_mailbox().
+        """
         mbx_id, src, mfn, pfn = self._mailbox_info(mailbox_id,
                                                    prefer_local=prefer_local)
-        with self._lock:
-            mbox = dict(((p, m) for p, i, m in self._mbox_cache)
-                        ).get(pfn, None)
+        mbox = self._mbox_cache.get(pfn)
         try:
             if mbox is None:
                 if from_cache:
                     return None
                 if session:
                     session.ui.mark(_('%s: Updating: %s') % (mbx_id, mfn))
-                mbox = self.load_pickle(pfn)
+                mbox = self.load_mailbox_state(pfn)
             if prefer_local and not mbox.is_local:
                 mbox = None
             else:
@@ -1967,12 +1994,10 @@ class ConfigManager(ConfigDict):
             mbox.is_local = prefer_local
 
         # Always set these, they can't be pickled
-        mbox._decryption_key_func = lambda: self.master_key
-        mbox._encryption_key_func = lambda: (self.prefs.encrypt_mail and
-                                             self.master_key)
+        self._prepare_mailbox(mbox)
 
         # Finally, re-add to the cache
-        self.cache_mailbox(session, pfn, mbx_id, mbox)
+        self.cache_mailbox(session, pfn, mbx_id, mbox, pin=pin)
 
         return mbox
 
@@ -1992,9 +2017,7 @@ class ConfigManager(ConfigDict):
                     path = os.path.join(path, os.path.basename(name))
 
             mbx = wervd.MailpileMailbox(path)
-            mbx._decryption_key_func = lambda: self.master_key
-            mbx._encryption_key_func = lambda: (self.prefs.encrypt_mail and
-                                                self.master_key)
+            self._prepare_mailbox(mbx)
             return FilePath(path), mbx
 
     def open_local_mailbox(self, session):
@@ -2306,6 +2329,11 @@ class ConfigManager(ConfigDict):
                 config.slow_worker.wait_until = lambda: (
                     (not config.save_worker) or config.save_worker.is_idle())
                 config.slow_worker.start()
+
+                # Replay popular searches so the caches are warm
+                config.slow_worker.add_unique_task(
+                    config.background, 'warm_search_caches',
+                    lambda: config.search_history.warm_up(config))
             if config.scan_worker == config.dumb_worker:
                 config.scan_worker = Worker('Scan worker', config.background)
                 config.slow_worker.wait_until = lambda: (
@@ -2358,6 +2386,24 @@ class ConfigManager(ConfigDict):
             config.cron_worker.add_task('refresh_command_cache', 5,
                                         refresh_command_cache)
 
+            def content_store_gc():
+                # Only walk the store if a mailbox has let go of something
+                store = config.get_content_store()
+                if store is not None and store.orphaned:
+                    config.slow_worker.add_unique_task(
+                        config.background, 'content_store_gc', store.gc)
+            config.cron_worker.add_task('content_store_gc', 307,
+                                        content_store_gc)
+
+            def msg_size_backfill():
+                if config.index is not None and config.index._unsized:
+                    config.slow_worker.add_unique_task(
+                        config.background, 'backfill_msg_sizes',
+                        lambda: config.index.backfill_msg_sizes(
+                            config.background))
+            config.cron_worker.add_task('backfill_msg_sizes', 613,
+                                        msg_size_backfill)
+
             from mailpile.postinglist import GlobalPostingList
             def optimizer():
                 config.scan_worker.add_unique_task(
@@ -0,0 +1,475 @@
+import ctypes
+import ctypes.util
+import hashlib
+import hmac
+import os
+import struct
+import zlib
+
+from mailpile.i18n import gettext as _
+from mailpile.i18n import ngettext as _n
+from mailpile.util import sha512b64 as genkey
+
+
+#
+# This is an encrypted file format which can be read (and decrypted) in
+# random-access fashion, in-process, without spawning openssl for each
+# file. It is what the WERVD maildir uses for new messages.
+#
+# The file starts with RFC2822-style headers, like the older streamed
+# format, followed by a blank line and then the binary data: the plaintext
+# is split into fixed-size chunks, each encrypted with AES-256-CTR and
+# followed by an HMAC-SHA256 of its index, a last-chunk flag and the
+# ciphertext. The index and flag stop chunks from being reordered or the
+# file from being truncated without us noticing.
+#
+# Optionally (compression: zlib), each chunk is compressed before it is
+# encrypted. Compressed chunks vary in size, so each is then prefixed with
+# its length; we find our way around by hopping from one prefix to the
+# next, which only reads a few bytes per chunk. We only hop as far as we
+# need to, so reading the start of a message stays cheap; the size of the
+# plaintext is only worked out if somebody asks (or seeks from the end).
+# Older versions cannot read compressed files, so compression is off
+# unless the user turns it on.
+#
+# The AES implementation is OpenSSL's libcrypto, via ctypes. If it cannot
+# be loaded, Available() returns False and callers fall back to the
+# streaming openssl coprocess (see mailpile.crypto.streamer).
+#
+
+CHUNKED_MAGIC = 'X-Mailpile-Encrypted-Data: v2'
+CHUNKED_HEADERS = ('From: Mailpile <encrypted@mailpile.is>\n'
+                   'Subject: %(subject)s\n')
+CHUNKED_CIPHER = 'aes-256-ctr'
+CHUNKED_COMPRESSION = 'zlib'
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 16 * 1024 * 1024
+MAC_LEN = 32
+AES_BLOCK = 16
+LENGTH = struct.Struct('>I')
+MAX_READ = 2 ** 62
+
+_LIBCRYPTO = None
+
+
+def _libcrypto():
+    global _LIBCRYPTO
+    if _LIBCRYPTO is None:
+        _LIBCRYPTO = False
+        try:
+            lc = ctypes.CDLL(ctypes.util.find_library('crypto') or
+                             'libcrypto.so')
+            lc.EVP_CIPHER_CTX_new.restype = ctypes.c_void_p
+            lc.EVP_CIPHER_CTX_free.argtypes = [ctypes.c_void_p]
+            lc.EVP_aes_256_ctr.restype = ctypes.c_void_p
+            lc.EVP_EncryptInit_ex.argtypes = [
+                ctypes.c_void_p, ctypes.c_void_p, ctypes.c_void_p,
+                ctypes.c_char_p, ctypes.c_char_p]
+            lc.EVP_EncryptUpdate.argtypes = [
+                ctypes.c_void_p, ctypes.c_void_p,
+                ctypes.POINTER(ctypes.c_int), ctypes.c_char_p, ctypes.c_int]
+            _LIBCRYPTO = lc
+        except (OSError, AttributeError):
+            pass
+    return _LIBCRYPTO
+
+
+def Available():
+    """Returns True if in-process encryption is available."""
+    return bool(_libcrypto())
+
+
+def AesCtr(key, iv, data):
+    """
+    Encrypt (or decrypt, it is the same thing) data using AES-256-CTR.
+
+    >>> key, iv = 'k' * 32, '\\0' * 16
+    >>> AesCtr(key, iv, 'Hello world').encode('hex')
+    '96a42c04eaec3678c29bc0'
+    >>> AesCtr(key, iv, AesCtr(key, iv, 'Hello world'))
+    'Hello world'
+    """
+    lc = _libcrypto()
+    if not lc:
+        raise IOError(_('In-process encryption is unavailable'))
+    if not data:
+        return ''
+    ctx = lc.EVP_CIPHER_CTX_new()
+    if not ctx:
+        raise IOError(_('Failed to initialize cipher'))
+    try:
+        out = ctypes.create_string_buffer(len(data) + AES_BLOCK)
+        outl = ctypes.c_int(0)
+        if (lc.EVP_EncryptInit_ex(ctx, lc.EVP_aes_256_ctr(), None,
+                                  key, iv) != 1 or
+                lc.EVP_EncryptUpdate(ctx, out, ctypes.byref(outl),
+                                     data, len(data)) != 1):
+            raise IOError(_('Encryption failed'))
+        return out.raw[:outl.value]
+    finally:
+        lc.EVP_CIPHER_CTX_free(ctx)
+
+
+def _derive_keys(mep_key, nonce):
+    # Same key mutation as the streamed format, then separate keys for
+    # the cipher and the MACs.
+    mutated = genkey(mep_key or '', nonce)[:32].strip()
+    return (hmac.new(mutated, 'encrypt', hashlib.sha256).digest(),
+            hmac.new(mutated, 'authenticate', hashlib.sha256).digest())
+
+
+def _chunk_iv(index, chunk_size, compressed=False):
+    # The key is unique to the file, so the counter just has to be unique
+    # within it: each chunk starts where the previous one ended. Compressed
+    # chunks may end up larger than chunk_size, so they get a counter
+    # space of their own.
+    if compressed:
+        return struct.pack('>QQ', index + 1, 0)
+    return struct.pack('>QQ', 0, index * (chunk_size // AES_BLOCK))
+
+
+def _chunk_mac(mac_key, index, last, ciphertext):
+    return hmac.new(mac_key, struct.pack('>QB', index, bool(last)) +
+                    ciphertext, hashlib.sha256).digest()
+
+
+class ChunkedEncryptingWriter(object):
+    """
+    Encrypts (and optionally compresses) data written to it, in chunks,
+    writing the result to fd. The md5sum of everything written is
+    available once closed, as outer_md5sum.
+    """
+    def __init__(self, fd, mep_key, chunk_size=DEFAULT_CHUNK_SIZE,
+                 header_data=None, compress=False):
+        assert(chunk_size % AES_BLOCK == 0)
+        self.fd = fd
+        self.chunk_size = chunk_size
+        self.compress = compress
+        self.nonce = os.urandom(16).encode('hex')
+        self.enc_key, self.mac_key = _derive_keys(mep_key, self.nonce)
+        self.outer_md5 = hashlib.md5()
+        self.outer_md5sum = None
+        self.buffered = []
+        self.buffered_bytes = 0
+        self.index = 0
+        self._write_out(''.join([
+            CHUNKED_MAGIC, '\n',
+            CHUNKED_HEADERS % (header_data or
+                               {'subject': 'Mailpile encrypted data'}),
+            'cipher: {0!s}\n'.format(CHUNKED_CIPHER),
+            'nonce: {0!s}\n'.format(self.nonce),
+            'chunk-size: {0:d}\n'.format(chunk_size),
+            ('compression: {0!s}\n'.format(CHUNKED_COMPRESSION)
+             if compress else ''),
+            '\n']))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _write_out(self, data):
+        self.outer_md5.update(data)
+        self.fd.write(data)
+
+    def _write_chunk(self, data, last):
+        if self.compress:
+            data = zlib.compress(data)
+        ciphertext = AesCtr(self.enc_key,
+                            _chunk_iv(self.index, self.chunk_size,
+                                      self.compress), data)
+        if self.compress:
+            self._write_out(LENGTH.pack(len(ciphertext)))
+        self._write_out(ciphertext)
+        self._write_out(_chunk_mac(self.mac_key, self.index, last,
+                                   ciphertext))
+        self.index += 1
+
+    def write(self, data):
+        self.buffered.append(data)
+        self.buffered_bytes += len(data)
+        # Note: We always keep at least one byte back, as we do not know
+        #       which chunk is the last one until close() is called.
+        if self.buffered_bytes > self.chunk_size:
+            data = ''.join(self.buffered)
+            cut = ((len(data) - 1) // self.chunk_size) * self.chunk_size
+            for pos in range(0, cut, self.chunk_size):
+                self._write_chunk(data[pos:pos + self.chunk_size], False)
+            self.buffered = [data[cut:]]
+            self.buffered_bytes = len(data) - cut
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.outer_md5sum is None:
+            self._write_chunk(''.join(self.buffered), True)
+            self.buffered = []
+            self.outer_md5sum = self.outer_md5.hexdigest()
+            self.fd.flush()
+
+
+class ChunkedDecryptingReader(object):
+    """
+    A seekable, read-only file-like object which decrypts the data in a
+    chunked encrypted file. Only the chunks which are actually read get
+    decrypted; the most recent one is kept around for sequential reads.
+
+    >>> from StringIO import StringIO
+    >>> data = ''.join('Line %d\\n' % i for i in range(100))
+    >>> sio = StringIO()
+    >>> with ChunkedEncryptingWriter(sio, 'secret', chunk_size=64) as w:
+    ...     w.write(data)
+    >>> r = ChunkedDecryptingReader.Open(StringIO(sio.getvalue()), 'secret')
+    >>> r.readline(), r.seek(-8, 2), r.read()
+    ('Line 0\\n', None, 'Line 99\\n')
+    >>> r.seek(0); r.read() == data, r.size
+    (True, 790)
+    >>> ChunkedDecryptingReader.Open(StringIO(data), 'secret') is None
+    True
+    >>> bad = StringIO(sio.getvalue()[:-MAC_LEN - 64])
+    >>> ChunkedDecryptingReader.Open(bad, 'secret').read()
+    Traceback (most recent call last):
+        ...
+    IOError: Encrypted data is corrupt or has been tampered with
+    >>> headers_only = sio.getvalue().split('\\n\\n', 1)[0] + '\\n\\n'
+    >>> ChunkedDecryptingReader.Open(StringIO(headers_only), 'secret')
+    Traceback (most recent call last):
+        ...
+    IOError: Encrypted data is corrupt or has been tampered with
+
+    Compressed files work the same way, but take up less space:
+
+    >>> szio = StringIO()
+    >>> with ChunkedEncryptingWriter(szio, 'secret', chunk_size=256,
+    ...                              compress=True) as w:
+    ...     w.write(data)
+    >>> len(szio.getvalue()) < len(sio.getvalue()) // 2
+    True
+    >>> r = ChunkedDecryptingReader.Open(StringIO(szio.getvalue()), 'secret')
+    >>> r.readline(), len(r._records), r._size
+    ('Line 0\\n', 2, None)
+    >>> r.seek(-16, 2); r.readlines(), r.size, r.chunks
+    (['Line 98\\n', 'Line 99\\n'], 790, 4)
+    """
+    @classmethod
+    def Open(cls, fd, mep_key):
+        """
+        Returns a reader for fd, or None if fd is not in the chunked
+        format (in which case fd is rewound).
+        """
+        start = fd.tell()
+        if fd.readline().rstrip('\r\n') != CHUNKED_MAGIC:
+            fd.seek(start, 0)
+            return None
+        headers = {}
+        while True:
+            line = fd.readline().rstrip('\r\n')
+            if not line:
+                break
+            if ': ' in line:
+                hdr, val = line.split(': ', 1)
+                headers[hdr.lower()] = val
+        return cls(fd, mep_key, headers, fd.tell())
+
+    def __init__(self, fd, mep_key, headers, data_start):
+        if headers.get('cipher') != CHUNKED_CIPHER:
+            raise IOError(_('Unsupported cipher: %s')
+                          % headers.get('cipher'))
+        try:
+            self.chunk_size = int(headers['chunk-size'])
+            nonce = headers['nonce']
+        except (KeyError, ValueError):
+            raise IOError(_('Invalid encrypted data header'))
+        if not (0 < self.chunk_size <= MAX_CHUNK_SIZE and
+                self.chunk_size % AES_BLOCK == 0):
+            raise IOError(_('Invalid encrypted data header'))
+        compression = headers.get('compression')
+        if compression not in (None, CHUNKED_COMPRESSION):
+            raise IOError(_('Unsupported compression: %s') % compression)
+        self.compressed = bool(compression)
+
+        self.fd = fd
+        self.name = getattr(fd, 'name', None)
+        self.closed = False
+        self.enc_key, self.mac_key = _derive_keys(mep_key, nonce)
+        self.data_start = data_start
+
+        self._pos = 0
+        self._chunk = (None, '')
+
+        fd.seek(0, 2)
+        self._stored = fd.tell() - data_start
+        self._records = []
+        self._chunks = self._size = None
+        if not self.compressed:
+            # Calculate the size of the plaintext without reading anything
+            full = self.chunk_size + MAC_LEN
+            self._chunks = (self._stored + full - 1) // full
+            self._size = max(0, self._stored - self._chunks * MAC_LEN)
+
+        # There is always at least one (final) chunk, even for empty files
+        if not self._has_chunk(0):
+            raise self._corrupt()
+
+    chunks = property(lambda self: self._get_chunks())
+    size = property(lambda self: self._get_size())
+
+    def _get_chunks(self):
+        if self._chunks is None:
+            while self._find_record():
+                pass
+            self._chunks = len(self._records)
+        return self._chunks
+
+    def _get_size(self):
+        if self._size is None:
+            # We only know how big the last compressed chunk is once we
+            # have decompressed it.
+            last = self.chunks - 1
+            self._size = last * self.chunk_size + len(self._get_chunk(last))
+        return self._size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def close(self):
+        self.closed = True
+        self._chunk = (None, '')
+        self.fd.close()
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            self._pos += offset
+        elif whence == 2:
+            self._pos = self.size + offset
+        else:
+            self._pos = offset
+        self._pos = max(0, self._pos)
+
+    def _corrupt(self):
+        return IOError(_('Encrypted data is corrupt or has been '
+                         'tampered with'))
+
+    def _find_record(self):
+        # Finds the (offset, length) of the next compressed chunk, if any
+        if self._records:
+            offset, length = self._records[-1]
+            pos = offset + length - self.data_start
+        else:
+            pos = 0
+        if pos >= self._stored:
+            if pos != self._stored:
+                raise self._corrupt()
+            return False
+        self.fd.seek(self.data_start + pos, 0)
+        prefix = self.fd.read(LENGTH.size)
+        if len(prefix) < LENGTH.size:
+            raise self._corrupt()
+        length = LENGTH.unpack(prefix)[0] + MAC_LEN
+        self._records.append((self.data_start + pos + LENGTH.size, length))
+        return True
+
+    def _has_chunk(self, index):
+        if self._chunks is not None:
+            return index < self._chunks
+        while len(self._records) <= index:
+            if not self._find_record():
+                self._chunks = len(self._records)
+                return False
+        return True
+
+    def _get_chunk(self, index):
+        if self._chunk[0] == index:
+            return self._chunk[1]
+        if self.compressed:
+            offset, length = self._records[index]
+        else:
+            length = self.chunk_size + MAC_LEN
+            offset = self.data_start + index * length
+        self.fd.seek(offset, 0)
+        data = self.fd.read(length)
+        last = not self._has_chunk(index + 1)
+        ciphertext, mac = data[:-MAC_LEN], data[-MAC_LEN:]
+        if (len(data) < MAC_LEN or
+                (len(ciphertext) != self.chunk_size and not last and
+                 not self.compressed) or
+                not hmac.compare_digest(
+                    mac, _chunk_mac(self.mac_key, index, last, ciphertext))):
+            raise self._corrupt()
+        plaintext = AesCtr(self.enc_key,
+                           _chunk_iv(index, self.chunk_size, self.compressed),
+                           ciphertext)
+        if self.compressed:
+            try:
+                plaintext = zlib.decompress(plaintext)
+            except zlib.error:
+                raise self._corrupt()
+            if len(plaintext) != self.chunk_size and not last:
+                raise self._corrupt()
+        self._chunk = (index, plaintext)
+        return plaintext
+
+    def _read_some(self, size):
+        # Read up to size bytes, without crossing a chunk boundary
+        index, offset = divmod(self._pos, self.chunk_size)
+        if size <= 0 or not self._has_chunk(index):
+            return ''
+        data = self._get_chunk(index)[offset:offset + size]
+        self._pos += len(data)
+        return data
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = MAX_READ
+        data = []
+        while size > 0:
+            chunk = self._read_some(size)
+            if not chunk:
+                break
+            data.append(chunk)
+            size -= len(chunk)
+        return ''.join(data)
+
+    def readline(self, size=-1):
+        if size is None or size < 0:
+            size = MAX_READ
+        line = []
+        while size > 0:
+            start = self._pos
+            chunk = self._read_some(size)
+            if not chunk:
+                break
+            nl = chunk.find('\n')
+            if nl >= 0:
+                chunk = chunk[:nl + 1]
+                self._pos = start + nl + 1
+            line.append(chunk)
+            size -= len(chunk)
+            if nl >= 0:
+                break
+        return ''.join(line)
+
+    def readlines(self, sizehint=None):
+        return list(self)
+
+
+if __name__ == "__main__":
+    import doctest
+    import sys
+    results = doctest.testmod(optionflags=doctest.ELLIPSIS,
+                              extraglobs={})
+    print '{0!s}'.format(results)
+    if results.failed:
+        sys.exit(1)
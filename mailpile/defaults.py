@@ -40,6 +40,10 @@ CONFIG_RULES = {
         'postinglist_kb': (_('Posting list target size in KB'), int,       64),
         'sort_max':       (_('Max results we sort "well"'), int,         2500),
         'snippet_max':    (_('Max length of metadata snippets'), int,     250),
+        'ingest_processes': (_('Processes parsing mail (0=off)'), int,     0),
+        'html_max_bytes': (_('Max HTML bytes to index per part'), int, 524288),
+        'index_max_terms': (_('Max distinct words to index per message'),
+                            int, 5000),
         'debug':         p(_('Debugging flags'), str,                      ''),
         'experiments':    (_('Enabled experiments'), str,                  ''),
         'gpg_keyserver':  (_('Host:port of PGP keyserver'),
@@ -97,6 +101,7 @@ CONFIG_RULES = {
         'index_encrypted':X(_('Make encrypted content searchable'),
                             bool, False),
         'encrypt_mail':   X(_('Encrypt locally stored mail'), bool,      True),
+        'compress_mail':  X(_('Compress locally stored mail'), bool,     False),
         'encrypt_index':  X(_('Encrypt the local search index'), bool,  False),
         'encrypt_vcards': X(_('Encrypt the contact database'), bool,     True),
         'encrypt_events': X(_('Encrypt the event log'), bool,            True),
@@ -0,0 +1,122 @@
+import re
+from htmlentitydefs import name2codepoint
+
+
+#
+# This is a fast, forgiving HTML-to-text converter for the indexer. Unlike
+# lxml it never builds a DOM: it makes a single pass over the markup with
+# a few regular expressions, dropping tags, comments, scripts and styles
+# and decoding entities as it goes. Only the first max_bytes of the HTML
+# are looked at, so huge (or hostile) HTML parts cost a bounded amount of
+# time and memory.
+#
+# The output is only meant for searching and snippets; for displaying
+# messages to the user, see Email._extract_text_from_html and friends.
+#
+
+# Note: Attributes may not contain a '<', so a tag which is never closed
+#       only costs us a scan up to the next '<' (not to the end of the
+#       data, which made hostile input like '<a <a <a ...' quadratic).
+HTML_TAG_RE = re.compile(r'<(?:(/?)([a-zA-Z][a-zA-Z0-9]*)(?:\s[^<>]*)?/?>'
+                         r'|!--.*?(?:-->|$)'
+                         r'|[!?][^<>]*>)', re.DOTALL)
+
+HTML_ENTITY_RE = re.compile(r'&(#[xX][0-9a-fA-F]{1,6}|#[0-9]{1,7}'
+                            r'|[a-zA-Z][a-zA-Z0-9]{1,31});')
+
+# The contents of these are not text
+HTML_SKIP_TAGS = ('script', 'style', 'head', 'title', 'object', 'template')
+
+# These imply a line break
+HTML_BLOCK_TAGS = ('address', 'article', 'aside', 'blockquote', 'br', 'dd',
+                   'div', 'dl', 'dt', 'footer', 'form', 'h1', 'h2', 'h3',
+                   'h4', 'h5', 'h6', 'header', 'hr', 'li', 'ol', 'p', 'pre',
+                   'section', 'table', 'td', 'th', 'tr', 'ul')
+
+
+def _entity(m):
+    ent = m.group(1)
+    try:
+        if ent[:2] in ('#x', '#X'):
+            return unichr(int(ent[2:], 16))
+        elif ent[:1] == '#':
+            return unichr(int(ent[1:]))
+        elif ent in name2codepoint:
+            return unichr(name2codepoint[ent])
+    except (ValueError, OverflowError):
+        pass
+    return m.group(0)
+
+
+def UnescapeEntities(text):
+    """
+    Decode HTML character references.
+
+    >>> UnescapeEntities(u'Fish &amp; chips &#8364;5 &#x41; &bogus;')
+    u'Fish & chips \\u20ac5 A &bogus;'
+    """
+    if '&' not in text:
+        return text
+    return re.sub(HTML_ENTITY_RE, _entity, text)
+
+
+def HtmlToText(html, max_bytes=None):
+    """
+    Extract the text from an HTML document.
+
+    >>> HtmlToText(u'<html><head><title>T</title><style>p {}</style></head>'
+    ...            u'<body><p>Hello <b>world</b>!</p><!-- no -->Bye&nbsp;now'
+    ...            u'<script>alert(1);</script></body></html>')
+    u'\\nHello world!\\nBye\\xa0now'
+    >>> HtmlToText(u'Plain &lt;text&gt;')
+    u'Plain <text>'
+    >>> HtmlToText(u'<p>abcdefghij</p>', max_bytes=8)
+    u'\\nabcde'
+
+    Unclosed tags are text, and cost linear time:
+
+    >>> import time
+    >>> t0 = time.time(); html = HtmlToText(u'<a ' * 200000 + u'<b>x')
+    >>> html[-7:], time.time() - t0 < 5
+    (u'<a <a x', True)
+    """
+    if max_bytes and len(html) > max_bytes:
+        html = html[:max_bytes]
+
+    # Fast path: no markup at all
+    if '<' not in html:
+        return UnescapeEntities(html)
+
+    text, lower = [], None
+    pos, end = 0, len(html)
+    while pos < end:
+        m = HTML_TAG_RE.search(html, pos)
+        if not m:
+            text.append(html[pos:])
+            break
+
+        text.append(html[pos:m.start()])
+        pos = m.end()
+
+        closing, tag = m.group(1), (m.group(2) or '').lower()
+        if not tag:
+            continue  # Comment, doctype or processing instruction
+        elif tag in HTML_SKIP_TAGS and not closing:
+            # Jump straight to the closing tag (or the end of the data)
+            lower = lower or html.lower()
+            close = lower.find('</' + tag, pos)
+            pos = end if (close < 0) else close
+        elif tag in HTML_BLOCK_TAGS:
+            text.append('\n')
+
+    return UnescapeEntities(''.join(text))
+
+
+if __name__ == '__main__':
+    import doctest
+    import sys
+    results = doctest.testmod(optionflags=doctest.ELLIPSIS,
+                              extraglobs={})
+    print '{0!s}'.format(results)
+    if results.failed:
+        sys.exit(1)
@@ -0,0 +1,286 @@
+import cPickle
+import cStringIO
+import os
+import re
+import sys
+import threading
+import traceback
+from collections import deque
+from Queue import Queue, Empty
+
+import mailpile.util
+from mailpile.i18n import gettext as _
+from mailpile.i18n import ngettext as _n
+from mailpile.mailutils import ParseHeaders, ParseMessage
+from mailpile.plugins import PluginManager
+from mailpile.safe_popen import Popen, PIPE
+from mailpile.util import *
+
+
+##[ Multi-process message parsing ]###########################################
+#
+# Parsing messages (MIME, HTML-to-text, tokenizing, keyword extractors) is
+# CPU bound and holds the GIL, so big imports only ever use one core. The
+# IngestPool farms that work out to worker processes. The workers only
+# read message bodies; the parent still parses headers, assigns MIDs, adds
+# the keywords which depend on the index (dates, tags...) and writes to
+# the index, in the order the messages were submitted.
+#
+# The workers are freshly started Python interpreters, not forks of this
+# busy, threaded process: they inherit no locks, caches or index, and
+# share nothing with us but two pipes. They are sent raw message bytes
+# and send back (keywords, body_info) - no Message objects. Anything
+# involving GnuPG is left to the parent, and if a worker dies or stops
+# answering, the parent gives up on the pool and parses in-process.
+#
+
+# Messages which may need GnuPG are parsed by the parent
+CRYPTO_RE = re.compile(r'pgp|-----BEGIN ', re.IGNORECASE)
+
+# The parent only needs the headers, which end at the first blank line
+HEADER_END_RE = re.compile(r'\r?\n\r?\n')
+
+WORKER_COMMAND = 'import mailpile.ingest; mailpile.ingest._worker_main()'
+
+
+class IngestedMessage(object):
+    """The result of reading one message in an ingestion worker."""
+
+    def __init__(self, msg_ptr, msg_bytes, msg_headers, keywords, body_info):
+        self.msg_ptr = msg_ptr
+        self.msg_bytes = msg_bytes
+        self.msg_headers = msg_headers
+        self.keywords = keywords
+        self.body_info = body_info
+
+    def message(self):
+        """The message headers, as a payload-less Message."""
+        return ParseHeaders(self.msg_headers)
+
+
+def _worker_read(index, settings, msg_data):
+    try:
+        msg = ParseMessage(cStringIO.StringIO(msg_data), pgpmime=False)
+        keywords, body_info = index._read_message_content(
+            None, msg, settings['html_max_bytes'], settings['max_terms'])
+        if keywords is None:
+            return None
+        return keywords, body_info
+    except:
+        # Returning None makes the parent read this one itself, which
+        # takes care of error reporting.
+        if settings['debug']:
+            traceback.print_exc()
+        return None
+
+
+def _worker_main():
+    """Read (msg_ptr, bytes) jobs on stdin, pickle the results to stdout."""
+    if os.name == 'nt':
+        import msvcrt
+        msvcrt.setmode(0, os.O_BINARY)
+        msvcrt.setmode(1, os.O_BINARY)
+
+    # Plugins or libraries printing things must not corrupt our results
+    jobs = sys.stdin
+    results = os.fdopen(os.dup(1), 'wb')
+    os.dup2(2, 1)
+    sys.stdout = sys.stderr
+
+    # Load the same keyword extractors as the parent, and only those.
+    settings = cPickle.load(jobs)
+    for module in settings['modules']:
+        __import__(module)
+    for registered, wanted in (
+            (PluginManager.TEXT_KW_EXTRACTORS, settings['text']),
+            (PluginManager.DATA_KW_EXTRACTORS, settings['data'])):
+        for term in registered.keys():
+            if term not in wanted:
+                del registered[term]
+        if len(registered) != len(wanted):
+            sys.stderr.write('Ingest worker: missing keyword extractors\n')
+            return
+
+    # Reading message contents uses no index state, so an empty index
+    # will do.
+    from mailpile.search import MailIndex
+    index = MailIndex.__new__(MailIndex)
+
+    while True:
+        try:
+            msg_ptr, msg_data = cPickle.load(jobs)
+        except EOFError:
+            break
+        cPickle.dump(_worker_read(index, settings, msg_data), results,
+                     cPickle.HIGHEST_PROTOCOL)
+        results.flush()
+
+
+class _IngestWorker(object):
+    DEAD = 'dead'
+
+    def __init__(self, settings):
+        # Make sure the worker imports the same mailpile as we did
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))] +
+            [p for p in [env.get('PYTHONPATH')] if p])
+
+        self.proc = Popen([sys.executable, '-c', WORKER_COMMAND],
+                          stdin=PIPE, stdout=PIPE, env=env,
+                          long_running=True)
+        self.outstanding = 0
+        self.jobs = Queue()
+        self.results = Queue()
+        self.threads = [threading.Thread(target=t)
+                        for t in (self._writer, self._reader)]
+        for t in self.threads:
+            t.daemon = True
+            t.start()
+        self.send(settings)
+
+    def _writer(self):
+        # Writes go via a thread, so a stuck worker cannot block us
+        try:
+            while True:
+                job = self.jobs.get()
+                if job is None:
+                    break
+                cPickle.dump(job, self.proc.stdin, cPickle.HIGHEST_PROTOCOL)
+                self.proc.stdin.flush()
+        except (IOError, OSError, ValueError):
+            pass
+        finally:
+            try:
+                self.proc.stdin.close()
+            except (IOError, OSError):
+                pass
+
+    def _reader(self):
+        try:
+            while True:
+                self.results.put(cPickle.load(self.proc.stdout))
+        except:
+            self.results.put(self.DEAD)
+
+    def send(self, job):
+        self.jobs.put(job)
+
+    def stop(self):
+        self.jobs.put(None)
+        try:
+            self.proc.kill()
+            self.proc.wait()
+        except OSError:
+            pass
+
+
+class IngestPool(object):
+    """
+    A pool of processes reading messages for the indexer.
+
+    Messages are submitted in the order they should be indexed, and
+    collect() hands back the results in that same order. At most `window`
+    messages are in flight at once; callers should stop reading mail
+    and collect(wait=True) whenever the pool is full().
+
+    The worker processes are only started once there is something to
+    parse. A result of None means the caller should parse the message
+    itself; if the workers stop responding (or cannot be started), that
+    is what happens for everything.
+    """
+    TIMEOUT = 60  # Seconds to wait for a single message
+
+    def __init__(self, session, processes, window=None):
+        self.session = session
+        self.processes = processes
+        self.window = window or (4 * processes)
+        self.pending = deque()
+        self.workers = None
+        self.broken = getattr(sys, 'frozen', False) or not sys.executable
+
+    def _settings(self):
+        text = PluginManager.TEXT_KW_EXTRACTORS
+        data = PluginManager.DATA_KW_EXTRACTORS
+        return {
+            'html_max_bytes': self.session.config.sys.html_max_bytes,
+            'max_terms': self.session.config.sys.index_max_terms,
+            'debug': self.session.config.sys.debug,
+            'modules': sorted(set(f.__module__ for f in
+                                  text.values() + data.values())),
+            'text': text.keys(),
+            'data': data.keys()}
+
+    def _get_workers(self):
+        if self.workers is None and not self.broken:
+            self.workers = []
+            try:
+                settings = self._settings()
+                for i in range(0, self.processes):
+                    self.workers.append(_IngestWorker(settings))
+            except (OSError, IOError, ValueError):
+                if self.session.config.sys.debug:
+                    traceback.print_exc()
+                self._give_up()
+        return self.workers
+
+    def _give_up(self):
+        # Everything still pending gets parsed by the caller instead
+        self.broken = True
+        self.pending = deque((c, p, None, None, 0)
+                             for c, p, w, h, s in self.pending)
+        self._stop()
+
+    def submit(self, context, msg_ptr, msg_data):
+        worker = headers = None
+        if msg_data is not None and not CRYPTO_RE.search(msg_data):
+            workers = self._get_workers()
+            if workers:
+                worker = min(workers, key=lambda w: w.outstanding)
+                worker.outstanding += 1
+                worker.send((msg_ptr, msg_data))
+                end = HEADER_END_RE.search(msg_data)
+                headers = msg_data[:end.end()] if end else msg_data
+        self.pending.append((context, msg_ptr, worker, headers,
+                             len(msg_data or '')))
+
+    def full(self):
+        return len(self.pending) >= self.window
+
+    def collect(self, wait=False):
+        """
+        Return (context, msg_ptr, IngestedMessage or None) tuples for the
+        messages at the head of the queue which are done. If wait is set,
+        wait for the first one; if wait is 'all', wait for all of them.
+        """
+        done = []
+        while self.pending:
+            context, msg_ptr, worker, headers, size = self.pending[0]
+            result = None
+            if worker is not None:
+                # Each worker answers in order, so its next result is ours
+                if worker.results.empty():
+                    if not (wait == 'all' or (wait and not done)):
+                        break
+                try:
+                    result = worker.results.get(timeout=self.TIMEOUT)
+                except Empty:
+                    result = worker.DEAD
+                if result is worker.DEAD:
+                    self._give_up()
+                    continue
+                worker.outstanding -= 1
+            self.pending.popleft()
+            if result is not None:
+                result = IngestedMessage(msg_ptr, size, headers, *result)
+            done.append((context, msg_ptr, result))
+        return done
+
+    def _stop(self):
+        for worker in (self.workers or []):
+            worker.stop()
+        self.workers = None
+
+    def close(self):
+        self.pending.clear()
+        self._stop()
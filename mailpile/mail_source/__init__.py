@@ -269,7 +269,8 @@ class BaseMailSource(threading.Thread):
                         all_completed = False
                         break
                     count = self.rescan_mailbox(mbx_key, mbx_cfg, path,
-                                                stop_after=this_batch)
+                                                stop_after=this_batch,
+                                                changes=state.get('changes'))
 
                     if count >= 0:
                         self.event.data['counters'
@@ -712,9 +713,11 @@ class BaseMailSource(threading.Thread):
         }
         scan_args = scan_args or {}
         count = 0
+        loc = None
         try:
             with self._lock:
-                loc = config.open_mailbox(session, mbx_key, prefer_local=True)
+                loc = config.open_mailbox(session, mbx_key, prefer_local=True,
+                                          pin=True)
             if src == loc:
                 return count
 
@@ -786,9 +789,12 @@ class BaseMailSource(threading.Thread):
             raise
         finally:
             progress['running'] = False
+            if loc is not None:
+                config.unpin_mailbox(session, mbx_key, prefer_local=True)
         return count
 
-    def rescan_mailbox(self, mbx_key, mbx_cfg, path, stop_after=None):
+    def rescan_mailbox(self, mbx_key, mbx_cfg, path, stop_after=None,
+                       changes=None):
         session, config = self.session, self.session.config
 
         with self._lock:
@@ -799,6 +805,7 @@ class BaseMailSource(threading.Thread):
         mailboxes = min(1, len([m for m in self.my_config.mailbox.values()
                                 if self._policy(m) not in ('ignore',
                                                            'unknown')]))
+        mbox = None
         try:
             ostate, self._state = self._state, 'Rescan({0!s}, {1!s})'.format(mbx_key,
                                                                    stop_after)
@@ -820,7 +827,7 @@ class BaseMailSource(threading.Thread):
 
             with self._lock:
                 mbox = config.open_mailbox(session, mbx_key,
-                                           prefer_local=False)
+                                           prefer_local=False, pin=True)
             def process_new(msg, msg_metadata_kws, msg_ts, keywords, snippet):
                 return self._process_new(mbx_key, mbx_cfg, mbox,
                                          msg, msg_metadata_kws, msg_ts,
@@ -858,6 +865,12 @@ class BaseMailSource(threading.Thread):
             if 'rescans' in self.event.data:
                 self.event.data['rescans'][:-mailboxes] = []
 
+            # A set of changed keys only makes sense for the mailbox it
+            # came from, not the local copy.
+            if changes is not None and not (
+                    mbx_cfg.local or self.my_config.discovery.local_copy):
+                scan_mailbox_args['changes'] = changes
+
             return count + config.index.scan_mailbox(session,
                                                      mbx_key,
                                                      mbx_cfg.local or path,
@@ -869,6 +882,8 @@ class BaseMailSource(threading.Thread):
         finally:
             self._state = ostate
             self._rescanning = False
+            if mbox is not None:
+                config.unpin_mailbox(session, mbx_key, prefer_local=False)
 
     def open_mailbox(self, mbx_id, fn):
         # This allows mail sources to override the default mailbox
@@ -0,0 +1,349 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import threading
+
+import mailpile.util
+from mailpile.util import MboxRLock
+
+
+#
+# This is a minimal inotify(7) binding (using ctypes, so no extra
+# dependencies) which watches local mailboxes for changes. Maildirs are
+# watched one message at a time, so we know exactly which keys came and
+# went; mbox files just get flagged as changed.
+#
+# If inotify is not available (not Linux, or we have run out of watches),
+# everything degrades to the old behaviour of polling mtimes and sizes.
+#
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_UNMOUNT = 0x00002000
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o0004000
+
+MAILDIR_MASK = (IN_CREATE | IN_MOVED_TO | IN_MOVED_FROM | IN_DELETE |
+                IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+MBOX_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_ATTRIB |
+             IN_DELETE_SELF | IN_MOVE_SELF)
+GONE_MASK = (IN_DELETE_SELF | IN_MOVE_SELF | IN_UNMOUNT | IN_IGNORED)
+
+EVENT_HEADER = struct.Struct('iIII')
+
+# Past this many pending changes, we just ask for a full rescan instead.
+MAX_CHANGES = 10000
+
+_LIBC = None
+
+
+def _libc():
+    global _LIBC
+    if _LIBC is None:
+        _LIBC = False
+        if sys.platform.startswith('linux'):
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library('c') or
+                                   'libc.so.6', use_errno=True)
+                libc.inotify_init1
+                libc.inotify_add_watch
+                libc.inotify_rm_watch
+                _LIBC = libc
+            except (OSError, AttributeError):
+                pass
+    return _LIBC
+
+
+def Available():
+    """Returns True if inotify can be used on this system."""
+    return bool(_libc())
+
+
+def MaildirKey(filename, colon=':'):
+    """
+    Convert a Maildir file name into a mailbox key, or None if the file
+    is not a message.
+
+    >>> MaildirKey('1234.M5P6.host:2,RS')
+    '1234.M5P6.host'
+    >>> MaildirKey('1234.M5P6.host!2,S', colon='!')
+    '1234.M5P6.host'
+    >>> MaildirKey('.hidden') is None
+    True
+    """
+    if not filename or filename.startswith('.'):
+        return None
+    return filename.split(colon)[0]
+
+
+class MailboxChanges(object):
+    """
+    The changes seen in a single mailbox since it was last rescanned.
+    If rescan is set, the added and removed sets are incomplete (or
+    meaningless, for mbox files) and the whole mailbox must be checked.
+
+    >>> mc = MailboxChanges()
+    >>> mc.add('a'); mc.remove('b'); bool(mc)
+    True
+    >>> mc.discard(mc.copy()); bool(mc)
+    False
+    """
+    def __init__(self, added=None, removed=None, rescan=False):
+        self.added = set(added or [])
+        self.removed = set(removed or [])
+        self.rescan = rescan
+
+    def __nonzero__(self):
+        return bool(self.rescan or self.added or self.removed)
+
+    def __repr__(self):
+        return '<MailboxChanges(+{0!s} -{1!s}{2!s})>'.format(
+            len(self.added), len(self.removed),
+            self.rescan and ' rescan' or '')
+
+    def copy(self):
+        return MailboxChanges(self.added, self.removed, self.rescan)
+
+    def add(self, key):
+        self.added.add(key)
+        self._check_size()
+
+    def remove(self, key):
+        self.removed.add(key)
+        self._check_size()
+
+    def _check_size(self):
+        if len(self.added) + len(self.removed) > MAX_CHANGES:
+            self.want_rescan()
+
+    def want_rescan(self):
+        self.added, self.removed, self.rescan = set(), set(), True
+
+    def discard(self, changes):
+        """Forget changes which have been dealt with."""
+        self.added -= changes.added
+        self.removed -= changes.removed
+        if changes.rescan:
+            self.rescan = False
+
+
+class InotifyWatcher(threading.Thread):
+    """
+    A background thread which watches local mailboxes using inotify and
+    keeps track of what has changed in each of them. The callback (if any)
+    is invoked with the mailbox key whenever something happens.
+    """
+    POLL_TIMEOUT = 1  # Seconds; how often we check if we should quit
+    READ_SIZE = 64 * 1024
+
+    def __init__(self, callback=None, name='Inotify watcher'):
+        threading.Thread.__init__(self)
+        self.name = name
+        self.daemon = True
+        self.callback = callback
+        self.alive = False
+        self._lock = MboxRLock()
+        self._wds = {}       # wd -> (mailbox key, is_maildir, colon)
+        self._watched = {}   # mailbox key -> (path, [wd, ...])
+        self._changes = {}   # mailbox key -> MailboxChanges
+        self._fd = _libc().inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def _add_watch(self, path, mask):
+        wd = _libc().inotify_add_watch(self._fd, path, mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return wd
+
+    def is_watching(self, mbx_key, path=None):
+        with self._lock:
+            watched = self._watched.get(mbx_key)
+            return (watched is not None and
+                    (path is None or watched[0] == path))
+
+    def watch(self, mbx_key, path, colon=':'):
+        """
+        Start watching a mailbox. Returns True on success, False if the
+        mailbox cannot be watched (the caller should poll it instead).
+        """
+        with self._lock:
+            if self.is_watching(mbx_key, path):
+                return True
+            self.unwatch(mbx_key)
+
+            wds = []
+            try:
+                if os.path.isdir(path):
+                    subdirs = [os.path.join(path, s) for s in ('new', 'cur')]
+                    if not all(os.path.isdir(s) for s in subdirs):
+                        return False
+                    for sub in subdirs:
+                        wd = self._add_watch(sub, MAILDIR_MASK)
+                        self._wds[wd] = (mbx_key, True, colon)
+                        wds.append(wd)
+                elif os.path.isfile(path):
+                    wd = self._add_watch(path, MBOX_MASK)
+                    self._wds[wd] = (mbx_key, False, colon)
+                    wds.append(wd)
+                else:
+                    return False
+            except (OSError, IOError):
+                for wd in wds:
+                    self._rm_watch(wd)
+                return False
+
+            # We do not know what happened before we started watching,
+            # so the first rescan has to look at everything.
+            self._watched[mbx_key] = (path, wds)
+            self._changes[mbx_key] = MailboxChanges(rescan=True)
+            return True
+
+    def _rm_watch(self, wd):
+        if self._wds.pop(wd, None) is not None:
+            _libc().inotify_rm_watch(self._fd, wd)
+
+    def unwatch(self, mbx_key):
+        with self._lock:
+            path, wds = self._watched.pop(mbx_key, (None, []))
+            for wd in wds:
+                self._rm_watch(wd)
+            self._changes.pop(mbx_key, None)
+
+    def watched(self):
+        with self._lock:
+            return set(self._watched.keys())
+
+    def changes(self, mbx_key):
+        """
+        Returns a copy of the pending changes for a mailbox, or None if
+        we are not watching it.
+        """
+        with self._lock:
+            if mbx_key not in self._watched:
+                return None
+            return self._changes[mbx_key].copy()
+
+    def consume(self, mbx_key, changes):
+        """Mark a set of changes (as returned by changes()) as processed."""
+        with self._lock:
+            if mbx_key in self._changes:
+                self._changes[mbx_key].discard(changes)
+
+    def pending(self):
+        """Returns True if any watched mailbox has unprocessed changes."""
+        with self._lock:
+            return any(self._changes.values())
+
+    def _handle(self, wd, mask, name):
+        with self._lock:
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, every mailbox needs a full rescan.
+                for changes in self._changes.values():
+                    changes.want_rescan()
+                return self._changes.keys()
+
+            if wd not in self._wds:
+                return []
+            mbx_key, is_maildir, colon = self._wds[wd]
+
+            if mask & GONE_MASK:
+                # The mailbox (or part of it) went away or was replaced;
+                # give up on it, so our caller falls back to polling.
+                if mask & IN_IGNORED:
+                    self._wds.pop(wd, None)
+                self.unwatch(mbx_key)
+                return [mbx_key]
+
+            changes = self._changes[mbx_key]
+            if not is_maildir:
+                changes.want_rescan()
+            elif not (mask & IN_ISDIR):
+                key = MaildirKey(name, colon)
+                if key is None:
+                    return []
+                elif mask & (IN_CREATE | IN_MOVED_TO):
+                    changes.add(key)
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    changes.remove(key)
+            return [mbx_key]
+
+    def _read_events(self):
+        try:
+            data = os.read(self._fd, self.READ_SIZE)
+        except OSError, e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return []
+            raise
+
+        events, pos = [], 0
+        while pos + EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, pos)
+            pos += EVENT_HEADER.size
+            name = data[pos:pos + length].rstrip('\0')
+            pos += length
+            events.append((wd, mask, name))
+        return events
+
+    def run(self):
+        self.alive = True
+        try:
+            while self.alive and not mailpile.util.QUITTING:
+                try:
+                    ready = select.select([self._fd], [], [],
+                                          self.POLL_TIMEOUT)[0]
+                except select.error, e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                if not ready:
+                    continue
+
+                touched = set()
+                for wd, mask, name in self._read_events():
+                    touched |= set(self._handle(wd, mask, name))
+                if self.callback:
+                    for mbx_key in touched:
+                        self.callback(mbx_key)
+        finally:
+            self.alive = False
+            self._close()
+
+    def _close(self):
+        with self._lock:
+            self._wds, self._watched, self._changes = {}, {}, {}
+            if self._fd >= 0:
+                os.close(self._fd)
+                self._fd = -1
+
+    def quit(self, join=False):
+        self.alive = False
+        if join and self.is_alive():
+            self.join()
+
+
+if __name__ == '__main__':
+    import doctest
+    results = doctest.testmod(optionflags=doctest.ELLIPSIS,
+                              extraglobs={})
+    print '{0!s}'.format(results)
+    if results.failed:
+        sys.exit(1)
@@ -1,6 +1,7 @@
 import time
 import os
 
+import mailpile.mail_source.inotify as inotify
 from mailpile.mail_source import BaseMailSource
 from mailpile.i18n import gettext as _
 from mailpile.i18n import ngettext as _n
@@ -14,6 +15,8 @@ class LocalMailSource(BaseMailSource):
     # This is a helper for the events.
     __classname__ = 'mailpile.mail_source.local.LocalMailSource'
 
+    WATCH_DELAY = 2  # Wait this long for things to settle after a change
+
     def __init__(self, *args, **kwargs):
         BaseMailSource.__init__(self, *args, **kwargs)
         if not self.my_config.name:
@@ -21,11 +24,48 @@ class LocalMailSource(BaseMailSource):
         self.my_config.protocol = 'local'  # We may be upgrading an old
                                            # mbox or maildir source.
         self.watching = -1
+        self._watcher = None
 
     def close(self):
         pass
 
+    def quit(self, *args, **kwargs):
+        if self._watcher:
+            self._watcher.quit()
+        return BaseMailSource.quit(self, *args, **kwargs)
+
+    def _start_watcher(self):
+        if self._watcher is None:
+            self._watcher = False
+            if inotify.Available():
+                try:
+                    self._watcher = inotify.InotifyWatcher(
+                        callback=self._on_change,
+                        name='Inotify({0!s})'.format(self.my_config._key))
+                    self._watcher.start()
+                except (OSError, IOError):
+                    self._watcher = False
+        return self._watcher
+
+    def _on_change(self, mbx_key):
+        # Coalesce bursts of changes (e.g. a big delivery) into one rescan
+        self.wake_up(after=self.WATCH_DELAY)
+
+    def _sleep(self, seconds):
+        if (self._watcher and self._watcher.pending() and
+                not self._last_rescan_failed):
+            seconds = min(seconds, self.WATCH_DELAY)
+        return BaseMailSource._sleep(self, seconds)
+
+    def _unwatch_inactive(self, mailboxes):
+        active = set(m._key for m in mailboxes
+                     if self._policy(m) not in ('ignore', 'unknown'))
+        for mbx_key in self._watcher.watched() - active:
+            self._watcher.unwatch(mbx_key)
+
     def open(self):
+        if self._start_watcher():
+            self._unwatch_inactive(self.my_config.mailbox.values())
         with self._lock:
             mailboxes = self.my_config.mailbox.values()
             if self.watching == len(mailboxes):
@@ -47,6 +87,38 @@ class LocalMailSource(BaseMailSource):
         return (len(ds) == 1) and os.path.join(path, ds[0], 'Data')
 
     def _has_mailbox_changed(self, mbx, state):
+        changes = self._watched_changes(mbx)
+        if changes is None or changes.rescan:
+            # Not watched, or the watcher does not know exactly what
+            # happened; fall back to checking mtimes and sizes.
+            changed = self._has_mailbox_changed_on_disk(mbx, state)
+            if changes is not None:
+                if changed:
+                    state['watched'] = changes
+                else:
+                    self._watcher.consume(mbx._key, changes)
+            return changed
+
+        # With no changes at all, leave state['changes'] unset so the odd
+        # "check anyway" rescan still looks at the whole mailbox.
+        state['watched'] = changes
+        if changes:
+            state['changes'] = (changes.added, changes.removed)
+        return bool(changes)
+
+    def _watched_changes(self, mbx):
+        if not self._watcher:
+            return None
+        mbx_path = FilePath(self._path(mbx)).raw_fp
+        if os.path.exists(os.path.join(mbx_path, 'wervd.ver')):
+            colon = '!'
+        else:
+            colon = ':'
+        if self._watcher.watch(mbx._key, mbx_path, colon=colon):
+            return self._watcher.changes(mbx._key)
+        return None
+
+    def _has_mailbox_changed_on_disk(self, mbx, state):
         mbx_path = FilePath(self._path(mbx)).raw_fp
 
         # This is common to all local mailboxes, check the mtime/size
@@ -78,6 +150,10 @@ class LocalMailSource(BaseMailSource):
         return (mtsz != self.event.data.get('mailbox_state', {}).get(mbx._key))
 
     def _mark_mailbox_rescanned(self, mbx, state):
+        if self._watcher and 'watched' in state:
+            self._watcher.consume(mbx._key, state['watched'])
+        if 'mtsz' not in state:
+            return
         if 'mailbox_state' in self.event.data:
             self.event.data['mailbox_state'][mbx._key] = state['mtsz']
         else:
@@ -8,6 +8,9 @@
 ## info required to locate this message and this message only within the
 ## larger mailbox.
 
+import cPickle
+from cStringIO import StringIO
+from itertools import izip
 from urllib import quote, unquote
 
 from mailpile.i18n import gettext as _
@@ -18,10 +21,17 @@ from mailpile.util import MboxRLock
 
 __all__ = ['mbox', 'maildir', 'gmvault', 'imap', 'macmail', 'pop3', 'wervd',
            'MBX_ID_LEN',
-           'NoSuchMailboxError', 'IsMailbox', 'OpenMailbox']
+           'NoSuchMailboxError', 'IsMailbox', 'OpenMailbox',
+           'DumpMailboxState', 'LoadMailboxState']
 
 MAILBOX_CLASSES = []
 
+# Saved mailbox state starts with this, followed by the format version
+STATE_MAGIC = 'Mailpile-Mailbox-State:'
+STATE_VERSION = 1
+
+STRING_MAP_TAG = 'string-map:1'
+
 
 class NoSuchMailboxError(OSError):
     pass
@@ -56,11 +66,76 @@ def OpenMailbox(fn, config, create=False):
     raise ValueError('Not a mailbox: {0!s}'.format(fn))
 
 
+def DumpMailboxState(mbox, fd):
+    """
+    Save the state of a mailbox (its table of contents and so on) to a
+    file. This is a versioned header followed by a binary pickle; the
+    mailbox classes take care to keep their big tables in a form which is
+    compact and fast to load.
+    """
+    fd.write('{0!s}{1:d}\n'.format(STATE_MAGIC, STATE_VERSION))
+    cPickle.dump(mbox, fd, protocol=cPickle.HIGHEST_PROTOCOL)
+
+
+def LoadMailboxState(data):
+    """
+    Load mailbox state saved by DumpMailboxState, or by older versions of
+    Mailpile which just pickled the mailbox.
+
+    >>> sio = StringIO()
+    >>> DumpMailboxState({'_toc': {}}, sio)
+    >>> LoadMailboxState(sio.getvalue())
+    {'_toc': {}}
+    >>> LoadMailboxState(cPickle.dumps({'_toc': {}}, protocol=0))
+    {'_toc': {}}
+    """
+    if not data.startswith(STATE_MAGIC):
+        return cPickle.loads(data)
+    eol = data.index('\n')
+    version = int(data[len(STATE_MAGIC):eol])
+    if version > STATE_VERSION:
+        raise ValueError('Unsupported mailbox state version: {0!s}'
+                         .format(version))
+    sio = StringIO(data)
+    sio.seek(eol + 1)
+    return cPickle.load(sio)
+
+
+def PackStringMap(smap):
+    """
+    Pack a dict of strings into a table which pickles compactly and loads
+    much faster than a dict. Anything else is returned unchanged.
+
+    >>> packed = PackStringMap({'a': 'cur/a:2,S', 'b': 'new/b'})
+    >>> packed[0] == STRING_MAP_TAG
+    True
+    >>> sorted(UnpackStringMap(packed).items())
+    [('a', 'cur/a:2,S'), ('b', 'new/b')]
+    >>> PackStringMap({'a': 1})
+    {'a': 1}
+    """
+    if not isinstance(smap, dict) or not smap:
+        return smap
+    keys, values = smap.keys(), smap.values()
+    for s in keys + values:
+        if type(s) != str or '\0' in s:
+            return smap
+    return (STRING_MAP_TAG, '\0'.join(keys), '\0'.join(values))
+
+
+def UnpackStringMap(packed):
+    if (isinstance(packed, tuple) and len(packed) == 3 and
+            packed[0] == STRING_MAP_TAG):
+        return dict(izip(packed[1].split('\0'), packed[2].split('\0')))
+    return packed
+
+
 def UnorderedPicklable(parent, editable=False):
     """A factory for generating unordered, picklable mailbox classes."""
 
     class UnorderedPicklableMailbox(parent):
         UNPICKLABLE = []
+        STRING_MAPS = ['_toc', 'source_map']
 
         def __init__(self, *args, **kwargs):
             parent.__init__(self, *args, **kwargs)
@@ -85,6 +160,9 @@ def UnorderedPicklable(parent, editable=False):
 
         def __setstate__(self, data):
             self.__dict__.update(data)
+            for sm in self.STRING_MAPS:
+                if sm in self.__dict__:
+                    self.__dict__[sm] = UnpackStringMap(self.__dict__[sm])
             self._lock = MboxRLock()
             with self._lock:
                 self._save_to = None
@@ -105,6 +183,9 @@ def UnorderedPicklable(parent, editable=False):
                        '_file', '_lock', 'parsed'] + self.UNPICKLABLE:
                 if dk in odict:
                     del odict[dk]
+            for sm in self.STRING_MAPS:
+                if sm in odict:
+                    odict[sm] = PackStringMap(odict[sm])
             return odict
 
         def save(self, session=None, to=None, pickler=None):
@@ -148,6 +229,23 @@ def UnorderedPicklable(parent, editable=False):
             with self._lock:
                 return self.get_file(toc_id).read(*args)
 
+        def get_header_bytes(self, toc_ids, max_bytes=10240):
+            # One file per message, so just read each until the headers end
+            for toc_id in toc_ids:
+                try:
+                    with self._lock:
+                        fd = self.get_file(toc_id)
+                except (IOError, OSError, KeyError):
+                    yield toc_id, None
+                    continue
+                lines, count = [], 0
+                for line in fd:
+                    lines.append(line)
+                    count += len(line)
+                    if line in ('\n', '\r\n') or count >= max_bytes:
+                        break
+                yield toc_id, ''.join(lines)[:max_bytes]
+
         def get_string(self, *args, **kwargs):
             with self._lock:
                 return parent.get_string(self, *args, **kwargs)
@@ -182,3 +280,13 @@ def UnorderedPicklable(parent, editable=False):
 
 
     return UnorderedPicklableMailbox
+
+
+if __name__ == "__main__":
+    import doctest
+    import sys
+    results = doctest.testmod(optionflags=doctest.ELLIPSIS,
+                              extraglobs={})
+    print '{0!s}'.format(results)
+    if results.failed:
+        sys.exit(1)
@@ -0,0 +1,160 @@
+import weakref
+from collections import OrderedDict
+
+from mailpile.util import MboxLock
+
+
+#
+# Opening a mailbox means loading its saved state, so recently used
+# mailboxes are kept in memory. Code which holds on to a mailbox for a
+# while (a rescan, copying mail) pins it, so it will not be evicted and
+# saved while still being worked on. Other mailboxes are evicted, least
+# recently used first, once there are too many of them.
+#
+# An evicted mailbox may still be in use somewhere; until it has been
+# garbage collected we keep a weak reference to it and hand it out again,
+# so there is never more than one live copy of a mailbox's state.
+#
+
+
+class _CacheEntry(object):
+    def __init__(self, mbx_id, mbox):
+        self.mbx_id = mbx_id
+        self.mbox = mbox
+        self.pins = 0
+        self.dirty = True
+
+
+class MailboxCache(object):
+    """
+    An LRU cache of open mailboxes, keyed by the name of their state
+    file (there is one for each mailbox ID, local and remote). This class
+    only does the bookkeeping; evicted mailboxes are returned to the
+    caller, which should save them.
+
+    >>> mc = MailboxCache(max_size=1)
+    >>> class Mbx(object): pass
+    >>> a, b = Mbx(), Mbx()
+    >>> mc.put('a', '00001', a, pin=True)
+    []
+    >>> mc.put('b', '00002', b)
+    []
+    >>> len(mc.unpin('a'))
+    1
+    >>> mc.get('a') is a, mc.keys()
+    (True, ['b', 'a'])
+    >>> del a; mc.get('a'), mc.keys()
+    (None, ['b'])
+    >>> dirty = mc.get_dirty(); dirty
+    [('b', '00002', <...Mbx object at ...>)]
+    >>> mc.mark_clean('b', dirty[0][2]); mc.get_dirty()
+    []
+    """
+    def __init__(self, max_size=5):
+        self.lock = MboxLock()
+        self.max_size = max_size
+        self.entries = OrderedDict()  # pfn -> _CacheEntry
+        self.evicted = weakref.WeakValueDictionary()  # pfn -> mbox
+        self.digests = {}  # pfn -> md5 of the last saved state
+
+    def keys(self):
+        with self.lock:
+            return self.entries.keys() + [k for k in self.evicted.keys()
+                                          if k not in self.entries]
+
+    def get(self, pfn):
+        """Returns the mailbox for pfn, or None if it is not cached."""
+        with self.lock:
+            entry = self.entries.pop(pfn, None)
+            if entry is not None:
+                self.entries[pfn] = entry  # Most recent
+                return entry.mbox
+            return self.evicted.get(pfn)
+
+    def put(self, pfn, mbx_id, mbox, pin=False):
+        """
+        Add (or refresh) a mailbox, marking it as dirty. Returns a list
+        of (pfn, mbx_id, mbox) tuples for evicted mailboxes.
+        """
+        with self.lock:
+            entry = self.entries.pop(pfn, None)
+            if entry is None or entry.mbox is not mbox:
+                pins = entry.pins if entry else 0
+                entry = _CacheEntry(mbx_id, mbox)
+                entry.pins = pins
+            self.entries[pfn] = entry
+            self.evicted.pop(pfn, None)
+            entry.dirty = True
+            if pin:
+                entry.pins += 1
+            return self._evict()
+
+    def _evict(self):
+        # Note: The most recently used mailbox is never evicted, even if
+        #       everything else is pinned.
+        evicted = []
+        for pfn in self.entries.keys()[:-1]:
+            if len(self.entries) <= self.max_size:
+                break
+            entry = self.entries[pfn]
+            if not entry.pins:
+                del self.entries[pfn]
+                self.evicted[pfn] = entry.mbox
+                if entry.dirty:
+                    evicted.append((pfn, entry.mbx_id, entry.mbox))
+        return evicted
+
+    def pin(self, pfn):
+        with self.lock:
+            if pfn in self.entries:
+                self.entries[pfn].pins += 1
+                return True
+            return False
+
+    def unpin(self, pfn):
+        """Unpin a mailbox. Returns any mailboxes which were evicted."""
+        with self.lock:
+            entry = self.entries.get(pfn)
+            if entry is not None and entry.pins > 0:
+                entry.pins -= 1
+                entry.dirty = True  # Whoever pinned it probably changed it
+            return self._evict()
+
+    def get_dirty(self):
+        """
+        Returns the dirty mailboxes. They stay dirty until whoever saves
+        them calls mark_clean().
+        """
+        with self.lock:
+            return [(p, e.mbx_id, e.mbox) for p, e in self.entries.items()
+                    if e.dirty]
+
+    def mark_clean(self, pfn, mbox):
+        """Call this just before saving a mailbox."""
+        with self.lock:
+            entry = self.entries.get(pfn)
+            if entry is not None and entry.mbox is mbox:
+                entry.dirty = False
+
+    def mark_dirty(self, pfn):
+        with self.lock:
+            if pfn in self.entries:
+                self.entries[pfn].dirty = True
+
+    def clear(self):
+        """Drop all unpinned mailboxes from the cache."""
+        with self.lock:
+            for pfn, entry in self.entries.items():
+                if not entry.pins:
+                    del self.entries[pfn]
+                    self.evicted[pfn] = entry.mbox
+
+
+if __name__ == "__main__":
+    import doctest
+    import sys
+    results = doctest.testmod(optionflags=doctest.ELLIPSIS,
+                              extraglobs={})
+    print '{0!s}'.format(results)
+    if results.failed:
+        sys.exit(1)
@@ -0,0 +1,263 @@
+import os
+import threading
+from collections import OrderedDict
+
+from mailpile.util import MboxLock
+
+
+#
+# Reading a message used to mean opening a file, reading it and closing it
+# again; rendering a long thread or a page of search results did this
+# dozens of times. Instead, mailboxes share a pool of read-only file
+# descriptors, one per file, which are kept open (up to a limit) and read
+# from at explicit offsets. Each reader gets its own PooledFile with its
+# own position, so readers never get in each other's way.
+#
+# Files which are deleted or replaced must be forgotten, or the pool will
+# keep serving (and holding disk space for) the old data.
+#
+
+
+class FDPool(object):
+    """
+    An LRU pool of read-only file descriptors, shared by all threads.
+
+    Descriptors which are in use are never closed; if all of them are
+    busy the pool may briefly grow beyond max_fds.
+    """
+    def __init__(self, max_fds=500):
+        self.lock = MboxLock()
+        self.max_fds = max_fds
+        self.entries = OrderedDict()  # path -> _PoolEntry
+        self.hits = self.misses = self.evictions = 0
+
+    def _open(self, path):
+        try:
+            return os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        except OSError, e:
+            # Our callers expect the same errors as from open()
+            raise IOError(e.errno, e.strerror, path)
+
+    def _checkout(self, path):
+        with self.lock:
+            entry = self.entries.pop(path, None)
+            if entry is not None:
+                self.hits += 1
+                self.entries[path] = entry  # Most recent
+                entry.users += 1
+                return entry
+            self.misses += 1
+
+        # Open outside the lock, a slow filesystem shouldn't block everyone
+        fd = self._open(path)
+        with self.lock:
+            entry = self.entries.pop(path, None)
+            if entry is None:
+                entry = _PoolEntry(fd)
+            else:
+                os.close(fd)  # Another thread beat us to it
+            self.entries[path] = entry
+            entry.users += 1
+            self._evict()
+            return entry
+
+    def _checkin(self, entry):
+        with self.lock:
+            entry.users -= 1
+            if entry.forgotten and not entry.users:
+                entry.close()
+
+    def _evict(self):
+        if len(self.entries) <= self.max_fds:
+            return
+        for path in self.entries.keys():
+            entry = self.entries[path]
+            if not entry.users:
+                del self.entries[path]
+                entry.close()
+                self.evictions += 1
+                if len(self.entries) <= self.max_fds:
+                    break
+
+    def set_max_fds(self, max_fds):
+        with self.lock:
+            self.max_fds = max(1, max_fds)
+            self._evict()
+
+    def pread(self, path, offset, length):
+        """Read up to length bytes from path, starting at offset."""
+        entry = self._checkout(path)
+        try:
+            with entry.lock:
+                os.lseek(entry.fd, offset, os.SEEK_SET)
+                return os.read(entry.fd, length)
+        finally:
+            self._checkin(entry)
+
+    def size(self, path):
+        entry = self._checkout(path)
+        try:
+            return os.fstat(entry.fd).st_size
+        finally:
+            self._checkin(entry)
+
+    def open(self, path, start=0, end=None):
+        """
+        Return a read-only file-like object for path (or a part of it).
+        Unless an end is given, the file ends where it ended when opened.
+        """
+        if end is None:
+            end = self.size(path)
+        return PooledFile(self, path, start, end)
+
+    def forget(self, path):
+        """Stop caching a file, which has been (re)moved or replaced."""
+        with self.lock:
+            entry = self.entries.pop(path, None)
+            if entry is not None:
+                entry.forgotten = True
+                if not entry.users:
+                    entry.close()
+
+    def clear(self):
+        for path in self.entries.keys():
+            self.forget(path)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'max_fds': self.max_fds,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+
+class _PoolEntry(object):
+    def __init__(self, fd):
+        self.fd = fd
+        self.lock = threading.Lock()  # Held while seeking and reading
+        self.users = 0
+        self.forgotten = False
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class PooledFile(object):
+    """
+    A read-only file-like object for the bytes from start to end of a
+    file in an FDPool. Positions (tell, seek) are relative to start.
+
+    >>> import tempfile
+    >>> tf = tempfile.NamedTemporaryFile()
+    >>> tf.write('From x\\nSubject: hi\\n\\nBody\\nmore'); tf.flush()
+    >>> pool = FDPool(max_fds=1)
+    >>> fd = pool.open(tf.name, 7)
+    >>> fd.readline(), fd.read(2), fd.tell()
+    ('Subject: hi\\n', '\\nB', 14)
+    >>> fd.readlines()
+    ['ody\\n', 'more']
+    >>> fd.seek(-4, 2); fd.read(100)
+    'more'
+    >>> [l for l in pool.open(tf.name, 0, 10)]
+    ['From x\\n', 'Sub']
+    >>> pool.stats()['entries'], pool.stats()['hits']
+    (1, 2)
+    """
+    BLOCK_SIZE = 8192  # Read-ahead for readline()
+
+    def __init__(self, pool, path, start, end):
+        self.pool = pool
+        self.name = path
+        self.closed = False
+        self._start = self._pos = start
+        self._end = end
+        self._buf, self._buf_start = '', start
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def close(self):
+        self.closed = True
+        self._buf = ''
+
+    def tell(self):
+        return self._pos - self._start
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            self._pos += offset
+        elif whence == 2:
+            self._pos = self._end + offset
+        else:
+            self._pos = self._start + offset
+        self._pos = max(self._start, self._pos)
+
+    def _buffered(self, size):
+        bo = self._pos - self._buf_start
+        if 0 <= bo < len(self._buf):
+            return self._buf[bo:bo + size]
+        return ''
+
+    def read(self, size=-1):
+        avail = self._end - self._pos
+        if size is None or size < 0 or size > avail:
+            size = avail
+        if size <= 0:
+            return ''
+        data = self._buffered(size)
+        if len(data) < size:
+            data += self.pool.pread(self.name, self._pos + len(data),
+                                    size - len(data))
+        self._pos += len(data)
+        return data
+
+    def readline(self, size=-1):
+        if size is None or size < 0:
+            size = self._end - self._pos
+        line = []
+        while size > 0 and self._pos < self._end:
+            data = self._buffered(size)
+            if not data:
+                self._buf_start = self._pos
+                self._buf = self.pool.pread(
+                    self.name, self._pos,
+                    min(self.BLOCK_SIZE, self._end - self._pos))
+                data = self._buf[:size]
+                if not data:
+                    break
+            nl = data.find('\n')
+            if nl >= 0:
+                data = data[:nl + 1]
+            line.append(data)
+            self._pos += len(data)
+            size -= len(data)
+            if nl >= 0:
+                break
+        return ''.join(line)
+
+    def readlines(self, sizehint=None):
+        return list(self)
+
+
+GLOBAL_FD_POOL = FDPool()
+
+
+if __name__ == "__main__":
+    import doctest
+    import sys
+    results = doctest.testmod(optionflags=doctest.ELLIPSIS,
+                              extraglobs={})
+    print '{0!s}'.format(results)
+    if results.failed:
+        sys.exit(1)
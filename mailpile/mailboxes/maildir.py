@@ -1,11 +1,116 @@
 import mailbox
 import os
 import sys
+import time
 
 import mailpile.mailboxes
 from mailpile.i18n import gettext as _
 from mailpile.i18n import ngettext as _n
 from mailpile.mailboxes import UnorderedPicklable
+from mailpile.mailboxes.fdpool import GLOBAL_FD_POOL
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+#
+# The standard library's Maildir rebuilds its table of contents from
+# scratch whenever new/ or cur/ changes, stat()ing every file on the way;
+# with hundreds of thousands of messages that takes seconds. Instead, we
+# only list the subdirectories which have changed, only check the entries
+# we have not seen before, and apply the differences to the existing TOC.
+#
+
+
+def _ListDir(path):
+    """Yields (name, is_dir) tuples; is_dir is None if unknown."""
+    if scandir is not None:
+        for entry in scandir(path):
+            yield entry.name, entry.is_dir()
+    else:
+        for name in os.listdir(path):
+            yield name, None
+
+
+def RefreshMaildir(mbox, is_message=None):
+    """
+    Bring the table of contents of a mailbox.Maildir up to date. Files
+    whose keys fail the is_message test are ignored. Returns True if any
+    subdirectory had to be listed.
+
+    >>> import tempfile, shutil
+    >>> td = tempfile.mkdtemp()
+    >>> md = mailbox.Maildir(os.path.join(td, 'md'))
+    >>> for fn in ('new/1', 'new/.hidden', 'cur/2:2,S'):
+    ...     open(os.path.join(md._path, fn), 'w').close()
+    >>> is_msg = lambda k: not k.startswith('.')
+    >>> RefreshMaildir(md, is_msg)
+    True
+    >>> sorted(md._toc.items())
+    [('1', 'new/1'), ('2', 'cur/2:2,S')]
+    >>> os.rename(os.path.join(md._path, 'new/1'),
+    ...           os.path.join(md._path, 'cur/1:2,'))
+    >>> RefreshMaildir(md, is_msg); sorted(md._toc.items())
+    True
+    [('1', 'cur/1:2,'), ('2', 'cur/2:2,S')]
+    >>> md._toc_listed = dict((s, time.time() + 10) for s in md._toc_listed)
+    >>> RefreshMaildir(md, is_msg)
+    False
+    >>> shutil.rmtree(td)
+    """
+    listed = getattr(mbox, '_toc_listed', None) or {}
+    changed = []
+    for subdir in mbox._toc_mtimes:
+        mtime = os.path.getmtime(mbox._paths[subdir])
+        # A listing made within a couple of seconds of the last change
+        # may have missed further changes with the same mtime, so we do
+        # not trust it. See mailbox.Maildir._refresh for details.
+        if (mtime != mbox._toc_mtimes[subdir] or
+                listed.get(subdir, 0) - mtime <= 2 + mbox._skewfactor):
+            changed.append(subdir)
+        mbox._toc_mtimes[subdir] = mtime
+    if not changed:
+        return False
+
+    known = dict((subdir, {}) for subdir in changed)
+    for key, fn in mbox._toc.iteritems():
+        subdir, name = fn.split(os.sep, 1)
+        if subdir in known:
+            known[subdir][name] = key
+
+    added, removed = [], []
+    for subdir in changed:
+        path = mbox._paths[subdir]
+        listed[subdir] = time.time()
+        names = set()
+        for name, is_dir in _ListDir(path):
+            names.add(name)
+            if name in known[subdir]:
+                continue
+            key = name.split(mbox.colon)[0]
+            if is_message is not None and not is_message(key):
+                continue
+            if is_dir is None:
+                is_dir = os.path.isdir(os.path.join(path, name))
+            if not is_dir:
+                added.append((key, os.path.join(subdir, name)))
+        for name, key in known[subdir].iteritems():
+            if name not in names:
+                removed.append((key, os.path.join(subdir, name)))
+
+    for key, fn in removed:
+        if mbox._toc.get(key) == fn:
+            del mbox._toc[key]
+    for key, fn in added:
+        mbox._toc[key] = fn
+    mbox._toc_listed = listed
+    mbox._last_read = time.time()
+    return True
 
 
 class MailpileMailbox(UnorderedPicklable(mailbox.Maildir, editable=True)):
@@ -24,10 +129,19 @@ class MailpileMailbox(UnorderedPicklable(mailbox.Maildir, editable=True)):
 
     def _refresh(self):
         with self._lock:
-            mailbox.Maildir._refresh(self)
             # Dotfiles are not mail. Ignore them.
-            for t in [k for k in self._toc.keys() if k.startswith('.')]:
-                del self._toc[t]
+            RefreshMaildir(self, lambda k: not k.startswith('.'))
+
+    def get_file(self, key):
+        with self._lock:
+            path = os.path.join(self._path, self._lookup(key))
+        return GLOBAL_FD_POOL.open(path)
+
+    def remove(self, key):
+        with self._lock:
+            path = os.path.join(self._path, self._lookup(key))
+            mailbox.Maildir.remove(self, key)
+        GLOBAL_FD_POOL.forget(path)
 
     def get_metadata_keywords(self, toc_id):
         subdir, name = os.path.split(self._lookup(toc_id))
@@ -39,3 +153,12 @@ class MailpileMailbox(UnorderedPicklable(mailbox.Maildir, editable=True)):
 
 
 mailpile.mailboxes.register(25, MailpileMailbox)
+
+
+if __name__ == "__main__":
+    import doctest
+    results = doctest.testmod(optionflags=doctest.ELLIPSIS,
+                              extraglobs={})
+    print '{0!s}'.format(results)
+    if results.failed:
+        sys.exit(1)
@@ -1,15 +1,171 @@
+import binascii
 import errno
+import hashlib
 import mailbox
+import mmap
 import os
+import sys
 import threading
+from array import array
 
 import mailpile.mailboxes
 from mailpile.i18n import gettext as _
 from mailpile.i18n import ngettext as _n
 from mailpile.mailboxes import MBX_ID_LEN, NoSuchMailboxError
+from mailpile.mailboxes.fdpool import GLOBAL_FD_POOL
 from mailpile.util import *
 
 
+# File offsets must fit; a C long is only 32 bits on some platforms.
+TOC_OFFSET_TYPE = 'l' if (array('l').itemsize >= 8) else 'd'
+
+
+class CompactTOC(object):
+    """
+    The table of contents of an mbox: a dict-like mapping of integer keys
+    to (start, end) offsets. The offsets and the checksums used in message
+    pointers are kept in flat arrays, which take far less memory than a
+    dict of tuples. Keys are expected to be assigned in order; deleting
+    an entry leaves a hole.
+
+    >>> toc = CompactTOC({0: (0, 10), 2: (20, 30)})
+    >>> toc[3] = (30, 40)
+    >>> toc.set_cs(3, 'abcd')
+    >>> del toc[0]
+    >>> len(toc), toc.keys(), toc[3], toc.get_cs(3), toc.get_cs(2), 0 in toc
+    (2, [2, 3], (30, 40), 'abcd', None, False)
+    >>> toc.truncate(3)
+    >>> toc.items()
+    [(2, (20, 30))]
+    >>> import cPickle
+    >>> cPickle.loads(cPickle.dumps(toc, protocol=2)).items()
+    [(2, (20, 30))]
+    """
+    CS_LEN = 4
+    NO_CS = '\0' * CS_LEN
+
+    def __init__(self, toc=None):
+        self.starts = array(TOC_OFFSET_TYPE)
+        self.ends = array(TOC_OFFSET_TYPE)
+        self.checksums = array('c')
+        self.count = 0
+        for key, value in sorted((toc or {}).iteritems()):
+            self[key] = value
+
+    def __getstate__(self):
+        # Arrays pickle as lists of numbers; raw bytes are far smaller
+        # and faster to load.
+        return {
+            'typecode': self.starts.typecode,
+            'itemsize': self.starts.itemsize,
+            'byteorder': sys.byteorder,
+            'starts': self.starts.tostring(),
+            'ends': self.ends.tostring(),
+            'checksums': self.checksums.tostring(),
+            'count': self.count
+        }
+
+    def __setstate__(self, state):
+        if isinstance(state.get('starts'), array):
+            self.__dict__.update(state)
+            return
+        typecode = state['typecode']
+        if array(typecode).itemsize != state['itemsize']:
+            raise ValueError('Incompatible TOC from another platform')
+        self.starts, self.ends = array(typecode), array(typecode)
+        self.starts.fromstring(state['starts'])
+        self.ends.fromstring(state['ends'])
+        if state['byteorder'] != sys.byteorder:
+            self.starts.byteswap()
+            self.ends.byteswap()
+        if typecode != TOC_OFFSET_TYPE:
+            self.starts = array(TOC_OFFSET_TYPE, map(int, self.starts))
+            self.ends = array(TOC_OFFSET_TYPE, map(int, self.ends))
+        self.checksums = array('c', state['checksums'])
+        self.count = state['count']
+
+    def __contains__(self, key):
+        try:
+            return key >= 0 and self.starts[key] >= 0
+        except (IndexError, TypeError):
+            return False
+
+    has_key = __contains__
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        return (int(self.starts[key]), int(self.ends[key]))
+
+    def __setitem__(self, key, value):
+        self.add(key, value[0], value[1])
+
+    def add(self, key, start, end, cs=None):
+        if key == len(self.starts):
+            self.starts.append(start)
+            self.ends.append(end)
+            self.checksums.fromstring(cs or self.NO_CS)
+            self.count += 1
+            return
+        elif key > len(self.starts):
+            while len(self.starts) < key:
+                self.starts.append(-1)
+                self.ends.append(-1)
+                self.checksums.fromstring(self.NO_CS)
+            return self.add(key, start, end, cs)
+        if key not in self:
+            self.count += 1
+        self.starts[key], self.ends[key] = start, end
+        self.set_cs(key, cs)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.starts[key] = self.ends[key] = -1
+        self.set_cs(key, None)
+        self.count -= 1
+
+    def get(self, key, default=None):
+        return self[key] if (key in self) else default
+
+    def iterkeys(self):
+        starts = self.starts
+        return (k for k in xrange(0, len(starts)) if starts[k] >= 0)
+
+    __iter__ = iterkeys
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def iteritems(self):
+        return ((k, self[k]) for k in self.iterkeys())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def values(self):
+        return [v for k, v in self.iteritems()]
+
+    def get_cs(self, key):
+        cs = self.checksums[key * self.CS_LEN:
+                            (key + 1) * self.CS_LEN].tostring()
+        return None if (cs == self.NO_CS) else cs
+
+    def set_cs(self, key, cs):
+        self.checksums[key * self.CS_LEN:(key + 1) * self.CS_LEN] = array(
+            'c', (cs or self.NO_CS)[:self.CS_LEN].ljust(self.CS_LEN))
+
+    def truncate(self, key):
+        """Remove all entries from key onwards."""
+        del self.starts[key:]
+        del self.ends[key:]
+        del self.checksums[key * self.CS_LEN:]
+        self.count = len([s for s in self.starts if s >= 0])
+
+
 class MailpileMailbox(mailbox.mbox):
     """A mbox class that supports pickling and a few mailpile specifics."""
 
@@ -47,6 +203,7 @@ class MailpileMailbox(mailbox.mbox):
 
     def __setstate__(self, dict):
         self.__dict__.update(dict)
+        self._upgrade_toc()
         self._lock = MboxRLock()
         self.is_local = False
         with self._lock:
@@ -66,54 +223,166 @@ class MailpileMailbox(mailbox.mbox):
                     raise
         self.update_toc()
 
+    def _upgrade_toc(self):
+        # Older versions pickled the TOC as a dict of (start, end) tuples,
+        # with the pointer checksums (if any) in a separate dict.
+        old_cs = self.__dict__.pop('_toc_cs', {})
+        if self._toc and not isinstance(self._toc, CompactTOC):
+            toc = CompactTOC(self._toc)
+            for key, (start, end, cs) in old_cs.iteritems():
+                if toc.get(key) == (start, end):
+                    toc.set_cs(key, cs)
+            self._toc = toc
+
     def __getstate__(self):
         odict = self.__dict__.copy()
         # Pickle can't handle function objects.
         for dk in ('_save_to',
                    '_encryption_key_func', '_decryption_key_func',
-                   '_file', '_lock', 'parsed'):
+                   '_file', '_file_id', '_lock', 'parsed'):
             if dk in odict:
                 del odict[dk]
         return odict
 
+    def _file_replaced(self, st):
+        # If the mailbox was replaced (not just modified), our descriptors
+        # all point at the old file and need to be reopened.
+        if getattr(self, '_file_id', None) is None:
+            fst = os.fstat(self._file.fileno())
+            self._file_id = (fst.st_dev, fst.st_ino)
+        if self._file_id == (st.st_dev, st.st_ino):
+            return False
+        self._file.close()
+        self._file = self._get_fd()
+        self._file_id = (st.st_dev, st.st_ino)
+        GLOBAL_FD_POOL.forget(self._path)
+        return True
+
     def update_toc(self):
         with self._lock:
+            st = os.stat(self._path)
+            replaced = self._file_replaced(st)
             fd = self._file
 
-            # FIXME: Should also check the mtime.
             fd.seek(0, 2)
             cur_length = fd.tell()
-            cur_mtime = os.path.getmtime(self._path)
+            cur_mtime = st.st_mtime
             try:
                 if (self._file_length == cur_length and
-                        self._mtime == cur_mtime):
+                        self._mtime == cur_mtime and not replaced):
                     return
             except (NameError, AttributeError):
                 pass
 
-            fd.seek(0)
-            self._next_key = 0
-            self._toc = {}
-            start = None
-            while True:
-                line_pos = fd.tell()
-                line = fd.readline()
-                if line.startswith('From '):
-                    if start is not None:
-                        len_nl = ('\r' == line[-2]) and 2 or 1
-                        self._toc[self._next_key] = (start, line_pos - len_nl)
-                        self._next_key += 1
-                    start = line_pos
-                elif line == '':
-                    if (start is not None) and (start != line_pos):
-                        self._toc[self._next_key] = (start, line_pos)
-                        self._next_key += 1
-                    break
+            resume_from = None if replaced else self._appended_to(cur_length)
+            if resume_from is None:
+                self._next_key = 0
+                self._toc = CompactTOC()
+                resume_from = 0
+            self._scan_toc(fd, resume_from)
 
             self._file_length = fd.tell()
             self._mtime = cur_mtime
         self.save(None)
 
+    def _appended_to(self, cur_length):
+        """
+        If the mailbox has only grown since we last looked, drop the last
+        message from the TOC (it may have grown too) and return the offset
+        to resume scanning from. Returns None if a full rescan is needed.
+        """
+        try:
+            if not self._toc or cur_length <= self._file_length:
+                return None
+            last_key = self._next_key - 1
+            if last_key not in self._toc:
+                return None
+
+            # Make sure the first and last messages are still where we
+            # think they are; if not, the file has been rewritten.
+            for key in set([self._toc.iterkeys().next(), last_key]):
+                start, end = self._toc[key]
+                cs = self._toc.get_cs(key)
+                if not cs or self.get_msg_cs80b(start, end - start) != cs:
+                    return None
+        except (AttributeError, IOError, OSError):
+            return None
+
+        start = self._toc[last_key][0]
+        self._toc.truncate(last_key)
+        self._next_key = last_key
+        return start
+
+    def _add_toc_entry(self, start, end, cs_data):
+        # We have the start of the message in hand, so we may as well
+        # checksum it now instead of seeking back for it later. This is
+        # the same as b64w(sha1b64(cs_data)[:4]), see get_msg_cs(), but
+        # without encoding the whole hash.
+        cs = b64w(binascii.b2a_base64(hashlib.sha1(cs_data).digest()[:3]))
+        self._toc.add(self._next_key, start, end, cs[:4])
+        self._next_key += 1
+
+    def _scan_toc(self, fd, offset):
+        fd.seek(0, 2)
+        length = fd.tell()
+        if offset >= length:
+            return
+        try:
+            mm = mmap.mmap(fd.fileno(), length, access=mmap.ACCESS_READ)
+        except (EnvironmentError, ValueError, OverflowError):
+            return self._scan_toc_lines(fd, offset)
+        try:
+            self._scan_toc_mmap(mm, offset, length)
+        finally:
+            mm.close()
+        fd.seek(length)
+
+    def _scan_toc_mmap(self, mm, offset, length):
+        # Searching for the separators in bulk is much faster than going
+        # line by line; escaped (>From) lines never match.
+        start = offset if (mm[offset:offset + 5] == 'From ') else None
+        pos = offset
+        while True:
+            sep = mm.find('\nFrom ', pos)
+            if sep < 0:
+                break
+            sep += 1
+            if start is not None:
+                # Same rule as _scan_toc_lines: check how the From line ends
+                eol = mm.find('\n', sep)
+                len_nl = ('\r' == mm[(eol if eol >= 0 else length) - 1]
+                          ) and 2 or 1
+                end = sep - len_nl
+                self._add_toc_entry(start, end,
+                                    mm[start:start + min(80, end - start)])
+            start = pos = sep
+        if (start is not None) and (start != length):
+            self._add_toc_entry(start, length,
+                                mm[start:start + min(80, length - start)])
+
+    def _scan_toc_lines(self, fd, offset):
+        fd.seek(offset)
+        start = None
+        head = []
+        while True:
+            line_pos = fd.tell()
+            line = fd.readline()
+            if line.startswith('From '):
+                if start is not None:
+                    len_nl = ('\r' == line[-2]) and 2 or 1
+                    end = line_pos - len_nl
+                    self._add_toc_entry(start, end,
+                                        ''.join(head)[:min(80, end - start)])
+                start = line_pos
+                head = [line]
+            elif line == '':
+                if (start is not None) and (start != line_pos):
+                    self._add_toc_entry(start, line_pos,
+                                        ''.join(head)[:80])
+                break
+            elif start is not None and line_pos - start < 80:
+                head.append(line)
+
     def save(self, session=None, to=None, pickler=None):
         if to and pickler:
             self._save_to = (pickler, to)
@@ -139,15 +408,13 @@ class MailpileMailbox(mailbox.mbox):
         pass
 
     def get_msg_cs(self, start, cs_size, max_length):
-        with self._lock:
-            if start is None:
-                raise IOError(_('No data found'))
-            fd = self._file
-            fd.seek(start, 0)
-            firstKB = fd.read(min(cs_size, max_length))
-            if firstKB == '':
-                raise IOError(_('No data found'))
-            return b64w(sha1b64(firstKB)[:4])
+        if start is None:
+            raise IOError(_('No data found'))
+        firstKB = GLOBAL_FD_POOL.pread(self._path, start,
+                                       min(cs_size, max_length))
+        if firstKB == '':
+            raise IOError(_('No data found'))
+        return b64w(sha1b64(firstKB)[:4])
 
     def get_msg_cs1k(self, start, max_length):
         return self.get_msg_cs(start, 1024, max_length)
@@ -157,12 +424,19 @@ class MailpileMailbox(mailbox.mbox):
 
     def get_msg_ptr(self, mboxid, toc_id):
         with self._lock:
-            msg_start = self._toc[toc_id][0]
-            msg_size = self.get_msg_size(toc_id)
+            msg_start, msg_end = self._toc[toc_id]
+            msg_size = msg_end - msg_start
+            # The base class may have swapped in a plain dict (on flush)
+            get_cs = getattr(self._toc, 'get_cs', None)
+            cs80b = get_cs and get_cs(toc_id)
+            if not cs80b:
+                cs80b = self.get_msg_cs80b(msg_start, msg_size)
+                if get_cs:
+                    self._toc.set_cs(toc_id, cs80b)
         return '{0!s}{1!s}:{2!s}:{3!s}'.format(mboxid,
                                b36(msg_start),
                                b36(msg_size),
-                               self.get_msg_cs80b(msg_start, msg_size))
+                               cs80b)
 
     def get_file_by_ptr(self, msg_ptr):
         parts = msg_ptr[MBX_ID_LEN:].split(':')
@@ -177,13 +451,50 @@ class MailpileMailbox(mailbox.mbox):
             if (cs1k != cs and cs80b != cs):
                 raise IOError(_('Message not found'))
 
-        # We duplicate the file descriptor here, in case other threads are
-        # accessing the same mailbox and moving it around, or in case we have
-        # multiple PartialFile objects in flight at once.
-        return mailbox._PartialFile(self._get_fd(), start, start + length)
+        # Pooled files share a descriptor but each keep their own position,
+        # so other threads or readers can't move things around under us.
+        return GLOBAL_FD_POOL.open(self._path, start, start + length)
+
+    def get_file(self, toc_id, from_=False):
+        with self._lock:
+            start, end = self._lookup(toc_id)
+        fd = GLOBAL_FD_POOL.open(self._path, start, end)
+        if not from_:
+            start += len(fd.readline())
+        return GLOBAL_FD_POOL.open(self._path, start, end)
 
     def get_bytes(self, toc_id, *args):
         return self.get_file(toc_id).read(*args)
 
+    def get_header_bytes(self, toc_ids, max_bytes=10240,
+                         block_size=1024 * 1024):
+        """
+        Yield (toc_id, data) pairs with the first max_bytes of each
+        message, which should cover the headers. The mailbox is read
+        sequentially in large blocks, only seeking to skip over bodies
+        which are bigger than a block.
+        """
+        with self._lock:
+            wanted = sorted((self._toc[t][0], self._toc[t][1], t)
+                            for t in toc_ids if t in self._toc)
+        data, data_start = '', 0
+        for start, end, toc_id in wanted:
+            want_end = min(end, start + max_bytes)
+            if not (data_start <= start and
+                    want_end <= data_start + len(data)):
+                data = GLOBAL_FD_POOL.pread(self._path, start,
+                                            max(block_size, want_end - start))
+                data_start = start
+            yield toc_id, data[start - data_start:want_end - data_start]
+
 
-mailpile.mailboxes.register(90, MailpileMailbox)
+if __name__ == "__main__":
+    import doctest
+    import sys
+    results = doctest.testmod(optionflags=doctest.ELLIPSIS,
+                              extraglobs={})
+    print '{0!s}'.format(results)
+    if results.failed:
+        sys.exit(1)
+else:
+    mailpile.mailboxes.register(90, MailpileMailbox)
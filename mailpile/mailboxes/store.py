@@ -0,0 +1,161 @@
+import errno
+import hashlib
+import hmac
+import os
+
+from mailpile.util import MboxLock
+
+
+#
+# The same message often lives in more than one mailbox (think of Gmail's
+# "All Mail" and labels), and each copy used to be downloaded, encrypted
+# and written to disk separately. The content store is a directory of
+# messages named by a keyed hash of their content. Local mailboxes hard
+# link to the files in it, so storing a duplicate costs a directory entry
+# and the filesystem's link count doubles as a reference count: once no
+# mailbox links to a message any more, gc() removes it. Mailboxes call
+# release() before deleting a file, so we know when gc() has work to do.
+#
+# If hard links are not available (or the mailbox lives on another file
+# system), we silently fall back to storing the message normally.
+#
+
+
+class ContentStore(object):
+    """
+    A directory of messages, named by content hash and shared (using
+    hard links) by any number of Maildirs on the same file system.
+
+    >>> import tempfile, shutil
+    >>> td = tempfile.mkdtemp()
+    >>> cs = ContentStore(os.path.join(td, 'store'))
+    >>> open(os.path.join(td, 'a'), 'w').write('encrypted(hello)')
+    >>> cid = cs.content_id('hello', 'key')
+    >>> cid == cs.content_id('hello', 'other key')
+    False
+    >>> cs.link(cid, os.path.join(td, 'b'))
+    False
+    >>> cs.adopt(cid, os.path.join(td, 'a'))
+    True
+    >>> cs.link(cid, os.path.join(td, 'b')), cs.refcount(cid)
+    (True, 2)
+    >>> open(os.path.join(td, 'b')).read()
+    'encrypted(hello)'
+    >>> cs.release(os.path.join(td, 'a')); os.remove(os.path.join(td, 'a'))
+    >>> cs.orphaned
+    0
+    >>> cs.release(os.path.join(td, 'b')); os.remove(os.path.join(td, 'b'))
+    >>> cs.orphaned, cs.refcount(cid)
+    (1, 0)
+    >>> cs.gc(), cs.refcount(cid), cs.orphaned
+    (1, None, 0)
+    >>> shutil.rmtree(td)
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = MboxLock()
+        self.linked = self.adopted = self.orphaned = 0
+
+    @classmethod
+    def Available(cls):
+        return hasattr(os, 'link')
+
+    def content_id(self, data, key=None):
+        """
+        Hash message data. The hash is keyed, so the names of the files
+        in the store reveal nothing about their (encrypted) contents.
+        """
+        return hmac.new(key or 'unencrypted', data, hashlib.sha256
+                        ).hexdigest()
+
+    def _path(self, cid):
+        return os.path.join(self.path, cid[:2], cid)
+
+    def link(self, cid, dest):
+        """
+        Link a message from the store to dest. Returns False if the store
+        does not have the message (or linking failed).
+        """
+        try:
+            os.link(self._path(cid), dest)
+        except (OSError, AttributeError):
+            return False
+        with self.lock:
+            self.linked += 1
+        return True
+
+    def adopt(self, cid, src):
+        """
+        Add a message (already written to src) to the store, by linking
+        to it. Returns True if the store now has the message.
+        """
+        fn = self._path(cid)
+        try:
+            if not os.path.exists(os.path.dirname(fn)):
+                os.makedirs(os.path.dirname(fn))
+            os.link(src, fn)
+        except OSError, e:
+            return (e.errno == errno.EEXIST)
+        except AttributeError:
+            return False
+        with self.lock:
+            self.adopted += 1
+        return True
+
+    def release(self, fn):
+        """
+        Note that a mailbox is about to delete fn. If that leaves a message
+        in the store with nobody linking to it, gc() has work to do.
+        """
+        try:
+            if os.stat(fn).st_nlink == 2:
+                with self.lock:
+                    self.orphaned += 1
+        except OSError:
+            pass
+
+    def refcount(self, cid):
+        """How many mailboxes link to this message, None if not stored."""
+        try:
+            return os.stat(self._path(cid)).st_nlink - 1
+        except OSError:
+            return None
+
+    def gc(self):
+        """Remove messages no mailbox links to. Returns how many."""
+        removed = 0
+        with self.lock:
+            self.orphaned = 0
+        if not os.path.isdir(self.path):
+            return removed
+        for sub in os.listdir(self.path):
+            subdir = os.path.join(self.path, sub)
+            if not os.path.isdir(subdir):
+                continue
+            for cid in os.listdir(subdir):
+                fn = os.path.join(subdir, cid)
+                try:
+                    if os.stat(fn).st_nlink <= 1:
+                        os.remove(fn)
+                        removed += 1
+                except OSError:
+                    pass
+        return removed
+
+    def stats(self):
+        with self.lock:
+            return {
+                'linked': self.linked,
+                'adopted': self.adopted,
+                'orphaned': self.orphaned
+            }
+
+
+if __name__ == "__main__":
+    import doctest
+    import sys
+    results = doctest.testmod(optionflags=doctest.ELLIPSIS,
+                              extraglobs={})
+    print '{0!s}'.format(results)
+    if results.failed:
+        sys.exit(1)
@@ -1,21 +1,31 @@
 import email.generator
 import email.message
 import mailbox
+import shutil
 import StringIO
 import sys
+import tempfile
 
 import mailpile.mailboxes
 from mailpile.i18n import gettext as _
 from mailpile.i18n import ngettext as _n
 from mailpile.mailboxes import UnorderedPicklable
+from mailpile.mailboxes.fdpool import GLOBAL_FD_POOL, PooledFile
+from mailpile.mailboxes.maildir import RefreshMaildir
 from mailpile.crypto.streamer import *
+from mailpile.crypto.chunked import ChunkedDecryptingReader
+from mailpile.crypto.chunked import ChunkedEncryptingWriter
+import mailpile.crypto.chunked
 from mailpile.util import safe_remove
 
 
 class MailpileMailbox(UnorderedPicklable(mailbox.Maildir, editable=True)):
     """A Maildir class that supports pickling and a few mailpile specifics."""
+    UNPICKLABLE = ['content_store', '_compression_func']
     supported_platform = None
     colon = '!'  # Works on both Windows and Unix
+    content_store = None  # A mailpile.mailboxes.store.ContentStore
+    _compression_func = staticmethod(lambda: False)
 
     @classmethod
     def parse_path(cls, config, fn, create=False):
@@ -36,21 +46,28 @@ class MailpileMailbox(UnorderedPicklable(mailbox.Maildir, editable=True)):
         with self._lock:
             fn = os.path.join(self._path, self._lookup(key))
             del self._toc[key]
+        GLOBAL_FD_POOL.forget(fn)
+        if self.content_store is not None:
+            self.content_store.release(fn)
         safe_remove(fn)
 
     def _refresh(self):
         with self._lock:
-            mailbox.Maildir._refresh(self)
             # WERVD mail names don't have dots in them
-            for t in [k for k in self._toc.keys() if '.' in k]:
-                del self._toc[t]
+            RefreshMaildir(self, lambda k: '.' not in k)
         safe_remove()  # Try to remove any postponed removals
 
     def _get_fd(self, key):
         with self._lock:
-            fd = open(os.path.join(self._path, self._lookup(key)), 'rb')
+            fd = GLOBAL_FD_POOL.open(os.path.join(self._path,
+                                                  self._lookup(key)))
             mep_key = self._decryption_key_func()
         if mep_key:
+            # New messages can be decrypted in-process and on demand,
+            # older ones need the openssl coprocess.
+            reader = ChunkedDecryptingReader.Open(fd, mep_key)
+            if reader is not None:
+                return reader
             fd = DecryptingStreamer(fd, mep_key=mep_key, name='WERVD')
         return fd
 
@@ -70,7 +87,11 @@ class MailpileMailbox(UnorderedPicklable(mailbox.Maildir, editable=True)):
 
     def get_file(self, key):
         with self._lock:
-            return StringIO.StringIO(self.get_string(key))
+            fd = self._get_fd(key)
+            if isinstance(fd, (ChunkedDecryptingReader, PooledFile)):
+                return fd  # Seekable, no need to read it all up front
+            with fd:
+                return StringIO.StringIO(fd.read())
 
     def get_metadata_keywords(self, toc_id):
         subdir, name = os.path.split(self._lookup(toc_id))
@@ -91,11 +112,38 @@ class MailpileMailbox(UnorderedPicklable(mailbox.Maildir, editable=True)):
                 if new_fpath != old_fpath:
                     os.rename(os.path.join(self._path, old_fpath),
                               os.path.join(self._path, new_fpath))
+                    GLOBAL_FD_POOL.forget(os.path.join(self._path, old_fpath))
                     self._toc[toc_id] = new_fpath
 
     def add(self, message, copies=1):
         """Add message and return assigned key."""
+        store = self.content_store
+        if store is None or not isinstance(message, str):
+            return self._write_message(message, copies)
+
+        # If another mailbox already has this message, just link to it
+        cid = store.content_id(message, self._encryption_key_func())
+        key = self._add_from_store(store, cid, copies)
+        if key is None:
+            key = self._write_message(message, copies)
+            store.adopt(cid, os.path.join(self._path, self._lookup(key)))
+        return key
+
+    def _add_from_store(self, store, cid, copies):
+        key = self._pick_filename(cid)
+        fn = os.path.join(self._path, 'new', key)
+        if not store.link(cid, fn):
+            return None
+        # Extra copies are for redundancy, so they must not share an inode
+        for cpn in range(1, copies):
+            shutil.copyfile(fn, '{0!s}.{1!s}'.format(fn, cpn))
+        self._toc[key] = os.path.join('new', key)
+        return key
+
+    def _write_message(self, message, copies):
         key = self._encryption_key_func()
+        if key and mailpile.crypto.chunked.Available():
+            return self._add_chunked(message, key, copies)
         es = None
         try:
             tmpdir = os.path.join(self._path, 'tmp')
@@ -108,20 +156,9 @@ class MailpileMailbox(UnorderedPicklable(mailbox.Maildir, editable=True)):
             self._dump_message(message, es)
             es.finish()
 
-            # We are using the MD5 to detect file system corruption, not in a
-            # security context - so using as little as 40 bits should be fine.
-            saved = False
-            key = None
-            for l in range(10, len(es.outer_md5sum)):
-                key = es.outer_md5sum[:l]
-                fn = os.path.join(self._path, 'new', key)
-                if not os.path.exists(fn):
-                    es.save(fn)
-                    saved = self._toc[key] = os.path.join('new', key)
-                    break
-            if not saved:
-                raise mailbox.ExternalClashError(_('Could not find a filename '
-                                                   'for the message.'))
+            key = self._pick_filename(es.outer_md5sum)
+            es.save(os.path.join(self._path, 'new', key))
+            self._toc[key] = os.path.join('new', key)
 
             for cpn in range(1, copies):
                 fn = os.path.join(self._path, 'new', '{0!s}.{1!s}'.format(key, cpn))
@@ -133,6 +170,37 @@ class MailpileMailbox(UnorderedPicklable(mailbox.Maildir, editable=True)):
             if es is not None:
                 es.close()
 
+    def _pick_filename(self, md5sum):
+        # We are using the MD5 to detect file system corruption, not in a
+        # security context - so using as little as 40 bits should be fine.
+        for l in range(10, len(md5sum)):
+            key = md5sum[:l]
+            if not os.path.exists(os.path.join(self._path, 'new', key)):
+                return key
+        raise mailbox.ExternalClashError(_('Could not find a filename '
+                                           'for the message.'))
+
+    def _add_chunked(self, message, mep_key, copies):
+        tmpfd, tmpfn = tempfile.mkstemp(dir=os.path.join(self._path, 'tmp'),
+                                        prefix='WERVD')
+        try:
+            with os.fdopen(tmpfd, 'wb') as fd:
+                with ChunkedEncryptingWriter(
+                        fd, mep_key,
+                        compress=self._compression_func()) as writer:
+                    self._dump_message(message, writer)
+
+            key = self._pick_filename(writer.outer_md5sum)
+            fn = os.path.join(self._path, 'new', key)
+            for cpn in range(1, copies):
+                shutil.copyfile(tmpfn, '{0!s}.{1!s}'.format(fn, cpn))
+            os.rename(tmpfn, fn)
+            self._toc[key] = os.path.join('new', key)
+            return key
+        finally:
+            if os.path.exists(tmpfn):
+                safe_remove(tmpfn)
+
     def _dump_message(self, message, target):
         if isinstance(message, email.message.Message):
             gen = email.generator.Generator(target, False, 0)
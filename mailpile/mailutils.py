@@ -2,6 +2,7 @@
 import base64
 import copy
 import email.header
+import email.message
 import email.parser
 import email.utils
 import errno
@@ -15,6 +16,7 @@ import re
 import StringIO
 import threading
 import traceback
+from collections import OrderedDict
 from email import encoders
 from email.mime.base import MIMEBase
 from email.mime.image import MIMEImage
@@ -189,31 +191,113 @@ def MakeContentID():
         return '{0:x}'.format(GLOBAL_CONTENT_ID)
 
 
-GLOBAL_PARSE_CACHE_LOCK = MboxLock()
-GLOBAL_PARSE_CACHE = []
+class ParseCache(object):
+    """
+    An LRU cache of parsed messages, bounded by their approximate size.
+
+    Entries are keyed by (cache_id, pgpmime), so the raw and the decrypted
+    versions of a message are cached (and evicted) separately.
+    """
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self.lock = MboxRLock()
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, cache_id, pgpmime):
+        with self.lock:
+            key = (cache_id, pgpmime)
+            if key in self.entries:
+                self.hits += 1
+                self.entries[key] = self.entries.pop(key)  # Most recent
+                return self.entries[key][1]
+            self.misses += 1
+            return None
+
+    def put(self, cache_id, pgpmime, message):
+        size = ApproxMessageSize(message)
+        with self.lock:
+            self._remove((cache_id, pgpmime))
+            if size > self.max_bytes:
+                return
+            while self.entries and self.bytes + size > self.max_bytes:
+                self._remove(self.entries.iterkeys().next())
+                self.evictions += 1
+            self.entries[(cache_id, pgpmime)] = (size, message)
+            self.bytes += size
+
+    def replace(self, cache_id, pgpmime, message):
+        """Replace a message, but only if it is already in the cache."""
+        with self.lock:
+            if (cache_id, pgpmime) in self.entries:
+                self.put(cache_id, pgpmime, message)
+
+    def _remove(self, key):
+        if key in self.entries:
+            self.bytes -= self.entries.pop(key)[0]
+
+    def clear(self, cache_id=None, pgpmime=False, full=False):
+        with self.lock:
+            for key in self.entries.keys():
+                if (full or
+                        (pgpmime and key[1]) or
+                        (cache_id is not None and key[0] == cache_id)):
+                    self._remove(key)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+
+def ApproxMessageSize(message):
+    """Estimate how much memory a parsed message uses."""
+    size = 0
+    for part in message.walk():
+        size += sum(len(h) + len(v) for h, v in part.items())
+        payload = part.get_payload()
+        if isinstance(payload, (str, unicode)):
+            size += len(payload)
+    return size
+
+
+def CopyMessageTree(message):
+    """
+    Copy the MIME structure of a message, sharing the (immutable) header
+    and payload strings with the original. This is all UnwrapMimeCrypto
+    needs to leave the original intact, and is far cheaper than a deepcopy
+    of a large message.
+    """
+    clone = copy.copy(message)
+    clone._headers = list(message._headers)
+    if message.is_multipart():
+        clone._payload = [CopyMessageTree(p) for p in message.get_payload()]
+    return clone
+
+
+GLOBAL_PARSE_CACHE = ParseCache()
+
 
 def ClearParseCache(cache_id=None, pgpmime=False, full=False):
-    global GLOBAL_PARSE_CACHE
-    with GLOBAL_PARSE_CACHE_LOCK:
-        GPC = GLOBAL_PARSE_CACHE
-        for i in range(0, len(GPC)):
-            if (full or
-                    (pgpmime and GPC[i][1]) or
-                    (cache_id and GPC[i][0] == cache_id)):
-                GPC[i] = (None, None, None)
+    GLOBAL_PARSE_CACHE.clear(cache_id=cache_id, pgpmime=pgpmime, full=full)
 
 
 def ParseMessage(fd, cache_id=None, update_cache=False,
                      pgpmime=True, config=None, event=None):
-    global GLOBAL_PARSE_CACHE
     if not GnuPG:
         pgpmime = False
 
     if cache_id is not None and not update_cache:
-        with GLOBAL_PARSE_CACHE_LOCK:
-            for cid, pm, message in GLOBAL_PARSE_CACHE:
-                if cid == cache_id and pm == pgpmime:
-                    return message
+        message = GLOBAL_PARSE_CACHE.get(cache_id, pgpmime)
+        if message is not None:
+            return message
 
     if pgpmime:
         message = ParseMessage(fd, cache_id=cache_id,
@@ -224,7 +308,7 @@ def ParseMessage(fd, cache_id=None, update_cache=False,
         if cache_id is not None:
             # Caching is enabled, let's not clobber the encrypted version
             # of this message with a fancy decrypted one.
-            message = copy.deepcopy(message)
+            message = CopyMessageTree(message)
         def MakeGnuPG(*args, **kwargs):
             ev = event or GetThreadEvent()
             if ev and 'event' not in kwargs:
@@ -249,10 +333,55 @@ def ParseMessage(fd, cache_id=None, update_cache=False,
             part.encryption_info = EncryptionInfo(parent=mei)
 
     if cache_id is not None:
-        with GLOBAL_PARSE_CACHE_LOCK:
-            # Keep 25 items, put new ones at the front
-            GLOBAL_PARSE_CACHE[24:] = []
-            GLOBAL_PARSE_CACHE[:0] = [(cache_id, pgpmime, message)]
+        GLOBAL_PARSE_CACHE.put(cache_id, pgpmime, message)
+
+    return message
+
+
+HEADER_NAME_RE = re.compile(r'^[\041-\071\073-\176]+:')
+
+
+def ParseHeaders(data):
+    """
+    Parse the header block at the start of a message (stopping at the
+    first blank line) and return a payload-less email.message.Message.
+    This skips all the MIME work done by ParseMessage, which makes it
+    much cheaper when all we need are headers like Date, From, To, Cc,
+    Subject, Message-ID and References.
+
+    >>> msg = ParseHeaders('From bre@example.com Mon Jan  1 00:00:00 2014\\r\\n'
+    ...                    'Subject: Hello\\r\\n  world\\r\\n'
+    ...                    'To: bre@example.com\\r\\n\\r\\nTo: body@example.com')
+    >>> msg['subject'], msg['to'], msg.get_unixfrom()[:9]
+    ('Hello\\n  world', 'bre@example.com', 'From bre@')
+    >>> ParseHeaders('Bogus line\\nTo: bre@example.com\\n').keys()
+    []
+    """
+    message = email.message.Message()
+    message.signature_info = SignatureInfo(bubbly=False)
+    message.encryption_info = EncryptionInfo(bubbly=False)
+
+    lines = data.split('\n')
+    if lines[0].startswith('From '):
+        message.set_unixfrom(lines.pop(0).rstrip('\r'))
+
+    header, value = None, []
+    for line in lines:
+        line = line.rstrip('\r')
+        if line[:1] in (' ', '\t'):
+            if header is not None:
+                value.append(line)
+            continue
+        if header is not None:
+            message[header] = '\n'.join(value)
+            header = None
+        if not HEADER_NAME_RE.match(line):
+            # Blank line (or garbage): the headers are over.
+            break
+        header, val = line.split(':', 1)
+        value = [val.lstrip()]
+    if header is not None:
+        message[header] = '\n'.join(value)
 
     return message
 
@@ -886,11 +1015,7 @@ class Email(object):
 
     def update_parse_cache(self, newmsg):
         if self.msg_idx_pos >= 0 and not self.ephemeral_mid:
-            with GLOBAL_PARSE_CACHE_LOCK:
-                GPC = GLOBAL_PARSE_CACHE
-                for i in range(0, len(GPC)):
-                    if GPC[i][0] == self.msg_idx_pos:
-                        GPC[i] = (self.msg_idx_pos, False, newmsg)
+            GLOBAL_PARSE_CACHE.replace(self.msg_idx_pos, False, newmsg)
 
     def clear_from_parse_cache(self):
         if self.msg_idx_pos >= 0 and not self.ephemeral_mid:
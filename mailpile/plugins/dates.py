@@ -1,5 +1,6 @@
-import time
+import calendar
 import datetime
+import time
 
 from mailpile.plugins import PluginManager
 from mailpile.i18n import gettext as _
@@ -47,6 +48,40 @@ _date_offsets = {
 }
 
 
+def _keyword_terms(start, end):
+    terms = []
+    while start <= end:
+        # Move forward one year?
+        if start[1:] == [1, 1]:
+            ny = [start[0], 12, 31]
+            if ny <= end:
+                terms.append('{0:d}:year'.format(start[0]))
+                start[0] += 1
+                continue
+
+        # Move forward one month?
+        if start[2] == 1:
+            nm = [start[0], start[1], 31]
+            if nm <= end:
+                terms.append('{0:d}-{1:d}:yearmonth'.format(start[0], start[1]))
+                start[1] += 1
+                _adjust(start)
+                continue
+
+        # Move forward one day...
+        terms.append('{0:d}-{1:d}-{2:d}:date'.format(*tuple(start)))
+        start[2] += 1
+        _adjust(start)
+    return terms
+
+
+def _day_ts(ymd, days=0):
+    year, month, day = ymd
+    day = min(day, calendar.monthrange(year, month)[1])
+    mdate = datetime.date(year, month, day) + datetime.timedelta(days=days)
+    return long(time.mktime(mdate.timetuple()))
+
+
 def search(config, idx, term, hits):
     try:
         word = term.split(':', 1)[1].lower()
@@ -71,37 +106,25 @@ def search(config, idx, term, hits):
         if not start <= end:
             raise ValueError()
 
-        terms = []
-        while start <= end:
-            # Move forward one year?
-            if start[1:] == [1, 1]:
-                ny = [start[0], 12, 31]
-                if ny <= end:
-                    terms.append('{0:d}:year'.format(start[0]))
-                    start[0] += 1
-                    continue
-
-            # Move forward one month?
-            if start[2] == 1:
-                nm = [start[0], start[1], 31]
-                if nm <= end:
-                    terms.append('{0:d}-{1:d}:yearmonth'.format(start[0], start[1]))
-                    start[1] += 1
-                    _adjust(start)
-                    continue
-
-            # Move forward one day...
-            terms.append('{0:d}-{1:d}-{2:d}:date'.format(*tuple(start)))
-            start[2] += 1
-            _adjust(start)
-
-        rt = []
-        for t in terms:
-            rt.extend(hits(t))
-        return rt
+        if getattr(hits, 'keywords', None) is not None:
+            # Matching against a single message's keywords (filters)
+            rt = []
+            for t in _keyword_terms(start, end):
+                rt.extend(hits(t))
+            return rt
+
+        # Searching the index: use the date column directly
+        return idx.search_range('date',
+                                _day_ts(start), _day_ts(end, days=1) - 1)
     except:
         raise ValueError('Invalid date range: {0!s}'.format(term))
 
 
+def year_search(config, idx, term, hits):
+    year = term.split(':', 1)[1]
+    return search(config, idx, 'dates:{0!s}'.format(year), hits)
+
+
 _plugins.register_search_term('dates', search)
 _plugins.register_search_term('date', search)
+_plugins.register_search_term('year', year_search)
@@ -9,7 +9,9 @@ from mailpile.i18n import ngettext as _n
 from mailpile.mailutils import Email, FormatMbxId
 from mailpile.mailutils import ExtractEmails, ExtractEmailAndName
 from mailpile.plugins import PluginManager
-from mailpile.search import MailIndex
+from mailpile.search import MailIndex, SearchCancelled
+from mailpile.search_query import Tokenize, IsOperator as IsQueryOperator
+from mailpile.tokenizer import Words
 from mailpile.urlmap import UrlMap
 from mailpile.util import *
 from mailpile.ui import SuppressHtmlOutput
@@ -34,12 +36,18 @@ class Search(Command):
         'end': 'end position',
         'full': 'return all metadata',
         'view': 'MID/MID pairs to expand in place',
-        'context': 'refine or redisplay an older search'
+        'context': 'refine or redisplay an older search',
+        'stream': 'pages of results to stream (see search/stream)'
     }
     IS_USER_ACTIVITY = True
     COMMAND_CACHE_TTL = 900
     CHANGES_SESSION_CONTEXT = True
 
+    # Streaming searches in progress, by event ID, so they can be fetched
+    # and cancelled by whoever started them. Only streaming searches can
+    # be cancelled; ordinary searches run to completion.
+    STREAMING = {}
+
     class CommandResult(Command.CommandResult):
         def __init__(self, *args, **kwargs):
             Command.CommandResult.__init__(self, *args, **kwargs)
@@ -81,6 +89,43 @@ class Search(Command):
         self._email_views = []
         self._email_view_pairs = {}
         self._emails = []
+        self._stream_pages = 0
+        self._streamed = []
+        self._cancelled = False
+        self._owner = None
+
+    @classmethod
+    def _SessionOwner(cls, session):
+        # Each HTTP request gets a Session of its own, so browsers are
+        # identified by their HTTP session ID instead.
+        return session.ui.html_variables.get('http_session') or session
+
+    @classmethod
+    def _OwnStreaming(cls, session, event_id):
+        search = cls.STREAMING.get(event_id)
+        if (search is not None and
+                search._owner == cls._SessionOwner(session)):
+            return search
+        return None
+
+    @classmethod
+    def StreamedPages(cls, session, event_id):
+        """
+        Return the pages streamed so far, or None if this session is not
+        running a streaming search with that event ID.
+        """
+        search = cls._OwnStreaming(session, event_id)
+        if search is not None:
+            return search._streamed
+        return None
+
+    @classmethod
+    def CancelStreaming(cls, session, event_id):
+        search = cls._OwnStreaming(session, event_id)
+        if search is not None:
+            search._cancelled = True
+            return True
+        return False
 
     def state_as_query_args(self):
         try:
@@ -97,6 +142,10 @@ class Search(Command):
         self._email_view_pairs = dict((m.split('/')[0], m.split('/')[-1])
                                       for m in self._email_views)
         self._emails = []
+        try:
+            self._stream_pages = max(0, int(self.data.get('stream', [0])[0]))
+        except ValueError:
+            raise UsageError(_('Bad number of pages to stream'))
 
         self.context = self.data.get('context', [None])[0]
         if self.context:
@@ -183,8 +232,13 @@ class Search(Command):
             session.searched = search or []
             if search is None or process_args:
                 prefix = ''
-                for arg in self._search_args:
-                    if arg.endswith(':'):
+                args = Tokenize(self._search_args)
+                for pos, arg in enumerate(args):
+                    if IsQueryOperator(arg) or arg in ('+', '-'):
+                        session.searched.append(arg)
+                    elif arg.endswith(':') and args[pos+1:pos+2] == ['(']:
+                        session.searched.append(arg.lower())
+                    elif arg.endswith(':'):
                         prefix = arg
                     elif ':' in arg or (arg and arg[0] in ('-', '+')):
                         if not arg.startswith('vfs:'):
@@ -194,17 +248,28 @@ class Search(Command):
                     elif prefix and '@' in arg:
                         session.searched.append(prefix + arg.lower())
                     else:
-                        words = re.findall(WORD_REGEXP, arg.lower())
+                        # Only lowercase; MailIndex.search() takes care of
+                        # folding, and of matching mail indexed without.
+                        words = Words(arg, fold=False)
                         session.searched.extend([prefix + word
                                                  for word in words])
             if not session.searched:
                 session.searched = ['all:mail']
 
             context = session.results if self.context else None
+            cancel = (lambda: self._cancelled) if self._stream_pages else None
             session.results = list(idx.search(session, session.searched,
-                                              context=context).as_set())
+                                              context=context,
+                                              cancel=cancel).as_set())
+            if self._stream_pages:
+                self._stream_results(idx, idx.sort_results_head(
+                    session, session.results, session.order,
+                    self._start + self._num, cancel=cancel), pages=1)
             if session.order:
-                idx.sort_results(session, session.results, session.order)
+                idx.sort_results(session, session.results, session.order,
+                                 cancel=cancel)
+            if self._stream_pages:
+                self._stream_results(idx, session.results)
 
         self._emails = []
         pivot_pos = any_pos = len(session.results)
@@ -240,8 +305,37 @@ class Search(Command):
 
         return session, idx
 
+    def _stream_results(self, idx, results, pages=None):
+        """
+        Prepare pages of results which clients of the async API can fetch
+        (using search/stream) and render before the search completes. The
+        event log only learns how many pages are ready.
+        """
+        full_threads = self.data.get('full', False)
+        pages = min(pages or self._stream_pages, self._stream_pages)
+        stream = []
+        for page in range(0, pages):
+            start = self._start + page * self._num
+            if page and start >= len(results):
+                break
+            stream.append(SearchResults(self.session, idx,
+                                        results=results,
+                                        start=start,
+                                        num=self._num,
+                                        full_threads=full_threads))
+        self._streamed = stream
+        self._update_stream_state(pages=len(stream))
+
+    def _update_stream_state(self, pages=0, total=None, complete=False):
+        self.event.data['stream'] = {
+            'pages': pages,
+            'total': total,
+            'complete': complete
+        }
+        self._update_event_state(self.event.RUNNING, log=True)
+
     def cache_id(self, *args, **kwargs):
-        if self._emails:
+        if self._emails or self._stream_pages:
             return ''
         return Command.cache_id(self, *args, **kwargs)
 
@@ -266,7 +360,23 @@ class Search(Command):
         return reqs
 
     def command(self):
-        session, idx = self._do_search()
+        if self._stream_pages:
+            self._owner = self._SessionOwner(self.session)
+            self.STREAMING[self.event.event_id] = self
+        try:
+            session, idx = self._do_search()
+        except SearchCancelled:
+            return self._error(_('Search cancelled'))
+        finally:
+            if self._stream_pages:
+                # The final results are returned below, so the streamed
+                # pages are no longer needed.
+                del self.STREAMING[self.event.event_id]
+                self._streamed = []
+        if self._stream_pages:
+            self._update_stream_state(total=len(session.results),
+                                      complete=True)
+
         full_threads = self.data.get('full', False)
         session.displayed = SearchResults(session, idx,
                                           start=self._start,
@@ -425,6 +535,44 @@ class View(Search):
                                  result=results)
 
 
+class StreamedSearch(Command):
+    """Fetch the results streamed so far by a streaming search"""
+    SYNOPSIS = (None, 'search/stream', 'search/stream', '<event-ID>')
+    ORDER = ('Searching', 9)
+    HTTP_CALLABLE = ('GET', )
+    HTTP_QUERY_VARS = {
+        'event_id': 'event ID of the streaming search'
+    }
+
+    def command(self):
+        event_ids = list(self.args) + self.data.get('event_id', [])
+        if len(event_ids) != 1:
+            raise UsageError(_('Please specify one event ID'))
+        pages = Search.StreamedPages(self.session, event_ids[0])
+        if pages is None:
+            return self._error(_('Not a streaming search: %s')
+                               % event_ids[0])
+        return self._success(_('Found %d pages of results') % len(pages),
+                             result=pages)
+
+
+class CancelSearch(Command):
+    """Cancel a streaming search (ordinary searches cannot be cancelled)"""
+    SYNOPSIS = (None, 'search/cancel', 'search/cancel', '<event-IDs>')
+    ORDER = ('Searching', 9)
+    HTTP_CALLABLE = ('POST', )
+    HTTP_POST_VARS = {
+        'event_id': 'event ID of the streaming search to cancel'
+    }
+
+    def command(self):
+        event_ids = list(self.args) + self.data.get('event_id', [])
+        cancelled = [e for e in event_ids
+                     if Search.CancelStreaming(self.session, e)]
+        return self._success(_('Cancelled %d searches') % len(cancelled),
+                             result=cancelled)
+
+
 class Extract(Command):
     """Extract attachment(s) to file(s)"""
     SYNOPSIS = ('e', 'extract', 'message/download', '<msgs> <att> [><fn>]')
@@ -499,7 +647,8 @@ class Extract(Command):
         return results
 
 
-_plugins.register_commands(Extract, Next, Order, Previous, Search, View)
+_plugins.register_commands(CancelSearch, Extract, Next, Order, Previous,
+                           Search, StreamedSearch, View)
 
 
 ##[ Search terms ]############################################################
@@ -75,11 +75,25 @@ def search(config, idx, term, hits):
 
         start = _mk_logsize(start, end_unit)
         end = _mk_logsize(end)
-        terms = ['{0!s}:ln2sz'.format(sz) for sz in range(start, end+1)]
 
+        if getattr(hits, 'keywords', None) is not None:
+            # Matching against a single message's keywords (filters)
+            rt = []
+            for sz in range(start, end+1):
+                rt.extend(hits('{0!s}:ln2sz'.format(sz)))
+            return rt
+
+        # Searching the index: use the size column (in KB) directly. The
+        # range covers whole log2 buckets, same as the :ln2sz keywords.
+        # Messages under 1KB (buckets 0-9) all have size 0 in the column,
+        # so for those we use the keywords, which are indexed for them.
         rt = []
-        for t in terms:
-            rt.extend(hits(t))
+        for sz in range(start, min(end, 9) + 1):
+            rt.extend(hits('{0!s}:ln2sz'.format(sz)))
+        if end >= 10:
+            rt.extend(idx.search_range('size',
+                                       (2 ** max(start, 10)) // 1024,
+                                       (2 ** (end + 1) - 1) // 1024))
         return rt
     except:
         raise ValueError('Invalid size: {0!s}'.format(term))
@@ -563,9 +563,7 @@ class ListTags(TagCommand):
         wanted.extend([t.lower() for t in self.data.get('only', [])])
         unwanted.extend([t.lower() for t in self.data.get('not', [])])
 
-        unread_messages = set()
-        for tag in self.session.config.get_tags(type='unread', default=[]):
-            unread_messages |= idx.TAGS.get(tag._key, set())
+        unread_messages = idx.get_unread_set()
 
         excluded_messages = set()
         for tag in self.session.config.get_tags(flag_hides=True, default=[]):
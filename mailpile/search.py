@@ -1,12 +1,15 @@
+import bisect
 import cStringIO
 import email
-import lxml.html
+import heapq
+import math
 import random
 import re
 import rfc822
 import time
 import threading
 import traceback
+from collections import OrderedDict
 from urllib import quote, unquote
 
 import mailpile.util
@@ -14,15 +17,23 @@ from mailpile.crypto.gpgi import GnuPG
 from mailpile.crypto.state import CryptoInfo, SignatureInfo, EncryptionInfo
 from mailpile.crypto.streamer import EncryptingStreamer
 from mailpile.eventlog import GetThreadEvent
+from mailpile.html_text import HtmlToText
 from mailpile.i18n import gettext as _
 from mailpile.i18n import ngettext as _n
+from mailpile.ingest import IngestPool
 from mailpile.plugins import PluginManager
 from mailpile.mailutils import decode_header
 from mailpile.mailutils import FormatMbxId, MBX_ID_LEN, NoSuchMailboxError
 from mailpile.mailutils import AddressHeaderParser, GetTextPayload
 from mailpile.mailutils import ExtractEmails, ExtractEmailAndName
-from mailpile.mailutils import Email, ParseMessage, HeaderPrint
+from mailpile.mailutils import Email, ParseMessage, ParseHeaders, HeaderPrint
 from mailpile.postinglist import GlobalPostingList
+from mailpile.search_query import Tokenize, Compile as CompileQuery
+from mailpile.search_query import Evaluate as EvaluateQuery
+from mailpile.search_query import Terms as QueryTerms
+from mailpile.search_query import PositiveTerms
+from mailpile.tokenizer import CaseFold, LowerCase, Words, TermCollector
+from mailpile.tokenizer import StripQuotes, StripSignature
 from mailpile.ui import *
 from mailpile.util import *
 from mailpile.vfs import vfs, FilePath
@@ -31,6 +42,10 @@ from mailpile.vfs import vfs, FilePath
 _plugins = PluginManager()
 
 
+class SearchCancelled(Exception):
+    """Raised when a cancellable search or sort is aborted."""
+
+
 class SearchResultSet:
     """
     Search results!
@@ -119,6 +134,34 @@ class MailIndex(object):
 
     MAX_INCREMENTAL_SAVES = 25
 
+    # How many messages scan_mailbox() hands the scan worker at once; lazy
+    # scans only read headers, so they can take bigger bites.
+    SCAN_BATCH_SIZE = 50
+    LAZY_SCAN_BATCH_SIZE = 500
+
+    # How many read_message() results to keep around for reuse
+    READ_CACHE_SIZE = 1000
+
+    # These keywords are still generated for use by filters, but searches
+    # for them are answered from the numeric sort columns (see search_range)
+    # so there is no need to write them to the posting lists. The size
+    # column is in KB though, so sizes below 1KB are still written.
+    COLUMN_KEYWORDS = (':year', ':yearmonth', ':date', ':ln2sz')
+    SUB_KB_KEYWORDS = frozenset(['{0:d}:ln2sz'.format(i)
+                                 for i in range(0, 10)])
+
+    # Words which occur more than once in a message also get a word:tfN
+    # keyword, where N is log2 of the term frequency (capped), so the
+    # relevance ranking can tell a passing mention from the main topic.
+    # Only the most frequent words of each message get one, so these add
+    # at most TERM_FREQ_WORDS entries per message to the posting lists.
+    TERM_FREQ_MAX = 6
+    TERM_FREQ_WORDS = 32
+
+    # BM25 tuning parameters for the relevance sort order
+    BM25_K1 = 1.2
+    BM25_B = 0.75
+
     def __init__(self, config):
         self.config = config
         self.interrupt = None
@@ -127,13 +170,21 @@ class MailIndex(object):
         self.INDEX_THR = []
         self.PTRS = {}
         self.TAGS = {}
+        self.UNREAD = frozenset()  # See get_unread_set()
+        self.ME = {}
+        self.MAGIC = {}
         self.MSGIDS = {}
         self.EMAILS = []
         self.EMAIL_IDS = {}
         self.CACHE = {}
         self.MODIFIED = set()
         self.EMAILS_SAVED = 0
+        self._unsized = set()
+        self._loading = False
         self._scanned = {}
+        self._read_cache = OrderedDict()
+        self._me_emails = None
+        self._magic_epoch = None
         self._saved_changes = 0
         self._lock = SearchRLock()
         self._save_lock = SearchRLock()
@@ -212,6 +263,8 @@ class MailIndex(object):
         self.MSGIDS = {}
         self.EMAILS = []
         self.EMAIL_IDS = {}
+        self._unsized = set()
+        self.UNREAD = frozenset()
         CachedSearchResultSet.DropCaches()
         bogus_lines = []
 
@@ -232,7 +285,7 @@ class MailIndex(object):
                     except (ValueError, IndexError, TypeError):
                         bogus_lines.append(line)
                 else:
-                    bogus = False
+                    bogus = unsized = False
                     words = line.split('\t')
 
                     # Migration: converting old metadata into new!
@@ -242,6 +295,7 @@ class MailIndex(object):
                         if len(words) == self.MSG_FIELDS_V1:
                             words[self.MSG_CC:self.MSG_CC] = ['']
                             words[self.MSG_KB:self.MSG_KB] = ['0']
+                            unsized = True  # See backfill_msg_sizes()
 
                         # Add V2 -> V3 here, etc. etc.
 
@@ -255,6 +309,8 @@ class MailIndex(object):
                             pos = int(words[self.MSG_MID], 36)
                             self.set_msg_at_idx_pos(pos, words,
                                                     original_line=line)
+                            if unsized:
+                                self._unsized.add(pos)
                             if session and len(self.INDEX) % 107 == 100:
                                 session.ui.mark(
                                     _('Loading metadata index...') +
@@ -277,6 +333,9 @@ class MailIndex(object):
         try:
             import mailpile.mail_source
             with self._save_lock, self._lock:
+                # The unread set is built once we are done, not one
+                # frozenset copy per message.
+                self._loading = True
                 with open(self.config.mailindex_file(), 'r') as fd:
                     # We don't raise on errors, in case only some of the chunks
                     # are corrupt - we want to read the rest of them.
@@ -294,6 +353,10 @@ class MailIndex(object):
             if session:
                 session.ui.warning(_('Metadata index not found: %s'
                                      ) % self.config.mailindex_file())
+        finally:
+            with self._lock:
+                self._loading = False
+                self._rebuild_unread()
 
         session.ui.mark(_('Loading global posting list...'))
         GlobalPostingList(session, '')
@@ -314,6 +377,26 @@ class MailIndex(object):
                                ) % len(self.INDEX))
         self.EMAILS_SAVED = len(self.EMAILS)
 
+    def backfill_msg_sizes(self, session):
+        """
+        Messages migrated from V1 metadata have a size of 0, as V1 did not
+        record sizes. This looks up their real sizes, so size: searches
+        (which use the size column) find them.
+        """
+        while self._unsized and not mailpile.util.QUITTING:
+            with self._lock:
+                msg_idx = self._unsized.pop()
+            try:
+                msg_size = Email(self, msg_idx).get_msg_size()
+            except (IOError, OSError, ValueError, IndexError, KeyError,
+                    NoSuchMailboxError):
+                continue
+            with self._lock:
+                msg_info = self.get_msg_at_idx_pos(msg_idx)
+                self.edit_msg_info(msg_info, msg_size=msg_size)
+                self.set_msg_at_idx_pos(msg_idx, msg_info)
+            play_nice_with_threads()
+
     def update_msg_tags(self, msg_idx_pos, msg_info):
         tags = set(self.get_tags(msg_info=msg_info))
         with self._lock:
@@ -323,6 +406,14 @@ class MailIndex(object):
                 if tid not in self.TAGS:
                     self.TAGS[tid] = set()
                 self.TAGS[tid].add(msg_idx_pos)
+            if self._loading:
+                return
+            unread = bool(tags & self._sort_freshness_tags)
+            if unread != (msg_idx_pos in self.UNREAD):
+                if unread:
+                    self.UNREAD = self.UNREAD | frozenset([msg_idx_pos])
+                else:
+                    self.UNREAD = self.UNREAD - frozenset([msg_idx_pos])
 
     def _maybe_encrypt(self, data):
         gpgr = self.config.prefs.gpg_recipient
@@ -678,7 +769,7 @@ class MailIndex(object):
     def scan_mailbox(self, session, mailbox_idx, mailbox_fn, mailbox_opener,
                      process_new=None, apply_tags=None, editable=False,
                      stop_after=None, deadline=None, reverse=False, lazy=False,
-                     event=None):
+                     event=None, changes=None):
         mailbox_idx = FormatMbxId(mailbox_idx)
         progress = self._get_scan_progress(mailbox_idx,
                                            event=event, reset=True)
@@ -713,8 +804,19 @@ class MailIndex(object):
             self.update_ptrs_and_msgids(session)
 
         existing_ptrs = set()
-        messages = sorted(mbox.keys())
-        messages_md5 = md5_hex(str(messages))
+        msg_ptrs = {}
+        if changes is not None:
+            # The caller knows exactly which keys came and went (thanks to
+            # inotify or similar), so there is no need to walk the whole
+            # mailbox. The added keys may also have gone away again.
+            added_keys, removed_keys = changes
+            present = set(mbox.keys())
+            messages = sorted(k for k in added_keys if k in present)
+            removed_keys = [k for k in removed_keys if k not in present]
+            messages_md5 = None
+        else:
+            messages = sorted(mbox.keys())
+            messages_md5 = md5_hex(str(messages))
         if messages_md5 == self._scanned.get(mailbox_idx, ''):
             return finito(0, _('%s: No new mail in: %s'
                                ) % (mailbox_idx, mailbox_fn),
@@ -735,10 +837,11 @@ class MailIndex(object):
 
         # Figure out which messages exist at all (so we can remove
         # stale pointers later on).
-        if not lazy:
+        if not lazy and changes is None:
             for ui in range(0, len(messages)):
                 msg_ptr = mbox.get_msg_ptr(mailbox_idx, messages[ui])
                 existing_ptrs.add(msg_ptr)
+                msg_ptrs[messages[ui]] = msg_ptr
                 if (ui % 317) == 0 and not deadline:
                     play_nice_with_threads()
 
@@ -747,10 +850,39 @@ class MailIndex(object):
         not_done_yet = 'NOT DONE YET'
         if reverse:
             messages.reverse()
+
+        def scan_batch(batch, last_date):
+            try:
+                return self.scan_messages(session, mailbox_idx, mbox, batch,
+                                          wait=True,
+                                          deadline=(deadline and
+                                                    start_time + deadline),
+                                          last_date=last_date,
+                                          process_new=process_new,
+                                          apply_tags=apply_tags,
+                                          stop_after=stop_after,
+                                          editable=editable,
+                                          event=event,
+                                          progress=progress,
+                                          lazy=lazy)
+            except TypeError:
+                return last_date, 0, 0, True
+
+        # Parse messages in parallel, if so configured
+        pool = None
+        processes = session.config.sys.ingest_processes
+        if processes > 0 and not lazy:
+            # Note: This starts no workers until there is something to parse
+            pool = IngestPool(session, processes)
+
+        batch = []
+        batch_size = lazy and self.LAZY_SCAN_BATCH_SIZE or self.SCAN_BATCH_SIZE
         for ui in range(0, len(messages)):
             play_nice_with_threads(weak=True)
             if mailpile.util.QUITTING or self.interrupt:
                 self.interrupt = None
+                if pool is not None:
+                    pool.close()
                 return finito(-1, _('Rescan interrupted: %s'
                                     ) % self.interrupt)
             if stop_after and added >= stop_after:
@@ -761,7 +893,7 @@ class MailIndex(object):
                 break
 
             i = messages[ui]
-            msg_ptr = mbox.get_msg_ptr(mailbox_idx, i)
+            msg_ptr = msg_ptrs.get(i) or mbox.get_msg_ptr(mailbox_idx, i)
             if msg_ptr in self.PTRS:
                 if (ui % 317) == 0:
                     session.ui.mark(parse_status(ui))
@@ -776,26 +908,46 @@ class MailIndex(object):
                 session.ui.mark(parse_status(ui))
 
             # Message new or modified, let's parse it.
+            if pool is None:
+                batch.append((i, msg_ptr, None))
+            else:
+                pool.submit(i, msg_ptr, self._read_raw_message(mbox, i))
+                batch.extend(pool.collect(wait=pool.full()))
+
+            # Hand the scan worker a batch at a time; if it stops early
+            # the checks at the top of the loop will tell us why.
+            if (len(batch) >= batch_size or
+                    (stop_after and added + len(batch) >= stop_after)):
+                last_date, a, u, complete = scan_batch(batch, last_date)
+                added += a
+                updated += u
+                batch = []
+                if not complete:
+                    messages_md5 = not_done_yet
+
+        if pool is not None:
             try:
-                last_date, a, u = self.scan_one_message(session,
-                                                        mailbox_idx, mbox, i,
-                                                        wait=True,
-                                                        msg_ptr=msg_ptr,
-                                                        last_date=last_date,
-                                                        process_new=process_new,
-                                                        apply_tags=apply_tags,
-                                                        stop_after=stop_after,
-                                                        editable=editable,
-                                                        event=event,
-                                                        progress=progress,
-                                                        lazy=lazy)
-            except TypeError:
-                a = u = 0
-
+                batch.extend(pool.collect(wait='all'))
+            finally:
+                pool.close()
+        if batch:
+            last_date, a, u, complete = scan_batch(batch, last_date)
             added += a
             updated += u
+            if not complete:
+                messages_md5 = not_done_yet
 
-        if not lazy:
+        if not lazy and changes is not None:
+            with self._lock:
+                for key in removed_keys:
+                    try:
+                        msg_ptr = mbox.get_msg_ptr(mailbox_idx, key)
+                    except (KeyError, IndexError, ValueError):
+                        continue
+                    if msg_ptr in self.PTRS:
+                        self._remove_location(session, msg_ptr)
+                        updated += 1
+        elif not lazy:
             with self._lock:
                 for msg_ptr in self.PTRS.keys():
                     if (msg_ptr[:MBX_ID_LEN] == mailbox_idx and
@@ -809,7 +961,18 @@ class MailIndex(object):
         if not deadline:
             play_nice_with_threads()
 
-        self._scanned[mailbox_idx] = messages_md5
+        if changes is None and not lazy:
+            self._scanned[mailbox_idx] = messages_md5
+        else:
+            # The mailbox no longer matches whatever we saw last time, or
+            # (lazy scans) the message bodies still need indexing.
+            self._scanned.pop(mailbox_idx, None)
+        if lazy and added:
+            self._schedule_body_scan(session, mailbox_idx, mailbox_fn,
+                                     mailbox_opener,
+                                     process_new=process_new,
+                                     apply_tags=apply_tags,
+                                     editable=editable)
         short_fn = '/'.join(mailbox_fn.split('/')[-2:])
         return finito(added,
                       _('%s: Indexed mailbox: ...%s (%d new, %d updated)'
@@ -818,6 +981,76 @@ class MailIndex(object):
                       updated=updated,
                       complete=(messages_md5 != not_done_yet))
 
+    def _schedule_body_scan(self, session, mailbox_idx, mailbox_fn,
+                            mailbox_opener, **kwargs):
+        """
+        Lazy scans only index headers; this schedules a full (non-lazy)
+        rescan on the slow worker, which indexes the message bodies once
+        the app is otherwise idle.
+        """
+        config = session.config
+        if config.slow_worker == config.dumb_worker:
+            # No background workers, this would block the lazy scan.
+            return
+        bg_session = config.background or session
+        config.slow_worker.add_unique_task(
+            bg_session, 'index_bodies:{0!s}'.format(mailbox_idx),
+            lambda: self.scan_mailbox(bg_session, mailbox_idx, mailbox_fn,
+                                      mailbox_opener, **kwargs))
+
+    def _read_raw_message(self, mbox, msg_mbox_key):
+        try:
+            return mbox.get_file(msg_mbox_key).read()
+        except (IOError, OSError, ValueError, IndexError, KeyError):
+            # Returning None makes _real_scan_one try and report the error
+            return None
+
+    def scan_messages(self, session, mailbox_idx, mbox, batch,
+                      wait=False, **kwargs):
+        """
+        Scan a batch of (msg_mbox_key, msg_ptr, ingested) messages in a
+        single scan worker task. Returns (last_date, added, updated,
+        complete), where complete is False if the batch was cut short.
+        """
+        args = [session, mailbox_idx, mbox, batch]
+        task = 'scan:{0!s}/{1!s}+{2:d}'.format(mailbox_idx, batch[0][0],
+                                               len(batch))
+        if wait:
+            return session.config.scan_worker.do(
+                session, task, lambda: self._real_scan_batch(*args, **kwargs))
+        else:
+            session.config.scan_worker.add_task(
+                session, task, lambda: self._real_scan_batch(*args, **kwargs))
+            return 0, 0, 0, False
+
+    def _real_scan_batch(self, session, mailbox_idx, mbox, batch,
+                         last_date=None, deadline=None, **kwargs):
+        added = updated = 0
+        headers = {}
+        if kwargs.get('lazy'):
+            # Read all the headers in one go, sequentially if possible
+            try:
+                headers = dict(mbox.get_header_bytes([b[0] for b in batch]))
+            except (AttributeError, IOError, OSError, ValueError):
+                if session.config.sys.debug:
+                    traceback.print_exc()
+        for msg_mbox_key, msg_ptr, ingested in batch:
+            if (mailpile.util.QUITTING or self.interrupt or
+                    (deadline and time.time() > deadline)):
+                return last_date, added, updated, False
+            last_date, a, u = self._real_scan_one(session,
+                                                  mailbox_idx, mbox,
+                                                  msg_mbox_key,
+                                                  msg_ptr=msg_ptr,
+                                                  ingested=ingested,
+                                                  msg_headers=headers.get(
+                                                      msg_mbox_key),
+                                                  last_date=last_date,
+                                                  **kwargs)
+            added += a
+            updated += u
+        return last_date, added, updated, True
+
     def scan_one_message(self, session, mailbox_idx, mbox, msg_mbox_key,
                          wait=False, **kwargs):
         args = [session, mailbox_idx, mbox, msg_mbox_key]
@@ -833,7 +1066,7 @@ class MailIndex(object):
     def _real_scan_one(self, session,
                        mailbox_idx, mbox, msg_mbox_idx,
                        msg_ptr=None, msg_data=None, msg_metadata_kws=None,
-                       last_date=None,
+                       ingested=None, msg_headers=None, last_date=None,
                        process_new=None, apply_tags=None, stop_after=None,
                        editable=False, event=None, progress=None,
                        lazy=False):
@@ -845,25 +1078,33 @@ class MailIndex(object):
 
         if 'rescan' in session.config.sys.debug:
             session.ui.debug('Reading message {0!s}/{1!s}'.format(mailbox_idx, msg_mbox_idx))
+        msg = None
         try:
-            if msg_data:
+            if ingested:
+                # The IngestPool read the body, we only need the headers
+                msg = ingested.message()
+                msg_bytes = ingested.msg_bytes
+                msg_metadata_kws = mbox.get_metadata_keywords(msg_mbox_idx)
+            elif msg_data:
                 msg_fd = cStringIO.StringIO(msg_data)
                 msg_metadata_kws = msg_metadata_kws or []
             elif lazy:
-                msg_data = mbox.get_bytes(msg_mbox_idx, 10240)
-                msg_data = msg_data.split('\r\n\r\n')[0].split('\n\n')[0]
-                msg_fd = cStringIO.StringIO(msg_data)
+                # Lazy scans only need the headers, skip the MIME parser
+                if msg_headers is None:
+                    msg_headers = mbox.get_bytes(msg_mbox_idx, 10240)
+                msg = ParseHeaders(msg_headers)
                 msg_bytes = mbox.get_msg_size(msg_mbox_idx)
                 msg_metadata_kws = mbox.get_metadata_keywords(msg_mbox_idx)
             else:
                 msg_fd = mbox.get_file(msg_mbox_idx)
                 msg_metadata_kws = mbox.get_metadata_keywords(msg_mbox_idx)
 
-            msg = ParseMessage(msg_fd,
-                               pgpmime=session.config.prefs.index_encrypted,
-                               config=session.config)
-            if not lazy:
-                msg_bytes = msg_fd.tell()
+            if msg is None:
+                msg = ParseMessage(msg_fd,
+                                   pgpmime=session.config.prefs.index_encrypted,
+                                   config=session.config)
+                if not lazy:
+                    msg_bytes = msg_fd.tell()
 
         except (IOError, OSError, ValueError, IndexError, KeyError):
             if session.config.sys.debug:
@@ -890,7 +1131,7 @@ class MailIndex(object):
                 session, msg_id, msg_ptr, msg_bytes,
                 msg, msg_metadata_kws,
                 last_date + 1, mailbox_idx, process_new, apply_tags,
-                lazy_body, msg_info)
+                lazy_body, msg_info, ingested=ingested)
             last_date = long(msg_info[self.MSG_DATE], 36)
             added += 1
 
@@ -938,11 +1179,16 @@ class MailIndex(object):
     def _extract_info_and_index(self, session, mailbox_idx,
                                 msg_mid, msg_id,
                                 msg_size, msg, msg_metadata_kws,
-                                default_date,
+                                default_date, ingested=None,
                                 **index_kwargs):
 
         msg_ts = self._extract_date_ts(session, msg_mid, msg_id, msg,
                                        default_date)
+        if ingested:
+            # A worker read the body; add what depends on the index here.
+            index_kwargs['parsed'] = self._read_message_meta(
+                msg_mid, msg_id, msg, msg_size, msg_ts,
+                ingested.keywords, ingested.body_info, mailbox=mailbox_idx)
 
         msg_to, msg_cc, msg_subj = self._extract_header_info(msg)
 
@@ -967,7 +1213,7 @@ class MailIndex(object):
                                 msg_id, msg_ptr, msg_size,
                                 msg, msg_metadata_kws, default_date,
                                 mailbox_idx, process_new, apply_tags,
-                                lazy_body, msg_info):
+                                lazy_body, msg_info, ingested=None):
         if lazy_body:
             msg_ts = self._extract_date_ts(session, 'new', msg_id, msg,
                                            default_date)
@@ -977,6 +1223,13 @@ class MailIndex(object):
                 self.hdr(msg, 'from'), msg_to, msg_cc, msg_size, msg_subj,
                 lazy_body, [])
 
+            # Index what the headers tell us, so the message can already
+            # be found by sender, subject etc. until the body is scanned.
+            self._index_keywords(
+                session, b36(msg_idx_pos),
+                set(self._read_message_headers(msg, {})) - STOPLIST,
+                compact=False)
+
         else:
             # If necessary, add the message to the index so we can index
             # terms to the right MID.
@@ -996,6 +1249,7 @@ class MailIndex(object):
                                               msg_mid, msg_id, msg_size,
                                               msg, msg_metadata_kws,
                                               default_date,
+                                              ingested=ingested,
                                               process_new=process_new,
                                               apply_tags=apply_tags,
                                               incoming=True)
@@ -1399,17 +1653,74 @@ class MailIndex(object):
                         (hdr == 'list-id' and 'list' not in body_info)):
                     body_info['list'] = word
                 words.append(word)
-                words.extend(re.findall(WORD_REGEXP, word))
+                words.extend(Words(word))
         return set(words)
 
     def read_message(self, session,
                      msg_mid, msg_id, msg, msg_size, msg_ts,
                      mailbox=None):
+        """
+        Extract the keywords and body info (snippet etc.) from a message.
+
+        Results are cached by message content (and ID and date), so that
+        work done while indexing can be reused by the autotagger and
+        friends, which read the same messages again from disk.
+        """
+        cache_key = self._read_cache_key(msg, msg_id, msg_ts)
+        with self._lock:
+            cached = self._read_cache.pop(cache_key, None)
+            if cached is not None:
+                self._read_cache[cache_key] = cached  # Most recently used
+        if cached is None:
+            cached = self._read_message(session, msg_mid, msg_id, msg,
+                                        msg_size, msg_ts)
+            # Encrypted messages may read differently later on (keys come
+            # and go), so those are not cached.
+            if cache_key and 'crypto:has' not in cached[0]:
+                with self._lock:
+                    self._read_cache[cache_key] = cached
+                    while len(self._read_cache) > self.READ_CACHE_SIZE:
+                        self._read_cache.popitem(last=False)
+
+        keywords, body_info = set(cached[0]), dict(cached[1])
+        if mailbox:
+            keywords.add('{0!s}:mailbox'.format(FormatMbxId(mailbox).lower()))
+        return keywords, body_info
+
+    def _read_cache_key(self, msg, msg_id, msg_ts):
+        # Hashing the raw headers and payloads is cheap compared to reading
+        # the message. Message IDs alone are not enough, as drafts keep
+        # theirs while being edited.
+        if not msg_id:
+            return None
+        try:
+            return (msg_id, msg_ts, md5_hex(str(msg.items()), *[
+                p.get_payload() for p in msg.walk() if not p.is_multipart()]))
+        except (TypeError, UnicodeError):
+            return None
+
+    def _read_message(self, session, msg_mid, msg_id, msg, msg_size, msg_ts):
+        keywords, body_info = self._read_message_content(
+            session, msg, session.config.sys.html_max_bytes,
+            session.config.sys.index_max_terms)
+        return self._read_message_meta(msg_mid, msg_id, msg, msg_size, msg_ts,
+                                       keywords, body_info)
+
+    def _read_message_content(self, session, msg, html_max, max_terms):
+        """
+        Extract the keywords and body info which depend only on the message
+        itself, not on the index or the rest of the app.
+
+        This is also used by ingestion worker processes, which have no
+        session: without one, messages which need GnuPG (or anything else
+        from the app) return (None, None) and get read by the parent.
+        """
         keywords = []
         snippet_text = snippet_html = ''
         body_info = {}
         payload = [None]
         textparts = 0
+        terms = TermCollector(max_terms=max_terms)
         for part in msg.walk():
             textpart = payload[0] = None
             ctype = part.get_content_type()
@@ -1429,17 +1740,7 @@ class MailIndex(object):
                     textparts += 1
 
             if ctype == 'text/html':
-                _loader(part)
-                if len(payload[0]) > 3:
-                    try:
-                        textpart = lxml.html.fromstring(payload[0]
-                                                        ).text_content()
-                    except:
-                        session.ui.warning(_('=%s/%s has bogus HTML.'
-                                             ) % (msg_mid, msg_id))
-                        textpart = payload[0]
-                else:
-                    textpart = payload[0]
+                textpart = HtmlToText(_loader(part), max_bytes=html_max)
 
             if 'pgp' in part.get_content_type().lower():
                 keywords.append('pgp:has')
@@ -1450,20 +1751,15 @@ class MailIndex(object):
                 att = self.try_decode(att, charset)
                 # FIXME: These should be tags!
                 keywords.append('attachment:has')
-                keywords.extend([t + ':att' for t
-                                 in re.findall(WORD_REGEXP, att.lower())])
+                keywords.extend([t + ':att' for t in Words(att)])
                 for kw, ext_list in ATT_EXTS.iteritems():
                     if att.lower().rsplit('.', 1)[-1] in ext_list:
                         keywords.append('{0!s}:has'.format(kw))
                 textpart = (textpart or '') + ' ' + att
 
             if textpart:
-                # FIXME: Does this lowercase non-ASCII characters correctly?
-                lines = [l for l in textpart.splitlines(True)
-                         if not l.startswith('>')
-                         and l[:4] not in ('----', '====', '____')]
-                keywords.extend(re.findall(WORD_REGEXP,
-                                           ''.join(lines).lower()))
+                text = StripQuotes(textpart)
+                keywords.extend(terms.words(StripSignature(text)))
 
                 # NOTE: As a side effect here, the cryptostate plugin will
                 #       add a 'crypto:has' keyword which we check for below
@@ -1473,7 +1769,7 @@ class MailIndex(object):
                                         body_info=body_info))
 
                 if ctype == 'text/plain':
-                    snippet_text += ''.join(lines).strip() + '\n'
+                    snippet_text += text.strip() + '\n'
                 else:
                     snippet_html += textpart.strip() + '\n'
 
@@ -1486,6 +1782,9 @@ class MailIndex(object):
             keywords.append('text:missing')
 
         if 'crypto:has' in keywords:
+            if session is None:
+                return None, None
+
             e = Email(self, -1,
                       msg_parsed=msg,
                       msg_parsed_pgpmime=msg,
@@ -1502,18 +1801,28 @@ class MailIndex(object):
             # Index the contents, if configured to do so
             if session.config.prefs.index_encrypted:
                 for text in [t['data'] for t in tree['text_parts']]:
-                    keywords.extend(re.findall(WORD_REGEXP, text.lower()))
+                    keywords.extend(terms.words(text))
                     for kwe in _plugins.get_text_kw_extractors():
                         keywords.extend(kwe(self, msg, 'text/plain', text,
                                             body_info=body_info))
 
-        keywords.append('{0!s}:id'.format(msg_id))
-        keywords.extend(re.findall(WORD_REGEXP,
-                                   self.hdr(msg, 'subject').lower()))
-        keywords.extend(re.findall(WORD_REGEXP,
-                                   self.hdr(msg, 'from').lower()))
-        if mailbox:
-            keywords.append('{0!s}:mailbox'.format(FormatMbxId(mailbox).lower()))
+        keywords.extend(self._read_message_headers(msg, body_info))
+
+        if snippet_text.strip() != '':
+            body_info['snippet'] = self.clean_snippet(snippet_text[:1024])
+        else:
+            body_info['snippet'] = self.clean_snippet(snippet_html[:1024])
+
+        tf_keywords = self._term_freq_keywords(keywords)
+        return (set(keywords) - STOPLIST) | tf_keywords, body_info
+
+    def _read_message_headers(self, msg, body_info):
+        """
+        Extract the keywords which only depend on the message headers.
+        Lazy scans index just these, until the body gets scanned.
+        """
+        keywords = Words(self.hdr(msg, 'subject'))
+        keywords.extend(Words(self.hdr(msg, 'from')))
 
         # This is a signal for the bayesian filters to discriminate by MUA.
         keywords.append('{0!s}:hp'.format(HeaderPrint(msg)))
@@ -1531,7 +1840,7 @@ class MailIndex(object):
                     emails = []
                     key_lower = 'list'
                 else:
-                    words = set(re.findall(WORD_REGEXP, val_lower))
+                    words = set(Words(val_lower))
                     emails = ExtractEmails(val_lower)
 
                 # Strip some common crap off; stop-words and robotic emails.
@@ -1561,16 +1870,44 @@ class MailIndex(object):
             if not msg[key]:
                 keywords.append('{0!s}:missing'.format(key))
 
+        return keywords
+
+    def _read_message_meta(self, msg_mid, msg_id, msg, msg_size, msg_ts,
+                           keywords, body_info, mailbox=None):
+        """
+        Add the keywords which depend on the index and config (message ID,
+        dates, tags...) to those from _read_message_content().
+        """
+        keywords = set(keywords)
+        keywords.add('{0!s}:id'.format(msg_id))
         for extract in _plugins.get_meta_kw_extractors():
-            keywords.extend(extract(self, msg_mid, msg, msg_size, msg_ts,
+            keywords |= set(extract(self, msg_mid, msg, msg_size, msg_ts,
                                     body_info=body_info))
+        if mailbox:
+            keywords.add('{0!s}:mailbox'.format(FormatMbxId(mailbox).lower()))
+        return keywords, body_info
 
-        if snippet_text.strip() != '':
-            body_info['snippet'] = self.clean_snippet(snippet_text[:1024])
-        else:
-            body_info['snippet'] = self.clean_snippet(snippet_html[:1024])
+    @classmethod
+    def _term_freq_keywords(cls, keywords, max_words=None):
+        """
+        Return word:tfN keywords for the most frequent words.
 
-        return (set(keywords) - STOPLIST), body_info
+        >>> sorted(MailIndex._term_freq_keywords(
+        ...     ['a:b', 'x', 'x', 'x', 'y', 'y', 'y', 'y', 'z', 'z'], max_words=2))
+        ['x:tf1', 'y:tf2']
+        """
+        counts = {}
+        for word in keywords:
+            if ':' not in word:
+                counts[word] = counts.get(word, 0) + 1
+        frequent = heapq.nlargest(max_words or cls.TERM_FREQ_WORDS,
+                                  [(count, word)
+                                   for word, count in counts.iteritems()
+                                   if count > 1 and word not in STOPLIST])
+        return set(['{0!s}:tf{1:d}'.format(word,
+                                           min(count.bit_length() - 1,
+                                               cls.TERM_FREQ_MAX))
+                    for count, word in frequent])
 
     # FIXME: Here it would be nice to recognize more boilerplate junk in
     #        more languages!
@@ -1594,11 +1931,16 @@ class MailIndex(object):
     def index_message(self, session, msg_mid, msg_id,
                       msg, msg_metadata_kws, msg_size, msg_ts,
                       mailbox=None, compact=True, filter_hooks=None,
-                      process_new=None, apply_tags=None, incoming=False):
-        keywords, snippet = self.read_message(session,
-                                              msg_mid, msg_id, msg,
-                                              msg_size, msg_ts,
-                                              mailbox=mailbox)
+                      process_new=None, apply_tags=None, incoming=False,
+                      parsed=None):
+        if parsed:
+            # The (keywords, body_info) from read_message() are known
+            keywords, snippet = parsed
+        else:
+            keywords, snippet = self.read_message(session,
+                                                  msg_mid, msg_id, msg,
+                                                  msg_size, msg_ts,
+                                                  mailbox=mailbox)
 
         # Apply the defaults for this mail source / mailbox.
         if apply_tags:
@@ -1622,10 +1964,21 @@ class MailIndex(object):
         if 'keywords' in self.config.sys.debug:
             print 'KEYWORDS: {0!s}'.format(keywords)
 
+        self._update_me_hits(msg_mid, keywords)
+        self._index_keywords(session, msg_mid, keywords, compact=compact)
+
+        self._magic_changed([int(msg_mid, 36)])
+        self.config.command_cache.mark_dirty(set([u'mail:all']) | keywords)
+        return keywords, snippet
+
+    def _index_keywords(self, session, msg_mid, keywords, compact=True):
         for word in keywords:
             if (word.startswith('__') or
                     # Tags are now handled outside the posting lists
-                    word.endswith(':tag') or word.endswith(':in')):
+                    word.endswith(':tag') or word.endswith(':in') or
+                    # Ranges are answered from the sort columns
+                    (word.endswith(self.COLUMN_KEYWORDS) and
+                     word not in self.SUB_KB_KEYWORDS)):
                 continue
             try:
                 GlobalPostingList.Append(session, word, [msg_mid],
@@ -1634,9 +1987,6 @@ class MailIndex(object):
                 # FIXME: we just ignore garbage
                 pass
 
-        self.config.command_cache.mark_dirty(set([u'mail:all']) | keywords)
-        return keywords, snippet
-
     def get_msg_at_idx_pos(self, msg_idx):
         try:
             crv = self.CACHE.get(msg_idx, {})
@@ -1660,7 +2010,11 @@ class MailIndex(object):
 
     def update_msg_sorting(self, msg_idx, msg_info):
         for order, sorter in self.SORT_ORDERS.iteritems():
-            self.INDEX_SORT[order][msg_idx] = sorter(self, msg_info)
+            value = sorter(self, msg_info)
+            column = self.INDEX_SORT[order]
+            if column[msg_idx] != value:
+                column[msg_idx] = value
+                self._range_cache.pop(order, None)
 
     def set_msg_at_idx_pos(self, msg_idx, msg_info, original_line=None):
         with self._lock:
@@ -1669,9 +2023,11 @@ class MailIndex(object):
                 self.INDEX_THR.append(-1)
                 for order in self.INDEX_SORT:
                     self.INDEX_SORT[order].append(0)
+                self._range_cache = {}
 
         msg_thr_mid = msg_info[self.MSG_THREAD_MID].split('/')[0]
         self.INDEX[msg_idx] = original_line or self.m2l(msg_info)
+        self._magic_changed([msg_idx])
         self.INDEX_THR[msg_idx] = int(msg_thr_mid, 36)
         self.MSGIDS[msg_info[self.MSG_ID]] = msg_idx
         for msg_ptr in msg_info[self.MSG_PTRS].split(','):
@@ -1779,6 +2135,9 @@ class MailIndex(object):
                 self.TAGS[tag_id] |= eids
             elif eids:
                 self.TAGS[tag_id] = eids
+            if tag_id in self._sort_freshness_tags and eids - self.UNREAD:
+                self.UNREAD = self.UNREAD | eids
+        self._magic_changed(added)
         try:
             self.config.command_cache.mark_dirty(
                 [u'mail:all', u'{0!s}:in'.format(self.config.tags[tag_id].slug)] +
@@ -1833,6 +2192,12 @@ class MailIndex(object):
         with self._lock:
             if tag_id in self.TAGS:
                 self.TAGS[tag_id] -= eids
+            if tag_id in self._sort_freshness_tags and eids & self.UNREAD:
+                still_unread = set()
+                for tid in self._sort_freshness_tags:
+                    still_unread |= (self.TAGS.get(tid, set()) & eids)
+                self.UNREAD = (self.UNREAD - eids) | still_unread
+        self._magic_changed(removed)
         try:
             self.config.command_cache.mark_dirty(
                 [u'{0!s}:in'.format(self.config.tags[tag_id].slug)] +
@@ -1851,11 +2216,66 @@ class MailIndex(object):
             for subtag in self.config.get_tags(parent=tag_id):
                 results.extend(hits('{0!s}:in'.format(subtag._key)))
             if tag.magic_terms and recursion < 5:
-                results.extend(self.search(session, [tag.magic_terms],
-                                           recursion=recursion+1).as_set())
+                results.extend(self.get_magic_hits(session, tag,
+                                                   recursion=recursion))
         results.extend(hits('{0!s}:in'.format(tag_id)))
         return results
 
+    def _magic_changed(self, msg_idxs):
+        # Messages which changed have to be re-checked against all the
+        # materialized saved searches before they are next used.
+        if self.MAGIC and msg_idxs:
+            with self._lock:
+                for view in self.MAGIC.values():
+                    view[2] |= set(msg_idxs)
+
+    def _get_magic_epoch(self):
+        # Terms like dates:today or from:me mean something else tomorrow
+        # or once our profiles change, and a view may depend on others
+        # (in:tag), so all the views are rebuilt when either happens.
+        return (time.strftime('%Y-%m-%d'),
+                self.config.vcards.profile_emails())
+
+    def get_magic_hits(self, session, tag, recursion=0):
+        """
+        Return the set of messages matching a tag's magic (saved search)
+        terms. The full search is only done once; after that, messages
+        which were indexed or (un)tagged in the meantime are re-checked
+        against the terms and the stored result is patched.
+        """
+        epoch = self._get_magic_epoch()
+        with self._lock:
+            if epoch != self._magic_epoch:
+                self.MAGIC, self._magic_epoch = {}, epoch
+            view = self.MAGIC.get(tag._key)
+            if view and view[0] == tag.magic_terms and view[1] is not None:
+                pending, view[2] = view[2], set()
+                if not pending:
+                    return view[1]
+            else:
+                view = self.MAGIC[tag._key] = [tag.magic_terms, None, set()]
+                pending = None
+
+        try:
+            if pending is None:
+                found = set(self.search(session, [tag.magic_terms],
+                                        recursion=recursion+1).as_set())
+            else:
+                matched = self.search(session, [tag.magic_terms],
+                                      context=pending,
+                                      recursion=recursion+1).as_set()
+                found = (view[1] - pending) | (matched & pending)
+        except:
+            with self._lock:
+                if pending:
+                    view[2] |= pending
+            raise
+
+        with self._lock:
+            if self.MAGIC.get(tag._key) is view:
+                view[1] = found
+        return found
+
     def _vfs_hits(self, session, searchterms):
         mailbox_path = FilePath(searchterms[0].split(':', 1)[1])
         session.ui.mark(_('Opening mailbox %s') % mailbox_path)
@@ -1881,17 +2301,122 @@ class MailIndex(object):
 
         return results
 
+    def _search_term(self, session, term, hits, recursion, fold=True):
+        """Find the hits for a single (leaf) search term."""
+        if fold and not term.startswith('vfs:'):
+            folded, lowered = CaseFold(term), LowerCase(term)
+            if folded != lowered:
+                # Mail indexed before we folded sharp s and friends only
+                # has lowercased keywords, so look for both until the
+                # user reindexes.
+                rt = list(self._search_term(session, folded, hits,
+                                            recursion, fold=False))
+                rt.extend(self._search_term(session, lowered, hits,
+                                            recursion, fold=False))
+                return rt
+            term = folded
+
+        if ':' not in term:
+            return hits(term)
+
+        rt = []
+        if term.startswith('in:'):
+            rt.extend(self.search_tag(session, term, hits,
+                                      recursion=recursion))
+        elif term.startswith('mid:'):
+            rt.extend([int(t, 36) for t in
+                       term[4:].replace('=', '').split(',')])
+        elif term.startswith('body:'):
+            rt.extend(hits(term[5:]))
+        elif term == 'all:mail':
+            rt.extend(range(0, len(self.INDEX)))
+        elif term in ('to:me', 'cc:me', 'from:me'):
+            if getattr(hits, 'keywords', None) is None:
+                rt.extend(self.get_me_hits(session, term.split(':')[0]))
+            else:
+                for email in self.config.vcards.profile_emails():
+                    rt.extend(hits('{0!s}:{1!s}'.format(email,
+                                              term.split(':')[0])))
+        elif term == 'is:encrypted':
+            for status in EncryptionInfo.STATUSES:
+                if status in CryptoInfo.STATUSES:
+                    continue
+                rt.extend(self.search_tag(session,
+                                          'in:mp_enc-{0!s}'.format(status),
+                                          hits, recursion=recursion))
+        elif term == 'is:signed':
+            for status in SignatureInfo.STATUSES:
+                if status in CryptoInfo.STATUSES:
+                    continue
+                rt.extend(self.search_tag(session,
+                                          'in:mp_sig-{0!s}'.format(status),
+                                          hits, recursion=recursion))
+        else:
+            t = term.split(':', 1)
+            fnc = _plugins.get_search_term(t[0])
+            if fnc:
+                rt.extend(fnc(self.config, self, term, hits))
+            else:
+                rt.extend(hits('{0!s}:{1!s}'.format(t[1], t[0])))
+        return rt
+
+    ME_FIELDS = ('to', 'cc', 'from')
+
+    def get_me_hits(self, session, field):
+        """
+        Return the set of messages which have one of our profile addresses
+        in the given header (to, cc or from).
+
+        These sets are built from the posting lists when first needed or
+        when the profile addresses change, and are then kept up to date as
+        messages are indexed. Callers must treat them as read-only.
+        """
+        emails = self.config.vcards.profile_emails()
+        with self._lock:
+            if emails != self._me_emails:
+                me = {}
+                for fld in self.ME_FIELDS:
+                    me[fld] = set()
+                    for email in emails:
+                        me[fld] |= set(int(h, 36) for h in GlobalPostingList(
+                            session, '{0!s}:{1!s}'.format(email, fld)).hits())
+                self.ME, self._me_emails = me, emails
+            return self.ME.get(field, set())
+
+    def _update_me_hits(self, msg_mid, keywords):
+        with self._lock:
+            if not self._me_emails:
+                return
+            msg_idx = int(msg_mid, 36)
+            for fld in self.ME_FIELDS:
+                for email in self._me_emails:
+                    if '{0!s}:{1!s}'.format(email, fld) in keywords:
+                        self.ME[fld].add(msg_idx)
+                        break
+
+    def _check_cancelled(self, cancel):
+        """
+        Abort a cancellable search if we are shutting down, the index has
+        been interrupted or the cancel callback says the caller gave up.
+        """
+        if cancel is None:
+            return
+        if mailpile.util.QUITTING or self.interrupt or cancel():
+            raise SearchCancelled(self.interrupt or _('Search cancelled'))
+
     def search(self, session, searchterms,
-               keywords=None, order=None, recursion=0, context=None):
+               keywords=None, order=None, recursion=0, context=None,
+               cancel=None):
         # Stash the raw search terms
         raw_terms = searchterms[:]
-        is_vfs = False
 
         # Choose how we are going to search
         if keywords is not None:
             # Searching within pre-defined keywords
             def hits(term):
                 return [int(h, 36) for h in keywords.get(term, [])]
+            # Tells plugins they cannot use the index (e.g. search_range)
+            hits.keywords = keywords
         else:
             # Normal search
             def hits(term):
@@ -1905,106 +2430,43 @@ class MailIndex(object):
                     session.ui.mark(_('Searching for %s') % term)
                     return [int(h, 36) for h
                             in GlobalPostingList(session, term).hits()]
+            hits.keywords = None
 
         # Replace some GMail-compatible terms with what we really use
-        if 'tags' in self.config:
-            for p in ('', '+', '-'):
-                while p + 'is:unread' in searchterms:
-                    where = searchterms.index(p + 'is:unread')
-                    new = session.config.get_tags(type='unread')
-                    if new:
-                        searchterms[where] = p + 'in:{0!s}'.format(new[0].slug)
-                for t in [term for term in searchterms
-                          if term.startswith(p + 'tag:')]:
-                    where = searchterms.index(t)
-                    searchterms[where] = p + 'in:' + t.split(':', 1)[1]
-
-        # If first term is a negative search, prepend an all:mail
-        if searchterms and searchterms[0] and searchterms[0][0] == '-':
-            searchterms[:0] = ['all:mail']
-
-        if context:
-            r = [(None, set(context))]
-        else:
-            r = []
-
-        for term in searchterms:
-            if term in STOPLIST:
+        def compat(term):
+            if 'tags' not in self.config:
+                return term
+            p = term[:1] if (term[:1] in ('+', '-')) else ''
+            if term[len(p):] == 'is:unread':
+                new = self.config.get_tags(type='unread')
+                if new:
+                    return p + 'in:{0!s}'.format(new[0].slug)
+            elif term[len(p):].startswith('tag:'):
+                return p + 'in:' + term.split(':', 1)[1]
+            return term
+        searchterms[:] = [compat(t) for t in searchterms]
+
+        # Compile the terms into a query plan
+        tokens = []
+        for token in Tokenize(searchterms):
+            if token in STOPLIST:
                 if session:
-                    session.ui.warning(_('Ignoring common word: %s') % term)
-                continue
-
-            if term[0] in ('-', '+'):
-                op = term[0]
-                term = term[1:]
-            else:
-                op = None
-
-            r.append((op, []))
-            rt = r[-1][1]
-            if not term.startswith('vfs:'):
-                term = term.lower()
-            else:
-                is_vfs = True
-
-            if ':' in term:
-                if term.startswith('in:'):
-                    rt.extend(self.search_tag(session, term, hits,
-                                              recursion=recursion))
-                elif term.startswith('mid:'):
-                    rt.extend([int(t, 36) for t in
-                               term[4:].replace('=', '').split(',')])
-                elif term.startswith('body:'):
-                    rt.extend(hits(term[5:]))
-                elif term == 'all:mail':
-                    rt.extend(range(0, len(self.INDEX)))
-                elif term in ('to:me', 'cc:me', 'from:me'):
-                    vcards = self.config.vcards
-                    emails = []
-                    for vc in vcards.find_vcards([], kinds=['profile']):
-                        emails += [vcl.value for vcl in vc.get_all('email')]
-                    for email in set(emails):
-                        if email:
-                            rt.extend(hits('{0!s}:{1!s}'.format(email,
-                                                      term.split(':')[0])))
-                elif term == 'is:encrypted':
-                    for status in EncryptionInfo.STATUSES:
-                        if status in CryptoInfo.STATUSES:
-                            continue
-                        rt.extend(self.search_tag(session,
-                                                  'in:mp_enc-{0!s}'.format(status),
-                                                  hits, recursion=recursion))
-                elif term == 'is:signed':
-                    for status in SignatureInfo.STATUSES:
-                        if status in CryptoInfo.STATUSES:
-                            continue
-                        rt.extend(self.search_tag(session,
-                                                  'in:mp_sig-{0!s}'.format(status),
-                                                  hits, recursion=recursion))
-                else:
-                    t = term.split(':', 1)
-                    fnc = _plugins.get_search_term(t[0])
-                    if fnc:
-                        rt.extend(fnc(self.config, self, term, hits))
-                    else:
-                        rt.extend(hits('{0!s}:{1!s}'.format(t[1], t[0])))
+                    session.ui.warning(_('Ignoring common word: %s') % token)
             else:
-                rt.extend(hits(term))
-
-        if r:
-            results = set(r[0][1])
-            for (op, rt) in r[1:]:
-                if op == '+':
-                    results |= set(rt)
-                elif op == '-':
-                    results -= set(rt)
-                else:
-                    results &= set(rt)
+                tokens.append(compat(token))
+        plan = CompileQuery(tokens)
+        is_vfs = bool([t for t in QueryTerms(plan) if t.startswith('vfs:')])
+
+        def leaf(term):
+            self._check_cancelled(cancel)
+            return self._search_term(session, term, hits, recursion)
+
+        results = EvaluateQuery(plan, leaf,
+                                lambda: set(range(0, len(self.INDEX))),
+                                initial=context)
+        if plan is not None and keywords is None:
             # Sometimes the scan gets aborted...
-            if keywords is None:
-                results -= set([len(self.INDEX)])
-        else:
-            results = set()
+            results -= set([len(self.INDEX)])
 
         # Unless we are searching for invisible things, remove them from
         # results by default.
@@ -2015,13 +2477,14 @@ class MailIndex(object):
                 (not session or 'all' not in order)):
             invisible = self.config.get_tags(flag_hides=True)
             exclude_terms = ['in:{0!s}'.format(i._key) for i in invisible]
+            # Look at the plan, not the tokens, so grouped, negated or
+            # field-qualified mentions (-(in:trash), in:(spam OR trash))
+            # count too.
+            mentioned = set(QueryTerms(plan))
             for tag in invisible:
-                tid = tag._key
-                for p in ('in:%s', '+in:%s', '-in:%s'):
-                    if ((p % tid) in searchterms or
-                            (p % tag.name) in searchterms or
-                            (p % tag.slug) in searchterms):
-                        exclude_terms = []
+                if mentioned & set(['in:%s' % n for n in
+                                    (tag._key, tag.name, tag.slug)]):
+                    exclude_terms = []
             if len(exclude_terms) > 1:
                 exclude_terms = ([exclude_terms[0]] +
                                  ['+{0!s}'.format(e) for e in exclude_terms[1:]])
@@ -2029,7 +2492,7 @@ class MailIndex(object):
             exclude = self.search(session, exclude_terms).as_set()
 
         # Decide if this is cached or not
-        if keywords is None and not is_vfs:
+        if keywords is None and not is_vfs and context is None:
             srs = CachedSearchResultSet(self, raw_terms)
             if len(srs) > 0:
                 return srs
@@ -2049,30 +2512,216 @@ class MailIndex(object):
 
     def _freshness_sorter(self, msg_info):
         ts = long(msg_info[self.MSG_DATE], 36)
-        for tid in self.get_tags(msg_info=msg_info):
-            if tid in self._sort_freshness_tags:
-                return ts + self.FRESHNESS_SORT_BOOST
+        if self._sort_freshness_tags.intersection(
+                msg_info[self.MSG_TAGS].split(',')):
+            return ts + self.FRESHNESS_SORT_BOOST
         return ts
 
     FRESHNESS_SORT_BOOST = (5 * 24 * 3600)
     SORT_ORDERS = {
         'freshness': _freshness_sorter,
         'date': lambda s, mi: long(mi[s.MSG_DATE], 36),
+        'size': lambda s, mi: int(mi[s.MSG_KB], 36),
 # FIXME: The following are disabled for now for being memory hogs
 #       'from': lambda s, mi: s.mi[s.MSG_FROM]),
 #       'subject': lambda s, mi: s.mi[s.MSG_SUBJECT]),
     }
 
     def _prepare_sorting(self):
-        self._sort_freshness_tags = [tag._key for tag in
-                                     self.config.get_tags(type='unread')]
+        self._sort_freshness_tags = set([tag._key for tag in
+                                         self.config.get_tags(type='unread')])
+        self._range_cache = {}
+        self._relevance_cache = None
+        self._relevance_avg_size = None
         self.INDEX_SORT = {}
         for order, sorter in self.SORT_ORDERS.iteritems():
             self.INDEX_SORT[order] = []
 
-    def sort_results(self, session, results, how):
+    def _refresh_unread(self, unread_tids):
+        # The set of unread tags changed, so both the unread set and the
+        # freshness sort column need to be rebuilt from scratch.
+        self._sort_freshness_tags = unread_tids
+        self._rebuild_unread()
+        freshness = self.INDEX_SORT.get('freshness')
+        if freshness is not None:
+            self._range_cache.pop('freshness', None)
+            for msg_idx in range(0, min(len(freshness), len(self.INDEX))):
+                try:
+                    msg_info = self.l2m(self.INDEX[msg_idx])
+                    freshness[msg_idx] = self._freshness_sorter(msg_info)
+                except (IndexError, ValueError):
+                    pass
+
+    def _rebuild_unread(self):
+        unread = set()
+        for tid in self._sort_freshness_tags:
+            unread |= self.TAGS.get(tid, set())
+        self.UNREAD = frozenset(unread)
+
+    def get_unread_set(self):
+        """
+        Return the set of messages carrying any unread tag.
+
+        UNREAD is copy-on-write: tagging replaces it with a new frozenset
+        instead of modifying it, so callers get it without a copy and can
+        iterate over it while other threads keep tagging.
+        """
+        unread_tids = set([tag._key for tag in
+                           self.config.get_tags(type='unread', default=[])])
+        with self._lock:
+            if unread_tids != self._sort_freshness_tags:
+                self._refresh_unread(unread_tids)
+            return self.UNREAD
+
+    def search_range(self, order, low=None, high=None):
+        """
+        Return the indexes of all messages whose value in one of the numeric
+        sort columns (see SORT_ORDERS) is within low..high, inclusive. A
+        bound of None leaves that end of the range open.
+
+        The column is sorted once and then kept until it changes, so each
+        range query is just a pair of binary searches.
+        """
+        with self._lock:
+            cached = self._range_cache.get(order)
+            if cached is None:
+                column = self.INDEX_SORT[order]
+                idxs = sorted(range(0, len(column)), key=column.__getitem__)
+                cached = ([column[i] for i in idxs], idxs)
+                self._range_cache[order] = cached
+        values, idxs = cached
+        start = 0 if (low is None) else bisect.bisect_left(values, low)
+        end = (len(values) if (high is None)
+               else bisect.bisect_right(values, high))
+        return idxs[start:end]
+
+    def _relevance_terms(self, session):
+        # Like _search_term, we look for both the folded and the merely
+        # lowercased form of each word, as older mail is indexed that way.
+        terms = []
+        plan = CompileQuery(Tokenize((session and session.searched) or []))
+        for term in PositiveTerms(plan):
+            if term.startswith('body:'):
+                term = term[5:]
+            forms = tuple(sorted(set([CaseFold(term), LowerCase(term)])))
+            if (term and ':' not in term and
+                    not [f for f in forms if f in STOPLIST]):
+                terms.append(forms)
+        return terms
+
+    def _relevance_hits(self, session, forms, suffix=''):
+        hits = set()
+        for form in forms:
+            hits |= set([int(h, 36) for h
+                         in GlobalPostingList(session, form + suffix).hits()])
+        return hits
+
+    def relevance_scores(self, session, results):
+        """
+        Score messages against the words in the current search, using
+        Okapi BM25. Term frequencies come from the word:tfN keywords (words
+        without one count as occurring once) and the document length is the
+        message size. Messages which match none of the words are left out
+        of the returned dict.
+
+        Scores depend only on the search terms, so they are cached for as
+        long as the terms and the index stay the same.
+        """
+        terms = self._relevance_terms(session)
+        if not terms:
+            return {}
+
+        results = set(results)
+        cache_key = (tuple(terms), len(self.INDEX))
+        cached = self._relevance_cache
+        if cached and cached[0] == cache_key and results <= cached[1]:
+            return cached[2]
+
+        sizes = self.INDEX_SORT['size']
+        total = float(len(sizes) or 1)
+        avg_size = self._relevance_avg_size
+        if avg_size is None or avg_size[0] != len(sizes):
+            # Only recalculated as the index grows; sizes rarely change
+            avg_size = (len(sizes), max(1.0, sum(sizes) / total))
+            self._relevance_avg_size = avg_size
+        avg_size = avg_size[1]
+        k1, b = self.BM25_K1, self.BM25_B
+
+        scores = {}
+        for forms in terms:
+            matching = self._relevance_hits(session, forms)
+            df = len(matching)
+            matching &= results
+            if not matching:
+                continue
+            idf = math.log(1.0 + (total - df + 0.5) / (df + 0.5))
+
+            tf = dict((msg_idx, 1) for msg_idx in matching)
+            for power in range(1, self.TERM_FREQ_MAX + 1):
+                tf_suffix = ':tf{0:d}'.format(power)
+                for msg_idx in self._relevance_hits(session, forms, tf_suffix):
+                    if msg_idx in tf:
+                        tf[msg_idx] = 2 ** power
+
+            for msg_idx, freq in tf.iteritems():
+                try:
+                    norm = 1 - b + b * (max(sizes[msg_idx], 1) / avg_size)
+                except IndexError:
+                    continue
+                scores[msg_idx] = (scores.get(msg_idx, 0) +
+                                   idf * freq * (k1 + 1) / (freq + k1 * norm))
+
+        self._relevance_cache = (cache_key, results, scores)
+        return scores
+
+    def _relevance_key(self, session, results):
+        # Best matches first, ties broken by date (newest first)
+        scores = self.relevance_scores(session, results)
+        dates = self.INDEX_SORT['date']
+        return lambda r: (-scores.get(r, 0), -dates[r])
+
+    def sort_results_head(self, session, results, how, count, cancel=None):
+        """
+        Sort and collapse just enough of the results to fill the first
+        `count` positions, using a partial (heap) sort on the sort column.
+        The returned list may be longer than `count`, and is shorter only
+        if there are not enough results. Orders which are not backed by a
+        sort column fall back to sorting everything.
+        """
+        results = list(results)
+        how = how or 'flat-unsorted'
+        orders = [o for o in self.INDEX_SORT if how.endswith(o)]
+        if len(results) <= count:
+            key = None
+        elif how.endswith('relevance'):
+            key = self._relevance_key(session, results)
+        elif orders:
+            key = self.INDEX_SORT[orders[0]].__getitem__
+        else:
+            key = None
+        if key is None:
+            self.sort_results(session, results, how, cancel=cancel)
+            return results
+
+        pick = heapq.nlargest if how.startswith('rev') else heapq.nsmallest
+        want = count
+        while True:
+            self._check_cancelled(cancel)
+            try:
+                head = pick(want, results, key=key)
+            except IndexError:
+                # Bogus results, let sort_results do the cleanup.
+                self.sort_results(session, results, how, cancel=cancel)
+                return results
+            self.sort_results(session, head, how, cancel=cancel)
+            if len(head) >= count or want >= len(results):
+                return head
+            want *= 4
+
+    def sort_results(self, session, results, how, cancel=None):
         if not results:
             return
+        self._check_cancelled(cancel)
 
         count = len(results)
         how = how or 'flat-unsorted'
@@ -2088,6 +2737,8 @@ class MailIndex(object):
             elif how.endswith('random'):
                 now = time.time()
                 results.sort(key=lambda k: sha1b64('{0!s}{1!s}'.format(now, k)))
+            elif how.endswith('relevance'):
+                results.sort(key=self._relevance_key(session, results))
             else:
                 did_sort = False
                 for order in self.INDEX_SORT:
@@ -2126,18 +2777,18 @@ class MailIndex(object):
             results.reverse()
 
         if 'flat' not in how:
-            all_new = set()
             if 'freshness' in how:
-                # FIXME: This calculation appears very cachable!
-                new_tags = session.config.get_tags(type='unread')
-                for tag in new_tags:
-                    all_new |= self.TAGS[tag._key]
+                all_new = self.get_unread_set()
+            else:
+                all_new = set()
 
             # This filters away all but the first (or oldst unread) result in
             # each conversation.
             session.ui.mark(_('Collapsing conversations...'))
             seen, pi = {}, 0
-            for ri in results:
+            for rpos, ri in enumerate(results):
+                if cancel is not None and (rpos % 10000) == 0:
+                    self._check_cancelled(cancel)
                 ti = self.INDEX_THR[ri]
                 if ti in seen:
                     if ti in all_new:
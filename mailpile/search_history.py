@@ -22,6 +22,8 @@ class SearchHistory(object):
 
     PICKLE_NAME = 'search-history.dat'
 
+    WARM_UP_SEARCHES = 10        # How many searches to replay on startup
+
     @classmethod
     def Load(cls, config, merge=None):
         with SEARCH_HISTORY_LOCK:
@@ -71,16 +73,26 @@ class SearchHistory(object):
         bitmask, order = zlib.decompress(compressed_bitmask).rsplit(':', 1)
         return self._from_bitmask(bitmask), order
 
-    def add(self, terms, results, order):
+    def add(self, terms, results, order, count=True, context=None):
+        """
+        Record a search. It only counts towards the popularity of its terms
+        if count is set and it is not just a repeat of the search context
+        it was made in (paging through results, for example).
+        """
         now = int(time.time())
         data = {
             'terms': terms[:],
             'results': results[:],
             'order': order,
-            't': now
+            't': now,
+            'n': 0
         }
         with SEARCH_HISTORY_LOCK:
             fprint = md5_hex(str(terms), str(results), str(order))
+            if count and context != 'search:{0!s}'.format(fprint):
+                data['n'] += 1
+            if fprint in self.cache:
+                data['n'] += self.cache[fprint].get('n', 1)
             self.cache[fprint] = data
             self.changed = True
             return fprint
@@ -88,7 +100,7 @@ class SearchHistory(object):
     def get(self, session, fprint):
         with SEARCH_HISTORY_LOCK:
             search = self.cache[fprint]
-            self.cache[fprint]['t'] = int(time.time())
+            search['t'] = int(time.time())
             if 'results' not in search and 'c' in search:
                 results, order = self._decompress(search['c'])
                 session.config.index.sort_results(session, results, order)
@@ -96,6 +108,52 @@ class SearchHistory(object):
                 search['order'] = order
             return tuple(search[t] for t in ('terms', 'results', 'order'))
 
+    def popular(self, count=None):
+        """
+        Return the terms and sort order of the most frequently used
+        searches, most popular first. Searches for the same terms are
+        counted together, even if their results have changed.
+        """
+        stats = {}
+        with SEARCH_HISTORY_LOCK:
+            for search in self.cache.values():
+                terms = tuple(search['terms'])
+                n, t, order = stats.get(terms, (0, 0, None))
+                if search['t'] >= t and search.get('order'):
+                    order = search['order']
+                stats[terms] = (n + search.get('n', 1),
+                                max(t, search['t']), order)
+        ranked = sorted(stats.iteritems(),
+                        key=lambda (terms, (n, t, order)): (-n, -t))
+        return [(list(terms), order) for terms, (n, t, order)
+                in ranked[:(count or self.WARM_UP_SEARCHES)]]
+
+    def warm_up(self, config, count=None):
+        """
+        Replay the most popular searches, so the posting lists, search
+        result cache and command cache are ready before the user asks.
+        This gives up as soon as the user starts doing things.
+        """
+        from mailpile.plugins.search import Search
+        from mailpile.ui import Session, BackgroundInteraction
+
+        # Searches change the session's results and context, so we use
+        # our own. Replayed searches do not make themselves more popular.
+        session = Session(config)
+        session.ui = BackgroundInteraction(config)
+        session.count_searches = False
+
+        for terms, order in self.popular(count):
+            if (mailpile.util.QUITTING or
+                    mailpile.util.LIVE_USER_ACTIVITIES > 0):
+                break
+            session.ui.mark(_('Warming up search: %s') % ' '.join(terms))
+            search = Search(session, arg=terms,
+                            data=({'order': [order]} if order else {}))
+            search.IS_USER_ACTIVITY = False
+            search.run()
+            play_nice_with_threads()
+
     def expire(self, ttl=None, compact=None):
         expired = time.time() - (ttl or self.DEFAULT_TTL)
         compact = time.time() - (compact or self.RAW_RESULT_TTL)
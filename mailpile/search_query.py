@@ -0,0 +1,323 @@
+import re
+
+
+#
+# This module implements the search query language: a list of search terms
+# is tokenized and compiled into a small operator tree (the "plan"), which
+# the search engine then evaluates over sets of message index positions.
+#
+# The grammar is a superset of the traditional flat term list:
+#
+#    query   := unit ( ['AND'] unit )*
+#    unit    := ['+' | '-'] or_expr
+#    or_expr := atom ( 'OR' atom )*
+#    atom    := ('NOT' | '-') atom | '(' query ')' | field: '(' query ')'
+#             | term
+#
+# Units are folded left to right, just like the flat term lists always were:
+# plain units narrow the results (AND), '+' units widen them (OR) and '-'
+# units subtract from them. OR binds tighter than the implicit AND, as in
+# GMail, so "a b OR c" means "a AND (b OR c)". A field qualifier in front
+# of a group (e.g. "from:(bob OR alice)") applies to all the plain words
+# within it.
+#
+# Plan nodes are tuples, so identical sub-expressions compare equal and
+# are only evaluated once:
+#
+#    ('term', 'from:bob')
+#    ('not', node)
+#    ('or', (node, node, ...))
+#    ('seq', ((op, node), (op, node), ...))    op is None, '+' or '-'
+#
+
+OPERATORS = ('AND', 'OR', 'NOT', '(', ')')
+
+FIELD_GROUP_RE = re.compile(r'^([+-]?[^\s():]+:)\(')
+
+
+def _split_term(term):
+    if term.lstrip('+-').startswith('vfs:'):
+        return [term]
+
+    tokens, tail = [], []
+    while term.endswith(')') and term not in OPERATORS:
+        tail.append(')')
+        term = term[:-1]
+
+    while term:
+        if term[:1] in ('+', '-') and term[1:2] == '(':
+            tokens.extend([term[0], '('])
+            term = term[2:]
+        elif term[:1] == '(':
+            tokens.append('(')
+            term = term[1:]
+        else:
+            m = re.match(FIELD_GROUP_RE, term)
+            if not m:
+                break
+            tokens.extend([m.group(1), '('])
+            term = term[len(m.group(0)):]
+
+    if term:
+        tokens.append(term)
+    return tokens + tail
+
+
+def Tokenize(terms):
+    """
+    Split a list of search terms into query tokens, separating parentheses
+    from the terms they are attached to.
+
+    >>> Tokenize(['(from:bob', 'OR', 'to:bob)', '-in:spam'])
+    ['(', 'from:bob', 'OR', 'to:bob', ')', '-in:spam']
+    >>> Tokenize(['-from:(bob alice)', 'hello world'])
+    ['-from:', '(', 'bob', 'alice', ')', 'hello', 'world']
+    >>> Tokenize(['vfs:/tmp/My (Mail)'])
+    ['vfs:/tmp/My (Mail)']
+    """
+    tokens = []
+    for term in terms:
+        if term.lstrip('+-').startswith('vfs:'):
+            tokens.append(term)
+        else:
+            for word in term.split():
+                tokens.extend(_split_term(word))
+    return tokens
+
+
+def IsOperator(token):
+    return token in OPERATORS
+
+
+class _Parser(object):
+    def __init__(self, tokens):
+        self.tokens = list(tokens)
+        self.pos = 0
+
+    def _peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return None
+
+    def _next(self):
+        token = self._peek()
+        self.pos += 1
+        return token
+
+    def query(self, field=None, nested=False):
+        units = []
+        while self.pos < len(self.tokens):
+            token = self._peek()
+            if token == ')':
+                if nested:
+                    break
+                self.pos += 1  # Ignore unbalanced parentheses
+                continue
+            elif token in ('AND', 'OR'):
+                self.pos += 1  # Ignore dangling operators
+                continue
+
+            op = None
+            if token in ('+', '-'):
+                op = self._next()
+            elif token[:1] in ('+', '-') and len(token) > 1:
+                op = token[0]
+                self.tokens[self.pos] = token[1:]
+
+            node = self.or_expr(field)
+            if node is not None:
+                units.append((op, node))
+
+        if not units:
+            return None
+        elif len(units) == 1 and units[0][0] is None:
+            return units[0][1]
+        return ('seq', tuple(units))
+
+    def or_expr(self, field):
+        nodes = [self.atom(field)]
+        while self._peek() == 'OR':
+            self.pos += 1
+            nodes.append(self.atom(field))
+        nodes = [n for n in nodes if n is not None]
+        if not nodes:
+            return None
+        elif len(nodes) == 1:
+            return nodes[0]
+        return ('or', tuple(nodes))
+
+    def _group(self, field):
+        node = self.query(field=field, nested=True)
+        if self._peek() == ')':
+            self.pos += 1
+        return node
+
+    def atom(self, field):
+        token = self._next()
+        if token is None or token in ('AND', 'OR', ')'):
+            return None
+
+        if token in ('NOT', '-'):
+            child = self.atom(field)
+            return ('not', child) if (child is not None) else None
+        elif token == '+':
+            return self.atom(field)
+        elif token == '(':
+            return self._group(field)
+
+        if token[:1] in ('+', '-'):
+            self.pos -= 1
+            self.tokens[self.pos] = token[1:]
+            if token[0] == '-':
+                child = self.atom(field)
+                return ('not', child) if (child is not None) else None
+            return self.atom(field)
+
+        if token.endswith(':') and self._peek() == '(':
+            self.pos += 1
+            return self._group(token)
+
+        if field and ':' not in token:
+            token = field + token
+        return ('term', token)
+
+
+def Compile(tokens):
+    """
+    Compile a list of query tokens (see Tokenize) into a plan.
+
+    >>> Compile(['hello'])
+    ('term', 'hello')
+    >>> Compile(['a', 'b', '+c', '-d'])
+    ('seq', ((None, ('term', 'a')), (None, ('term', 'b')), ('+', ('term', 'c')), ('-', ('term', 'd'))))
+    >>> Compile(Tokenize(['a (b OR NOT c)']))
+    ('seq', ((None, ('term', 'a')), (None, ('or', (('term', 'b'), ('not', ('term', 'c')))))))
+    >>> Compile(Tokenize(['from:(bob OR to:alice)']))
+    ('or', (('term', 'from:bob'), ('term', 'to:alice')))
+    >>> Compile(Tokenize(['a -subject:(b c)']))
+    ('seq', ((None, ('term', 'a')), ('-', ('seq', ((None, ('term', 'subject:b')), (None, ('term', 'subject:c')))))))
+    >>> Compile(Tokenize(['((a', 'OR', ')']))
+    ('term', 'a')
+    >>> Compile([]) is None
+    True
+    """
+    return _Parser(tokens).query()
+
+
+def Terms(plan):
+    """
+    Return a list of all the leaf terms used by a plan.
+
+    >>> Terms(Compile(Tokenize(['a -(b OR c)'])))
+    ['a', 'b', 'c']
+    """
+    if plan is None:
+        return []
+    kind = plan[0]
+    if kind == 'term':
+        return [plan[1]]
+    elif kind == 'not':
+        return Terms(plan[1])
+    elif kind == 'or':
+        return sum([Terms(n) for n in plan[1]], [])
+    else:
+        return sum([Terms(n) for op, n in plan[1]], [])
+
+
+def PositiveTerms(plan):
+    """
+    Return the leaf terms which messages must match to be found, ignoring
+    any terms which are negated or subtracted.
+
+    >>> PositiveTerms(Compile(Tokenize(['a -b (c OR NOT d) +e'])))
+    ['a', 'c', 'e']
+    """
+    if plan is None:
+        return []
+    kind = plan[0]
+    if kind == 'term':
+        return [plan[1]]
+    elif kind == 'not':
+        return []
+    elif kind == 'or':
+        return sum([PositiveTerms(n) for n in plan[1]], [])
+    else:
+        return sum([PositiveTerms(n) for op, n in plan[1] if op != '-'], [])
+
+
+def Evaluate(plan, leaf, universe, initial=None, cache=None):
+    """
+    Evaluate a plan, calling leaf(term) to find the hits for each term and
+    universe() when the set of all messages is needed. Sub-expressions
+    which occur more than once are only evaluated once. If an initial set
+    is given, it is the first operand of the top-level sequence.
+
+    >>> hits = {'a': [1, 2, 3], 'b': [2, 3, 4], 'c': [3, 5]}
+    >>> def ev(q, initial=None):
+    ...     return sorted(Evaluate(Compile(Tokenize([q])), hits.get,
+    ...                            lambda: set(range(0, 6)), initial=initial))
+    >>> ev('a b'), ev('a OR c'), ev('a -b'), ev('-a'), ev('NOT a OR c')
+    ([2, 3], [1, 2, 3, 5], [1], [0, 4, 5], [0, 3, 4, 5])
+    >>> ev('a b +c'), ev('(a OR b) -(c OR NOT b)'), ev('b', initial=[1, 2])
+    ([2, 3, 5], [2, 4], [2])
+    """
+    if cache is None:
+        cache = {}
+
+    def ev(node):
+        if node in cache:
+            return cache[node]
+
+        kind = node[0]
+        if kind == 'term':
+            rv = set(leaf(node[1]) or [])
+        elif kind == 'not':
+            rv = universe() - ev(node[1])
+        elif kind == 'or':
+            rv = set()
+            for child in node[1]:
+                rv |= ev(child)
+        else:
+            rv = fold(node[1])
+
+        cache[node] = rv
+        return rv
+
+    def fold(units, rv=None):
+        for op, child in units:
+            if op is None and child[0] == 'not':
+                # (a AND NOT b) is just (a - b), skip the complement
+                op, child = '-', child[1]
+            if rv is None:
+                if op == '-':
+                    rv = universe() - ev(child)
+                else:
+                    rv = set(ev(child))
+            elif op == '+':
+                rv |= ev(child)
+            elif op == '-':
+                rv -= ev(child)
+            else:
+                rv &= ev(child)
+        return rv if (rv is not None) else set()
+
+    if initial is not None:
+        if plan is None:
+            return set(initial)
+        elif plan[0] == 'seq':
+            return fold(plan[1], rv=set(initial))
+        else:
+            return fold(((None, plan), ), rv=set(initial))
+    elif plan is None:
+        return set()
+    return set(ev(plan))
+
+
+if __name__ == '__main__':
+    import doctest
+    import sys
+    results = doctest.testmod(optionflags=doctest.ELLIPSIS,
+                              extraglobs={})
+    print '{0!s}'.format(results)
+    if results.failed:
+        sys.exit(1)
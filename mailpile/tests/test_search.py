@@ -1,7 +1,16 @@
+import os
+import shutil
+import tempfile
 import unittest
 from nose.tools import assert_equal, assert_less
 
-from mailpile.tests import get_shared_mailpile
+import mailpile
+import mailpile.postinglist
+from mailpile.mailboxes.maildir import MailpileMailbox as Maildir
+from mailpile.mailutils import FormatMbxId, MBX_ID_LEN
+from mailpile.plugins.tags import AddTag
+from mailpile.tests import get_shared_mailpile, get_mailpile_root
+from mailpile.ui import Session, SilentInteraction
 
 
 def checkSearch(query, expected_count=1):
@@ -32,6 +41,9 @@ def test_generator():
     yield checkSearch(['from:twitter'], 2)
     # From date
     yield checkSearch(['dates:2013-09-17', 'feministinn'])
+    # Date ranges
+    yield checkSearch(['dates:2013-09..2013-10', 'feministinn'], 2)
+    yield checkSearch(['year:2013', 'feministinn'], 2)
     # with attachment
     #  - Note: this differs from mailpile-test.py because we do not have the
     #          keys required to decrypt, so encrypted mail => attachment.
@@ -42,9 +54,230 @@ def test_generator():
     yield checkSearch(['brennan', 'twitter'])
     # term + special
     yield checkSearch(['brennan', 'from:twitter'])
+    # Boolean operators
+    yield checkSearch(['brennan', 'OR', 'from:twitter'], 2)
+    yield checkSearch(['from:twitter', 'NOT', 'brennan'])
+    yield checkSearch(['from:(twitter', 'brennan)'])
     # Not found
     yield checkSearch(['subject:Moderation', 'kde-isl'], 0)
     yield checkSearch(['has:crypto'], 4)
 
     # Test that we do not crash when searching for a non-existant tag.
     yield checkSearch(['in:doesnotexist'], 0)
+
+class FreshMailpileTest(unittest.TestCase):
+    """Base class for tests which need a mailpile of their own."""
+
+    def setUp(self):
+        self.mailpiles = []
+        self.global_gpl = mailpile.postinglist.GLOBAL_GPL
+        self.plc_cache = mailpile.postinglist.PLC_CACHE
+
+    def tearDown(self):
+        mailpile.postinglist.GLOBAL_GPL = self.global_gpl
+        mailpile.postinglist.PLC_CACHE = self.plc_cache
+        for workdir, config in self.mailpiles:
+            config.stop_workers()
+            shutil.rmtree(workdir)
+
+    def new_mailpile(self, **sys_settings):
+        # The global posting list and the posting list cache are shared
+        # by the whole process (and the cache is keyed by keyword alone),
+        # keep our keywords out of the ones used by the other tests.
+        mailpile.postinglist.GLOBAL_GPL = None
+        mailpile.postinglist.PLC_CACHE = {}
+
+        workdir = tempfile.mkdtemp()
+        config = mailpile.app.ConfigManager(
+            workdir=workdir, rules=mailpile.defaults.CONFIG_RULES)
+        self.mailpiles.append((workdir, config))
+        session = Session(config)
+        config.load(session)
+        session.ui = SilentInteraction(config)
+        for var, value in sys_settings.iteritems():
+            config.sys[var] = value
+        mp = mailpile.Mailpile(session=session)
+        config.open_local_mailbox(session)
+        return mp, session, config
+
+
+class TestIngestPool(FreshMailpileTest):
+    """Scans using ingestion workers index the same as those without."""
+
+    def scan(self, processes):
+        mp, session, config = self.new_mailpile(ingest_processes=processes)
+        mp.add(os.path.join(get_mailpile_root(),
+                            'mailpile', 'tests', 'data', 'Maildir'))
+        mp.rescan('mailboxes')
+        idx = config.index
+        return (sorted(idx.INDEX),
+                [sorted(idx.search(session, [term]).as_set())
+                 for term in ('brennan', 'from:twitter', 'att:jpg',
+                              'has:attachment', 'personal:is')])
+
+    def test_ingest_processes(self):
+        assert_equal(self.scan(2), self.scan(0))
+
+
+class TestInvisibleTags(FreshMailpileTest):
+    """Hidden tags are only searched if the query mentions them."""
+
+    def test_grouped_mentions(self):
+        mp, session, config = self.new_mailpile()
+        mp.add(os.path.join(get_mailpile_root(),
+                            'mailpile', 'tests', 'data', 'Maildir'))
+        mp.rescan('mailboxes')
+        AddTag(session, arg=['Trash']).run(save=False)
+        trash = config.get_tag('Trash')
+        trash.update({'flag_hides': True})
+
+        idx = config.index
+        trashed = idx.search(session, ['brennan']).as_set()
+        idx.add_tag(session, trash._key, msg_idxs=trashed)
+
+        def search(*terms):
+            return idx.search(session, list(terms)).as_set()
+
+        assert_equal(len(trashed), 1)
+        assert_equal(search('brennan'), set())
+        assert_equal(len(search('from:twitter')), 1)
+        assert_equal(search('in:trash'), trashed)
+        assert_equal(search('(in:trash', 'OR', 'brennan)'), trashed)
+        assert_equal(search('in:(trash', 'OR', 'nothing)'), trashed)
+
+
+class TestSizeSearch(FreshMailpileTest):
+    """Size searches use the size column, which is in KB."""
+
+    def setUp(self):
+        FreshMailpileTest.setUp(self)
+        self.mp, self.session, self.config = self.new_mailpile()
+        self.maildir = os.path.join(self.mailpiles[-1][0], 'Sizes')
+        mbox = Maildir(self.maildir)
+        for subject, size in (('tiny', 300), ('small', 700),
+                              ('large', 3000)):
+            message = 'Subject: {0!s}\n\n'.format(subject)
+            mbox.add(message + 'x' * (size - len(message)))
+        self.mp.add(self.maildir)
+        self.mp.rescan('mailboxes')
+        self.idx = self.config.index
+
+    def search(self, term):
+        return sorted(self.idx.get_msg_at_idx_pos(i)[self.idx.MSG_SUBJECT]
+                      for i in self.idx.search(self.session, [term]).as_set())
+
+    def test_sub_kb_ranges(self):
+        assert_equal(self.search('size:256b..511b'), ['tiny'])
+        assert_equal(self.search('size:512b'), ['small'])
+        assert_equal(self.search('size:1..1kb'), ['small', 'tiny'])
+        assert_equal(self.search('size:300b..2k'), ['large', 'small', 'tiny'])
+        assert_equal(self.search('size:2k..4k'), ['large'])
+
+    def test_migrated_sizes(self):
+        # Turn the metadata into V1, which has no MSG_CC or MSG_KB
+        lines = []
+        for line in self.idx.INDEX:
+            words = line.split('\t')
+            del words[self.idx.MSG_KB]
+            del words[self.idx.MSG_CC]
+            lines.append('\t'.join(words))
+        with open(self.config.mailindex_file(), 'w') as fd:
+            fd.write('\n'.join(lines) + '\n')
+
+        self.idx.load(self.session)
+        assert_equal(len(self.idx._unsized), 3)
+        assert_equal(self.search('size:2k..4k'), [])
+
+        self.idx.backfill_msg_sizes(self.session)
+        assert_equal(len(self.idx._unsized), 0)
+        assert_equal(self.search('size:2k..4k'), ['large'])
+
+
+class TestScanChanges(FreshMailpileTest):
+    """Rescans told exactly which Maildir keys came and went."""
+
+    def test_add_rename_delete(self):
+        mp, session, config = self.new_mailpile()
+        path = os.path.join(self.mailpiles[-1][0], 'Changes')
+        mbox = Maildir(path)
+        keys = [mbox.add('Subject: Changes %d\n\nHello\n' % i)
+                for i in range(0, 3)]
+        mp.add(path)
+        mp.rescan('mailboxes')
+
+        idx = config.index
+        mbx_id = idx.PTRS.keys()[0][:MBX_ID_LEN]  # The only mail we have
+        def ptrs():
+            return sorted(p for p in idx.PTRS if p.startswith(mbx_id))
+        def ptrs_for(*keys):
+            return sorted(mbox.get_msg_ptr(mbx_id, k) for k in keys)
+        assert_equal(ptrs(), ptrs_for(*keys))
+
+        # New mail, a flag change (a rename within cur/) and a deletion;
+        # the renamed key shows up as both removed and added.
+        new_key = mbox.add('Subject: Changes 3\n\nHello\n')
+        old_fn = os.path.join(path, mbox._lookup(keys[0]))
+        os.rename(old_fn, os.path.join(
+            path, 'cur', os.path.basename(old_fn).split(':')[0] + ':2,S'))
+        mbox.remove(keys[1])
+
+        idx.scan_mailbox(session, mbx_id, path, config.open_mailbox,
+                         changes=(set([new_key, keys[0]]),
+                                  set([keys[0], keys[1]])))
+        assert_equal(ptrs(), ptrs_for(keys[0], keys[2], new_key))
+        msg_info = idx.get_msg_at_idx_pos(idx.PTRS[ptrs_for(new_key)[0]])
+        assert_equal(msg_info[idx.MSG_SUBJECT], 'Changes 3')
+
+
+class TestLazyScan(FreshMailpileTest):
+    """A lazy (headers only) scan, followed by the body scan it queues."""
+
+    class SlowWorker(object):
+        def __init__(self):
+            self.tasks = []
+
+        def add_unique_task(self, session, name, task):
+            self.tasks.append(task)
+
+    def setUp(self):
+        FreshMailpileTest.setUp(self)
+        self.mp, self.session, self.config = self.new_mailpile()
+        self.slow_worker = self.config.slow_worker = self.SlowWorker()
+
+    def tearDown(self):
+        self.config.slow_worker = self.config.dumb_worker
+        FreshMailpileTest.tearDown(self)
+
+    def lazy_then_body_scan(self, name, header_word, body_word):
+        data = os.path.join(get_mailpile_root(),
+                            'mailpile', 'tests', 'data', name)
+        path = os.path.join(self.mailpiles[-1][0], name)
+        if os.path.isdir(data):
+            shutil.copytree(data, path)
+        else:
+            shutil.copyfile(data, path)
+        mbx_id = FormatMbxId(self.mp.add(path).result['added'].keys()[0])
+
+        idx = self.config.index
+        def hits(word):
+            return len(idx.search(self.session, [word]).as_set())
+
+        # Only the headers get indexed at first...
+        idx.scan_mailbox(self.session, mbx_id, path, self.config.open_mailbox,
+                         lazy=True)
+        assert_equal(hits(header_word), 1)
+        assert_equal(hits(body_word), 0)
+        assert_equal(len(self.slow_worker.tasks), 1)
+        assert(mbx_id not in idx._scanned)
+
+        # ... the bodies once the queued rescan runs.
+        self.slow_worker.tasks.pop()()
+        assert_equal(hits(header_word), 1)
+        assert_equal(hits(body_word), 1)
+        assert(mbx_id in idx._scanned)
+
+    def test_mbox(self):
+        self.lazy_then_body_scan('tests.mbx', 'usbip', 'libusb')
+
+    def test_maildir(self):
+        self.lazy_then_body_scan('Maildir', 'masculinity', 'workshop')
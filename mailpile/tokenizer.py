@@ -0,0 +1,159 @@
+import re
+
+from mailpile.util import WORD_REGEXP, STOPLIST
+
+
+#
+# This module turns message text into search keywords. The same rules must
+# be applied to both the text being indexed and the terms being searched
+# for, so all the case folding and splitting lives here.
+#
+
+# How many distinct words from the body of a single message we index, by
+# default (see sys.index_max_terms). Normal mail comes nowhere close; this
+# keeps pathological messages (huge logs, base64 pasted inline, dictionary
+# spam) from bloating the index.
+MAX_TERMS = 5000
+
+# Words are split on Unicode whitespace and punctuation, not just ASCII
+WORD_RE = re.compile(WORD_REGEXP.pattern, re.UNICODE)
+
+# Characters which lower() does not fold to what a user would search for
+CASE_FOLDS = {
+    u'\u00df': u'ss',      # LATIN SMALL LETTER SHARP S
+    u'\u1e9e': u'ss',      # LATIN CAPITAL LETTER SHARP S
+    u'\u017f': u's',       # LATIN SMALL LETTER LONG S
+    u'\u03c2': u'\u03c3'   # GREEK SMALL LETTER FINAL SIGMA
+}
+CASE_FOLD_RE = re.compile(u'[{0!s}]'.format(u''.join(CASE_FOLDS.keys())))
+
+# Quoted text and ASCII-art rules, one line at a time
+QUOTED_LINE_MARKERS = ('>', '----', '====', '____')
+
+# The RFC 3676 signature delimiter
+SIGNATURE_RE = re.compile('\n-- \r?\n')
+
+
+def LowerCase(text):
+    """
+    Lowercase a string, without folding any special cases. Byte strings
+    are assumed to be UTF-8, if they decode as such. This is how keywords
+    were indexed before CaseFold() existed.
+
+    >>> LowerCase(u'Stra\\xdfe'), LowerCase('Caf\\xc3\\x89')
+    (u'stra\\xdfe', u'caf\\xe9')
+    """
+    if isinstance(text, str):
+        try:
+            text = text.decode('utf-8')
+        except UnicodeDecodeError:
+            pass
+    return text.lower()
+
+
+def CaseFold(text):
+    """
+    Fold the case of a string, so equivalent words compare equal. Byte
+    strings are assumed to be UTF-8, if they decode as such.
+
+    >>> CaseFold(u'Stra\\xdfe \\u039f\\u0394\\u039f\\u03a3')
+    u'strasse \\u03bf\\u03b4\\u03bf\\u03c3'
+    >>> CaseFold('Caf\\xc3\\xa9')
+    u'caf\\xe9'
+    >>> CaseFold('Caf\\xe9')
+    'caf\\xe9'
+    """
+    text = LowerCase(text)
+    if isinstance(text, unicode) and CASE_FOLD_RE.search(text):
+        text = CASE_FOLD_RE.sub(lambda m: CASE_FOLDS[m.group(0)], text)
+    return text
+
+
+def StripQuotes(text):
+    """
+    Remove quoted lines and ASCII-art rules from a message body.
+
+    >>> StripQuotes('Hi!\\n> You wrote\\n-----\\nBye\\n')
+    'Hi!\\nBye\\n'
+    """
+    return ''.join(l for l in text.splitlines(True)
+                   if not l.startswith(QUOTED_LINE_MARKERS))
+
+
+def StripSignature(text):
+    """
+    Remove the signature (if any) from a message body.
+
+    >>> StripSignature('Hi!\\n-- \\nBob, CEO of Bob Inc.\\n')
+    'Hi!\\n'
+    """
+    m = SIGNATURE_RE.search(text)
+    return text[:m.start() + 1] if m else text
+
+
+def Words(text, stoplist=None, fold=True):
+    """
+    Split text into (case folded) words, dropping any in the stoplist.
+    If fold is False, the words are only lowercased.
+
+    >>> Words(u'Hello, W\\xd6RLD! This is a test.', stoplist=STOPLIST)
+    [u'w\\xf6rld', u'test']
+    >>> Words(u'Gro\\xdfe', fold=False)
+    [u'gro\\xdfe']
+    >>> Words(u'non\\xa0breaking\\u3000spaces')
+    [u'non', u'breaking', u'spaces']
+    """
+    words = WORD_RE.findall((CaseFold if fold else LowerCase)(text))
+    if stoplist:
+        words = [w for w in words if w not in stoplist]
+    return words
+
+
+class TermCollector(object):
+    """
+    Collects the words from the text of a message, giving up on new words
+    once max_terms distinct words have been seen. Repeated words are kept,
+    so callers can still count term frequencies. Words in the stoplist do
+    not count towards the limit, but are not removed either; that is left
+    to the caller.
+
+    >>> tc = TermCollector(max_terms=2, stoplist=STOPLIST)
+    >>> tc.words(u'one two one and three two'), tc.truncated
+    ([u'one', u'two', u'one', u'and', u'two'], True)
+    >>> tc.words(u'Four, TWO')
+    [u'two']
+    """
+    def __init__(self, max_terms=MAX_TERMS, stoplist=STOPLIST):
+        self.max_terms = max_terms
+        self.stoplist = stoplist
+        self.seen = set()
+        self.truncated = False
+
+    def words(self, text):
+        words = Words(text)
+        new_words = set(words) - self.seen
+        if self.stoplist:
+            new_words -= self.stoplist
+        if len(self.seen) + len(new_words) <= self.max_terms:
+            self.seen |= new_words
+            return words
+
+        # Too many: accept new words in order until we hit the limit
+        self.truncated = True
+        for word in words:
+            if len(self.seen) >= self.max_terms:
+                break
+            if word in new_words:
+                self.seen.add(word)
+        stoplist = self.stoplist or ()
+        return [w for w in words if w in self.seen or w in stoplist]
+
+
+if __name__ == '__main__':
+    import doctest
+    import sys
+    results = doctest.testmod(optionflags=doctest.ELLIPSIS,
+                              extraglobs={})
+    print '{0!s}'.format(results)
+    if results.failed:
+        sys.exit(1)
@@ -737,6 +737,7 @@ class Session(object):
         self.last_event_id = None
         self.displayed = None
         self.context = None
+        self.count_searches = True
 
     def set_interactive(self, val):
         self.ui.interactive = val
@@ -759,9 +760,9 @@ class Session(object):
     def get_context(self, update=False):
         if update or not self.context:
             if self.searched:
-                sid = self.config.search_history.add(self.searched,
-                                                     self.results,
-                                                     self.order)
+                sid = self.config.search_history.add(
+                    self.searched, self.results, self.order,
+                    count=self.count_searches, context=self.context)
                 self.context = 'search:{0!s}'.format(sid)
         return self.context
 
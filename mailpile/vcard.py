@@ -1218,11 +1218,14 @@ class VCardStore(dict):
         self.loading = False
         self.loaded = False
         self._lock = VCardRLock()
+        self._profile_emails = None
 
     def index_vcard(self, card, collision_callback=None):
         attrs = (['email'] if (card.kind in self.KINDS_PEOPLE)
                  else ['nickname'])
         with self._lock:
+            if card.kind == 'profile':
+                self._profile_emails = None
             for attr in attrs:
                 for n, vcl in enumerate(card.get_all(attr, sort=True)):
                     key = vcl.value.lower()
@@ -1238,6 +1241,8 @@ class VCardStore(dict):
         attrs = (['email'] if (card.kind in self.KINDS_PEOPLE)
                  else ['nickname'])
         with self._lock:
+            if card.kind == 'profile':
+                self._profile_emails = None
             for attr in attrs:
                 for vcl in card.get_all(attr):
                     key = vcl.value.lower()
@@ -1329,6 +1334,21 @@ class VCardStore(dict):
             results.sort(key=lambda card: card.fn)
             return results
 
+    def profile_emails(self):
+        """
+        Return the (lowercased) e-mail addresses of all our profiles. This
+        is cached until a profile is indexed or deindexed.
+        """
+        with self._lock:
+            if self._profile_emails is None:
+                emails = set()
+                for vc in self.find_vcards([], kinds=['profile']):
+                    emails |= set([vcl.value.lower()
+                                   for vcl in vc.get_all('email')
+                                   if vcl.value])
+                self._profile_emails = frozenset(emails)
+            return self._profile_emails
+
     def add_vcards(self, *cards):
         prefs = self.config.prefs
         for card in cards: